@@ -0,0 +1,281 @@
+"""Incremental stock alerting.
+
+AlertEngine keeps the set of active alerts for one copy of the data.  It is
+built once with a full scan and afterwards only re-evaluates the items touched
+by each new transaction, so reading the active alerts costs O(active alerts)
+instead of a scan over every site.
+
+Rules:
+
+* ``below_min``  - stock is at or below the item's minimum stock level.
+* ``stockout``   - at the average daily usage of the last USAGE_WINDOW_DAYS
+  the stock runs out within STOCKOUT_HORIZON_DAYS.
+* ``spike``      - a single usage is more than SPIKE_FACTOR times the mean
+  quantity per usage in the window, once the item has SPIKE_MIN_HISTORY
+  usages there.
+  Spike alerts expire after SPIKE_TTL_SECONDS.
+
+A stockout alert expires when the oldest usage it was computed from leaves
+the window; reading the alerts then re-evaluates the item at the lower usage.
+
+Alerts raised or cleared by a transaction are put on a process-wide
+notification queue; start_notifier() runs a background thread that drains it
+into a JSON-lines outbox file.
+"""
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+
+import ledger
+from storage import CATEGORIES
+
+
+USAGE_WINDOW_DAYS = 14
+STOCKOUT_HORIZON_DAYS = 7
+SPIKE_FACTOR = 3.0
+SPIKE_MIN_HISTORY = 5
+SPIKE_TTL_SECONDS = 24 * 3600
+
+OUTBOX_FILE = "alerts_outbox.jsonl"
+
+_DAY = 24 * 3600
+
+RULE_LABELS = {
+    'below_min': '🔴 Below Minimum',
+    'stockout': '🟠 Projected Stockout',
+    'spike': '🟣 Consumption Spike',
+}
+
+_notifications = queue.Queue()
+_notifier_lock = threading.Lock()
+_notifier_thread = None
+
+
+def touched_items(transaction):
+    """(site, category, item) keys whose stock a transaction can change"""
+    category = transaction.get('category')
+    item = transaction.get('item')
+    if transaction.get('type') == 'transfer':
+        return [(transaction.get('from_site'), category, item), (transaction.get('to_site'), category, item)]
+    return [(transaction.get('site'), category, item)]
+
+
+class AlertEngine:
+    """Active alerts and rolling usage statistics for one data dict"""
+
+    def __init__(self, data):
+        self.data = data
+        self.active = {}
+        self._by_item = collections.defaultdict(set)
+        self._usage = collections.defaultdict(collections.deque)
+        self._usage_total = collections.defaultdict(float)
+        self.rebuild()
+
+    def rebuild(self):
+        """Full scan; alerts found here are already known and not notified"""
+        self.active.clear()
+        self._by_item.clear()
+        self._usage.clear()
+        self._usage_total.clear()
+
+        now = time.time()
+        log = self.data['transactions']
+        for transaction in ledger.transactions_between(log, now - USAGE_WINDOW_DAYS * _DAY, float('inf')):
+            if transaction.get('type') == 'used':
+                self._record_usage(transaction)
+
+        for site_name, site_info in self.data['sites'].items():
+            for category in CATEGORIES:
+                for item_name in site_info.get(category, {}):
+                    self._evaluate((site_name, category, item_name), now, notify=False)
+
+    def on_transaction(self, transaction, notify=True):
+        """Re-evaluate the items a transaction touched; return newly raised alerts.
+
+        Pass notify=False for transactions another replica already notified.
+        """
+        now = transaction.get('ts', time.time())
+        raised = []
+        if transaction.get('type') == 'used':
+            key = (transaction.get('site'), transaction.get('category'), transaction.get('item'))
+            spike = self._check_spike(key, transaction, now, notify)
+            self._record_usage(transaction)
+            if spike:
+                raised.append(spike)
+        for key in touched_items(transaction):
+            raised.extend(self._evaluate(key, now, notify=notify))
+        return raised
+
+    def forget_site(self, site_name):
+        """Drop every alert of a removed site"""
+        for key in [k for k in self._by_item if k[0] == site_name]:
+            for alert_key in list(self._by_item[key]):
+                self._clear(alert_key, notify=False)
+            self._by_item.pop(key, None)
+
+    def _expire(self, alert_keys):
+        """Drop expired spikes and re-evaluate items whose stockout alert aged"""
+        now = time.time()
+        for alert_key in [k for k in alert_keys if self.active[k].get('expires_ts', now + 1) <= now]:
+            if alert_key[0] == 'spike':
+                self._clear(alert_key, notify=False)
+            elif alert_key in self.active:
+                self._evaluate(alert_key[1:], now, notify=False)
+
+    def active_alerts(self, site=None):
+        """Currently active alerts, newest first"""
+        self._expire(self.active)
+        alerts = [a for a in self.active.values() if site is None or a['site'] == site]
+        return sorted(alerts, key=lambda a: a['raised_ts'], reverse=True)
+
+    def item_alerts(self, site_name, category, item_name):
+        """Active alerts for one item"""
+        key = (site_name, category, item_name)
+        self._expire(self._by_item.get(key, ()))
+        return [self.active[k] for k in self._by_item.get(key, ())]
+
+    def count(self, rule=None):
+        self._expire(self.active)
+        return sum(1 for a in self.active.values() if rule is None or a['rule'] == rule)
+
+    def daily_usage(self, key):
+        return self._usage_total.get(key, 0.0) / USAGE_WINDOW_DAYS
+
+    def usage_mean(self, key):
+        """Mean quantity per usage in the window"""
+        window = self._usage.get(key)
+        return self._usage_total.get(key, 0.0) / len(window) if window else 0.0
+
+    def _record_usage(self, transaction):
+        key = (transaction.get('site'), transaction.get('category'), transaction.get('item'))
+        window = self._usage[key]
+        window.append((transaction['ts'], transaction.get('quantity', 0)))
+        self._usage_total[key] += transaction.get('quantity', 0)
+        self._expire_usage(key, transaction['ts'])
+
+    def _expire_usage(self, key, now):
+        window = self._usage.get(key)
+        if not window:
+            return
+        cutoff = now - USAGE_WINDOW_DAYS * _DAY
+        while window and window[0][0] < cutoff:
+            self._usage_total[key] -= window.popleft()[1]
+        if not window:
+            self._usage_total[key] = 0.0
+
+    def _item(self, key):
+        site_name, category, item_name = key
+        return self.data['sites'].get(site_name, {}).get(category, {}).get(item_name)
+
+    def _check_spike(self, key, transaction, now, notify):
+        self._expire_usage(key, now)
+        average = self.usage_mean(key)
+        quantity = transaction.get('quantity', 0)
+        if len(self._usage.get(key, ())) < SPIKE_MIN_HISTORY or average <= 0 or quantity <= SPIKE_FACTOR * average:
+            return None
+        return self._raise(('spike',) + key, {
+            'message': f"Usage of {quantity} is {quantity / average:.1f}x the average usage ({average:.1f})",
+            'quantity': quantity,
+            'expires_ts': now + SPIKE_TTL_SECONDS,
+        }, now, notify)
+
+    def _evaluate(self, key, now, notify):
+        item = self._item(key)
+        if item is None:
+            for alert_key in list(self._by_item.get(key, ())):
+                self._clear(alert_key, notify)
+            return []
+
+        raised = []
+        stock = item.get('stock', 0)
+        min_stock = item.get('min_stock', 0)
+        unit = item.get('unit', '')
+
+        if stock <= min_stock:
+            alert = self._raise(('below_min',) + key, {
+                'message': f"Stock {stock} {unit} is at or below minimum {min_stock} {unit}",
+                'stock': stock,
+            }, now, notify)
+            if alert:
+                raised.append(alert)
+        else:
+            self._clear(('below_min',) + key, notify)
+
+        self._expire_usage(key, now)
+        daily = self.daily_usage(key)
+        days_left = stock / daily if daily > 0 else None
+        if days_left is not None and days_left <= STOCKOUT_HORIZON_DAYS:
+            alert = self._raise(('stockout',) + key, {
+                'message': f"About {days_left:.1f} days of stock left at {daily:.1f} {unit}/day",
+                'stock': stock,
+                'days_left': round(days_left, 1),
+                'expires_ts': self._usage[key][0][0] + USAGE_WINDOW_DAYS * _DAY,
+            }, now, notify)
+            if alert:
+                raised.append(alert)
+        else:
+            self._clear(('stockout',) + key, notify)
+        return raised
+
+    def _raise(self, alert_key, details, now, notify):
+        """Activate an alert; returns it only if it was not already active"""
+        existing = self.active.get(alert_key)
+        if existing is not None:
+            existing.update(details)
+            return None
+        rule, site_name, category, item_name = alert_key
+        alert = {'rule': rule, 'site': site_name, 'category': category, 'item': item_name, 'raised_ts': now}
+        alert.update(details)
+        self.active[alert_key] = alert
+        self._by_item[alert_key[1:]].add(alert_key)
+        if notify:
+            _notifications.put({'event': 'raised', **alert})
+        return alert
+
+    def _clear(self, alert_key, notify):
+        alert = self.active.pop(alert_key, None)
+        if alert is None:
+            return
+        self._by_item[alert_key[1:]].discard(alert_key)
+        if notify:
+            _notifications.put({'event': 'cleared', 'cleared_ts': time.time(), **alert})
+
+
+def _drain(outbox_path):
+    while True:
+        batch = [_notifications.get()]
+        while True:
+            try:
+                batch.append(_notifications.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            with open(outbox_path, "a", encoding="utf-8") as f:
+                for notification in batch:
+                    f.write(json.dumps(notification, default=str, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Could not write alert notifications to {outbox_path}: {e}", file=sys.stderr)
+        for _ in batch:
+            _notifications.task_done()
+
+
+def start_notifier(outbox_path=OUTBOX_FILE):
+    """Start the background thread writing notifications to the outbox (once per process)"""
+    global _notifier_thread
+    with _notifier_lock:
+        if _notifier_thread is None or not _notifier_thread.is_alive():
+            _notifier_thread = threading.Thread(target=_drain, args=(outbox_path,),
+                                                name="alert-notifier", daemon=True)
+            _notifier_thread.start()
+
+
+def pending_notifications():
+    return _notifications.qsize()
+
+
+def flush_notifications():
+    """Block until every queued notification has been written"""
+    _notifications.join()
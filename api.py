@@ -0,0 +1,380 @@
+"""Local HTTP/JSON API for batch and mobile clients.
+
+Runs next to the Streamlit app on the same data directory and uses the same
+inventory, ledger, storage and alert modules::
+
+    python api.py [--host 127.0.0.1] [--port 8765] [--data-dir multi_site_data]
+
+Read endpoints::
+
+    GET  /health
+    GET  /sites
+    GET  /sites/<site>/inventory
+    GET  /items?code=<code>            (hash index lookup)
+    GET  /items?name=<part of name>
+    GET  /transactions?after=<seq>&limit=<n>
+
+Write endpoints take a batch of records, each with a client generated
+``request_id``.  A record whose request_id was already applied is reported as
+``duplicate`` and not applied again, so clients can safely retry a batch.
+The other statuses are ``applied``, ``conflict`` and ``invalid`` (see sync)::
+
+    POST /batch     {"operations": [{"op": "add" | "use" | "transfer", ...}, ...]}
+    POST /sync      {"records": [...]}     offline outbox, same semantics
+    POST /add       {"records": [...]}
+    POST /use       {"records": [...]}
+    POST /transfer  {"records": [...]}
+
+Writes are applied to the in-memory store under one lock and persisted by a
+background flusher that writes each dirty site shard once per flush (group
+commit).  A request returns after the flush that contains its records, so
+many concurrent writers share a single file write.  When a flush fails its
+records are taken back and the requests fail, so they can be resent.  Clients should reuse one
+connection (HTTP/1.1 keep-alive); Client below does that.
+
+The store follows the change feed (see change_feed), so writes made by the
+Streamlit app or another API process are picked up before each request.  A
+write takes the feed's write lock before applying its records and the flush
+releases it, so the seqs handed out are unique across processes.
+"""
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import alerts
+import change_feed
+import inventory
+import item_index
+import ledger
+import storage
+import sync
+from storage import CATEGORIES
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+FLUSH_INTERVAL = 0.02
+MAX_PAGE = 1000
+
+
+class Store:
+    """In-memory data shared by all API requests, persisted with group commit"""
+
+    def __init__(self, data_dir=storage.DATA_DIR, flush_interval=FLUSH_INTERVAL):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval
+        self.feed = change_feed.ChangeFeed(data_dir)
+        self.data = self.feed.load() or {
+            'sites': {}, 'transactions': [], 'system_info': {'total_sites': 0}}
+        self.alert_engine = alerts.AlertEngine(self.data)
+        self.code_index = item_index.CodeIndex(self.data)
+        self.applied = sync.request_index(self.data['transactions'])
+
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._dirty = set()
+        self._generation = 0
+        self._flushed_generation = 0
+        self._flush_error = None
+        self._rejected = set()
+        self._flusher = threading.Thread(target=self._flush_loop, name="api-flusher", daemon=True)
+        self._flusher.start()
+        alerts.start_notifier()
+
+    def _apply_changes(self, transactions, reset):
+        """Catch up with what other processes saved (lock held)"""
+        if reset:
+            self.alert_engine.rebuild()
+            self.code_index.rebuild()
+            self.applied = sync.request_index(self.data['transactions'])
+            return
+        for transaction in transactions:
+            self.alert_engine.on_transaction(transaction, notify=False)
+            self.code_index.on_transaction(transaction)
+            if transaction.get('request_id'):
+                self.applied[transaction['request_id']] = transaction['seq']
+
+    def _catch_up(self):
+        # Unflushed writes are merged by the flusher's save instead.
+        if not self._dirty:
+            self._apply_changes(*self.feed.poll(self.data))
+
+    def apply(self, operations):
+        """Apply a batch of operations and wait until it is on disk"""
+        with self._lock:
+            self._apply_changes(*self.feed.begin(self.data))
+            results, transactions = sync.apply_batch(self.data, operations, self.applied)
+            for transaction in transactions:
+                self._dirty.update(inventory.touched_sites(transaction))
+                self.alert_engine.on_transaction(transaction)
+                self.code_index.on_transaction(transaction)
+            if not self._dirty:
+                self.feed.release()
+            if transactions:
+                self._generation += 1
+                generation = self._generation
+                self._flushed.notify_all()
+                while self._flushed_generation < generation:
+                    self._flushed.wait()
+                if self._flush_error is not None:
+                    raise RuntimeError(f"Failed to save data: {self._flush_error}")
+                # A failed flush lets other processes write first; the retry renumbers
+                # and drops records they already applied or whose item they deleted.
+                seqs = {t['request_id']: t['seq'] for t in transactions}
+                for result in results:
+                    if result['status'] != 'applied':
+                        continue
+                    if result['request_id'] in self._rejected:
+                        self._rejected.discard(result['request_id'])
+                        if result['request_id'] in self.applied:
+                            result.update(status='duplicate', seq=self.applied[result['request_id']])
+                        else:
+                            result.update(status='conflict', error="Item deleted by another process before it was saved")
+                            result.pop('seq', None)
+                    else:
+                        result['seq'] = seqs[result['request_id']]
+        return results
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while self._flushed_generation == self._generation:
+                    self._flushed.wait()
+            # Let concurrent writers pile into the same flush.
+            time.sleep(self.flush_interval)
+            with self._lock:
+                generation = self._generation
+                dirty, self._dirty = self._dirty, set()
+                try:
+                    if dirty:
+                        pending = ledger.transactions_after(self.data['transactions'], self.feed.seq)
+                        self._apply_changes(*self.feed.save(self.data, dirty))
+                        rejected, self.feed.rejected = self.feed.rejected, []
+                        self._rejected.update(t['request_id'] for t in rejected if t.get('request_id'))
+                        self.applied.update((t['request_id'], t['seq']) for t in pending
+                                            if t.get('request_id') and t['request_id'] not in self._rejected)
+                    self._flush_error = None
+                except Exception as e:
+                    self._flush_error = e
+                    self._roll_back(dirty)
+                finally:
+                    self.feed.release()
+                self._flushed_generation = generation
+                self._flushed.notify_all()
+
+    def _roll_back(self, dirty):
+        """Take back the writes of a failed flush so their clients can resend them"""
+        sync.undo_batch(self.data, ledger.transactions_after(self.data['transactions'], self.feed.seq), self.applied)
+        self._apply_changes([], True)
+        try:
+            # Shards written before the failure still hold the writes.
+            self.feed.save(self.data, dirty)
+        except Exception as e:
+            print(f"Could not rewrite {', '.join(sorted(dirty))} after a failed save: {e}", file=sys.stderr)
+
+    def sites(self):
+        with self._lock:
+            self._catch_up()
+            return [{'site': name, **{k: v for k, v in info.items() if k not in CATEGORIES}}
+                    for name, info in self.data['sites'].items()]
+
+    def site_inventory(self, site_name):
+        with self._lock:
+            self._catch_up()
+            site_info = self.data['sites'].get(site_name)
+            if site_info is None:
+                return None
+            return {category: dict(site_info.get(category, {})) for category in CATEGORIES}
+
+    def find_items(self, code=None, name=None):
+        """Items matching a code exactly or containing name, across all sites"""
+        if code:
+            with self._lock:
+                self._catch_up()
+                return [{'site': site_name, 'category': category, 'item': item_name,
+                         **self.data['sites'][site_name][category][item_name]}
+                        for site_name, category, item_name in self.code_index.lookup(code)]
+        name = name.lower()
+        matches = []
+        with self._lock:
+            self._catch_up()
+            for site_name, site_info in self.data['sites'].items():
+                for category in CATEGORIES:
+                    for item_name, item in site_info.get(category, {}).items():
+                        if name in item_name.lower():
+                            matches.append({'site': site_name, 'category': category, 'item': item_name, **item})
+        return matches
+
+    def transactions_after(self, seq, limit):
+        with self._lock:
+            self._catch_up()
+            return ledger.transactions_after(self.data['transactions'], seq, limit)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, default=str, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        """The request's JSON object; ValueError when the body is not one"""
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body cannot be skipped, so the connection cannot be reused.
+            self.close_connection = True
+            raise ValueError("Invalid Content-Length")
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise ValueError("Body must be JSON") from None
+        if not isinstance(body, dict):
+            raise ValueError("Body must be a JSON object")
+        return body
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [urllib.parse.unquote(p) for p in url.path.strip("/").split("/") if p]
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if parts == ["health"]:
+            self._send(200, {'status': 'ok'})
+        elif parts == ["sites"]:
+            self._send(200, {'sites': self.store.sites()})
+        elif len(parts) == 3 and parts[0] == "sites" and parts[2] == "inventory":
+            inventory_data = self.store.site_inventory(parts[1])
+            if inventory_data is None:
+                self._send(404, {'error': f"Unknown site '{parts[1]}'"})
+            else:
+                self._send(200, {'site': parts[1], 'inventory': inventory_data})
+        elif parts == ["items"]:
+            if not query.get('code') and not query.get('name'):
+                self._send(400, {'error': "Pass code or name"})
+            else:
+                self._send(200, {'items': self.store.find_items(query.get('code'), query.get('name'))})
+        elif parts == ["transactions"]:
+            try:
+                after = int(query.get('after', 0))
+                limit = min(int(query.get('limit', 100)), MAX_PAGE)
+            except ValueError:
+                self._send(400, {'error': "after and limit must be integers"})
+                return
+            if limit < 0:
+                self._send(400, {'error': "limit must not be negative"})
+                return
+            page = self.store.transactions_after(after, limit)
+            next_after = page[-1]['seq'] if page else after
+            self._send(200, {'transactions': page, 'next_after': next_after})
+        else:
+            self._send(404, {'error': "Not found"})
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path.strip("/")
+        try:
+            body = self._read_json()
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        if path == "batch":
+            operations = body.get('operations')
+        elif path == "sync":
+            operations = body.get('records')
+        elif path in ("add", "use", "transfer"):
+            records = body.get('records')
+            operations = [{**record, 'op': path} for record in records] if isinstance(records, list) else None
+        else:
+            self._send(404, {'error': "Not found"})
+            return
+
+        if not isinstance(operations, list) or not all(isinstance(o, dict) for o in operations):
+            self._send(400, {'error': "Expected a list of operation objects"})
+            return
+        try:
+            results = self.store.apply(operations)
+        except RuntimeError as e:
+            self._send(500, {'error': str(e)})
+            return
+        self._send(200, {'results': results})
+
+
+def make_server(store, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """HTTP server bound to host:port serving the given store (port 0 picks a free port)"""
+    handler = type("Handler", (_Handler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class Client:
+    """Minimal JSON client keeping one persistent connection to the API"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=30):
+        self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            self._connection.close()
+            self._connection.request(method, path, body=body, headers=headers)
+            response = self._connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def get(self, path, **params):
+        if params:
+            path = f"{path}?{urllib.parse.urlencode(params)}"
+        return self._request("GET", path)
+
+    def post(self, path, payload):
+        return self._request("POST", path, payload)
+
+    def site_inventory(self, site_name):
+        return self.get(f"/sites/{urllib.parse.quote(site_name, safe='')}/inventory")
+
+    def batch(self, operations):
+        return self.post("/batch", {'operations': operations})
+
+    def close(self):
+        self._connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON API for the material management data")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--data-dir", default=storage.DATA_DIR, help="sharded data directory")
+    args = parser.parse_args(argv)
+
+    server = make_server(Store(args.data_dir), args.host, args.port)
+    print(f"Serving material API on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
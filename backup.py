@@ -0,0 +1,333 @@
+"""Full and incremental backups with point-in-time restore.
+
+Backups live in one directory with a manifest::
+
+    backups/manifest.json
+    backups/<id>-full.zmm     the whole data dict
+    backups/<id>-delta.zmm    changes since the previous backup
+
+A delta holds only what changed since the backup before it: the new
+transactions (found by seq), the current state of the items those
+transactions touched, the site headers (location, manager, version ...)
+and system_info.  Sites that are new or were recreated since (their
+generation changed, see inventory.add_site) are stored whole.  Its cost therefore follows the change volume, not the data size.
+A full backup is taken every FULL_EVERY backups, or when the data cannot be
+expressed as a delta of the previous backup (e.g. it was restored to an
+older point).  A restore keeps counting seqs from the highest one already
+published, see prepare_restore().
+
+Files use the binary snapshot encoding (zlib-compressed) and the manifest
+records each file's SHA-256, checked before anything is restored.  Restoring
+backup N loads the last full backup at or before N and applies the deltas
+after it in order.  On the command line::
+
+    python backup.py create  [--full] [--data-dir multi_site_data] [--backup-dir backups]
+    python backup.py list    [--backup-dir backups]
+    python backup.py verify  [--backup-dir backups]
+    python backup.py restore <id> --to <data dir> [--backup-dir backups]
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import alerts
+import change_feed
+import inventory
+import ledger
+import storage
+from storage import CATEGORIES
+
+
+BACKUP_DIR = "backups"
+MANIFEST_FILE = "manifest.json"
+FULL_EVERY = 24
+INTERVAL = 15 * 60
+KEEP_FULL = 7
+
+_lock = threading.Lock()
+_last_created = {}
+
+
+class BackupError(Exception):
+    """Raised when a backup is missing, corrupt or cannot be restored."""
+
+
+def _write_atomic(path, blob):
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def _site_header(site_info):
+    return {k: v for k, v in site_info.items() if k not in CATEGORIES}
+
+
+def _site_versions(data):
+    return {site_name: inventory.site_version(site_info) for site_name, site_info in data['sites'].items()}
+
+
+def _site_generations(data):
+    return {site_name: inventory.site_generation(site_info) for site_name, site_info in data['sites'].items()}
+
+
+def _recreated(site_name, site_info, previous):
+    """Whether a site is new or was removed and added again since the previous backup"""
+    if site_name not in previous['site_versions']:
+        return True
+    generations = previous.get('site_generations')
+    if generations is not None and generations.get(site_name) != inventory.site_generation(site_info):
+        return True
+    # Backups taken before sites had generations
+    return inventory.site_version(site_info) < previous['site_versions'][site_name]
+
+
+def _delta(data, previous):
+    """Changes since the backup described by the manifest entry previous"""
+    new_transactions = ledger.transactions_after(data['transactions'], previous['last_seq'])
+    full_sites = {site_name: site_info for site_name, site_info in data['sites'].items()
+                  if _recreated(site_name, site_info, previous)}
+
+    items = {}
+    for transaction in new_transactions:
+        for site_name, category, item_name in alerts.touched_items(transaction):
+            if site_name in full_sites or site_name not in data['sites'] or category not in CATEGORIES:
+                continue
+            items[(site_name, category, item_name)] = data['sites'][site_name].get(category, {}).get(item_name)
+
+    return {
+        'transactions': new_transactions,
+        'items': [[site_name, category, item_name, item] for (site_name, category, item_name), item in items.items()],
+        'sites': {site_name: _site_header(site_info) for site_name, site_info in data['sites'].items()},
+        'full_sites': full_sites,
+        'extra': {k: v for k, v in data.items() if k not in ('sites', 'transactions')},
+    }
+
+
+def _apply_delta(data, delta):
+    data['transactions'].extend(delta['transactions'])
+    for site_name in [s for s in data['sites'] if s not in delta['sites']]:
+        del data['sites'][site_name]
+    for site_name, header in delta['sites'].items():
+        if site_name in delta['full_sites']:
+            data['sites'][site_name] = delta['full_sites'][site_name]
+            continue
+        site_info = data['sites'].setdefault(site_name, {category: {} for category in CATEGORIES})
+        for key in [k for k in site_info if k not in CATEGORIES]:
+            del site_info[key]
+        site_info.update(header)
+    for site_name, category, item_name, item in delta['items']:
+        items = data['sites'][site_name].setdefault(category, {})
+        if item is None:
+            items.pop(item_name, None)
+        else:
+            items[item_name] = item
+    for key in [k for k in data if k not in ('sites', 'transactions')]:
+        del data[key]
+    data.update(delta['extra'])
+
+
+def prepare_restore(restored, current):
+    """Make restored data ready to replace current (None for an empty store).
+
+    Seqs up to current's last_seq were already handed out, so the restored
+    data counts on from there instead of reusing them, and its restore count
+    is bumped so the next backup is a full one.
+    """
+    if current is not None:
+        system_info = restored['system_info']
+        system_info['last_seq'] = max(ledger.last_seq(restored), ledger.last_seq(current))
+        system_info['restores'] = max(system_info.get('restores', 0),
+                                      current['system_info'].get('restores', 0)) + 1
+    return restored
+
+
+class Backups:
+    """Backup chain stored in one directory"""
+
+    def __init__(self, backup_dir=BACKUP_DIR, full_every=FULL_EVERY, keep_full=KEEP_FULL):
+        self.backup_dir = backup_dir
+        self.full_every = full_every
+        self.keep_full = keep_full
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.backup_dir, MANIFEST_FILE)
+
+    def entries(self):
+        """Manifest entries, oldest first"""
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)['backups']
+        except FileNotFoundError:
+            return []
+
+    def _save_manifest(self, entries):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        _write_atomic(self.manifest_path, json.dumps({'backups': entries}, indent=2).encode("utf-8"))
+
+    def _full_due(self, data, entries):
+        if not entries:
+            return True
+        previous = entries[-1]
+        if (ledger.last_seq(data) < previous['last_seq']
+                or data['system_info'].get('restores', 0) != previous.get('restores', 0)):
+            return True
+        since_full = next(i for i, e in enumerate(reversed(entries)) if e['kind'] == 'full')
+        return since_full + 1 >= self.full_every
+
+    def create(self, data, full=False):
+        """Write a backup of data (a delta when possible) and return its manifest entry"""
+        with _lock:
+            entries = self.entries()
+            kind = 'full' if full or self._full_due(data, entries) else 'delta'
+            payload = data if kind == 'full' else _delta(data, entries[-1])
+            blob = storage.encode_binary(payload)
+
+            created = time.time()
+            number = entries[-1]['number'] + 1 if entries else 1
+            backup_id = f"{datetime.datetime.fromtimestamp(created):%Y%m%d-%H%M%S}-{number:05d}"
+            file_name = f"{backup_id}-{kind}.zmm"
+            os.makedirs(self.backup_dir, exist_ok=True)
+            _write_atomic(os.path.join(self.backup_dir, file_name), blob)
+
+            entry = {
+                'id': backup_id,
+                'number': number,
+                'kind': kind,
+                'file': file_name,
+                'created_at': created,
+                'last_seq': ledger.last_seq(data),
+                'site_versions': _site_versions(data),
+                'site_generations': _site_generations(data),
+                'restores': data['system_info'].get('restores', 0),
+                'transactions': len(data['transactions']) if kind == 'full' else len(payload['transactions']),
+                'size': len(blob),
+                'sha256': hashlib.sha256(blob).hexdigest(),
+            }
+            entries.append(entry)
+            self._save_manifest(self._prune(entries))
+            _last_created[self.backup_dir] = created
+            return entry
+
+    def maybe_create(self, data, interval=INTERVAL):
+        """Take a backup if the last one is older than interval seconds"""
+        if self.backup_dir not in _last_created:
+            entries = self.entries()
+            _last_created[self.backup_dir] = entries[-1]['created_at'] if entries else 0
+        if time.time() - _last_created[self.backup_dir] < interval:
+            return None
+        return self.create(data)
+
+    def _prune(self, entries):
+        """Drop whole chains older than the keep_full most recent full backups"""
+        fulls = [i for i, e in enumerate(entries) if e['kind'] == 'full']
+        if len(fulls) <= self.keep_full:
+            return entries
+        cut = fulls[-self.keep_full]
+        for entry in entries[:cut]:
+            try:
+                os.remove(os.path.join(self.backup_dir, entry['file']))
+            except FileNotFoundError:
+                pass
+        return entries[cut:]
+
+    def _read(self, entry):
+        path = os.path.join(self.backup_dir, entry['file'])
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+        except OSError as e:
+            raise BackupError(f"Backup {entry['id']} is missing: {e}") from e
+        if hashlib.sha256(blob).hexdigest() != entry['sha256']:
+            raise BackupError(f"Backup {entry['id']} failed its checksum")
+        try:
+            return storage.decode_binary(blob)
+        except storage.SnapshotError as e:
+            raise BackupError(f"Backup {entry['id']} is corrupt: {e}") from e
+
+    def verify(self):
+        """(entry, error or None) for every backup"""
+        results = []
+        for entry in self.entries():
+            try:
+                self._read(entry)
+                results.append((entry, None))
+            except BackupError as e:
+                results.append((entry, str(e)))
+        return results
+
+    def restore(self, backup_id=None):
+        """Data dict as of the given backup (the latest when None)"""
+        entries = self.entries()
+        if not entries:
+            raise BackupError("No backups found")
+        if backup_id is None:
+            target = len(entries) - 1
+        else:
+            target = next((i for i, e in enumerate(entries) if e['id'] == backup_id), None)
+            if target is None:
+                raise BackupError(f"Unknown backup '{backup_id}'")
+        start = max((i for i in range(target + 1) if entries[i]['kind'] == 'full'), default=None)
+        if start is None:
+            raise BackupError(f"No full backup before '{entries[target]['id']}'")
+
+        data = self._read(entries[start])
+        for entry in entries[start + 1:target + 1]:
+            _apply_delta(data, self._read(entry))
+        return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Full and incremental backups of the material data")
+    parser.add_argument("--backup-dir", default=BACKUP_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    create = sub.add_parser("create", help="back up the data directory")
+    create.add_argument("--data-dir", default=storage.DATA_DIR)
+    create.add_argument("--full", action="store_true", help="take a full backup")
+    sub.add_parser("list", help="list backups")
+    sub.add_parser("verify", help="check every backup file against its checksum")
+    restore = sub.add_parser("restore", help="restore a backup into a data directory")
+    restore.add_argument("backup_id")
+    restore.add_argument("--to", required=True, help="data directory to write")
+    args = parser.parse_args(argv)
+
+    backups = Backups(args.backup_dir)
+    if args.command == "create":
+        data = storage.load_data(args.data_dir)
+        if data is None:
+            print(f"No data found in {args.data_dir}", file=sys.stderr)
+            return 2
+        entry = backups.create(data, full=args.full)
+        print(f"{entry['id']} ({entry['kind']}): {entry['transactions']} transactions, {entry['size']:,} bytes")
+    elif args.command == "list":
+        for entry in backups.entries():
+            print(f"{entry['id']}  {entry['kind']:<5}  seq {entry['last_seq']:<8}  {entry['size']:>12,} bytes")
+    elif args.command == "verify":
+        failed = 0
+        for entry, error in backups.verify():
+            print(f"{entry['id']}: {error or 'ok'}")
+            failed += error is not None
+        return 1 if failed else 0
+    else:
+        try:
+            data = backups.restore(args.backup_id)
+        except BackupError as e:
+            print(e, file=sys.stderr)
+            return 1
+        feed = change_feed.ChangeFeed(args.to)
+        current = feed.load()
+        with feed.writing(current or data):
+            prepare_restore(data, current)
+            feed.save(data, rewrite=True)
+        print(f"Restored {args.backup_id} into {args.to}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,434 @@
+"""Change feed between replicas of the data.
+
+Every process, and every Streamlit session in it, holds its own copy of the
+data.  Writers publish what they changed to an append-only JSON-lines feed
+next to the site shards::
+
+    multi_site_data/changes/feed-<n>.jsonl    one record per save
+    multi_site_data/changes/lock              writer lock
+
+A record holds the transactions of one save and the state of the items they
+touched afterwards.  Saves that rewrite everything (sites added or removed,
+settings, restores) publish a ``reset`` record instead and replace the data
+of every replica: readers reload it from the shards.
+
+Readers poll: reading past their offset in the current feed file tells
+whether anything was appended, and only the new records are applied, so a
+replica catches up in time proportional to the change volume rather than
+reloading the data set.
+
+A writer takes the lock, first applies the records of other replicas, then
+writes its shards and appends its own record, so writes from different
+replicas are serialized and none overwrites another's shard update.  Holding
+the lock from before its changes until they are published (begin() ...
+save(), or writing()) makes the last published seq a counter shared by all
+replicas: transactions appended meanwhile take the next seqs, unique and in
+publish order.  Transactions appended without the lock are renumbered after
+the ones merged in when they are saved.  When both sides changed the
+same item the other replica's state is taken and the local stock, used and
+value changes are re-applied on top; a local edit, delete or (re)creation of the
+item wins.  Local changes are rejected instead when the other replica deleted
+the item they change, or already applied a record with the same request_id;
+so are later local changes to an item a rejected transaction created.  They
+end up in ``rejected`` and the merge is reported as a reset, since anything
+derived from the data has seen them.
+
+Feed files roll over at MAX_FILE_BYTES and the last KEEP_FILES are kept; a
+replica that falls further behind reloads everything.
+"""
+import contextlib
+import json
+import os
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # no flock: writers are only serialized within a process
+    fcntl = None
+
+import alerts
+import inventory
+import ledger
+import storage
+import valuation
+
+
+FEED_DIR = "changes"
+LOCK_FILE = "lock"
+MAX_FILE_BYTES = 4 * 1024 * 1024
+KEEP_FILES = 2
+POLL_INTERVAL = 1
+
+_local_lock = threading.Lock()
+
+
+class StaleDataError(Exception):
+    """Raised when a full save would overwrite data another replica replaced."""
+
+
+def _stock_change(transaction, key):
+    """(stock, used, value) change of one touched item, or None when the transaction sets the item"""
+    kind = transaction.get('type')
+    quantity = transaction.get('quantity', 0)
+    value = transaction.get('value', 0)
+    if kind == 'added' and not transaction.get('new_item'):
+        return quantity, 0, value
+    if kind == 'used':
+        return -quantity, quantity, -value
+    if kind == 'transfer':
+        return (-quantity, 0, -value) if key[0] == transaction.get('from_site') else (quantity, 0, value)
+    return None
+
+
+def _rebase(item, local_item, changes):
+    """State of an item once local unpublished changes are re-applied on top of item"""
+    if not changes:
+        return item
+    if item is None or local_item is None or None in changes:
+        return local_item
+    item = dict(item)
+    item['value'] = valuation.item_value(item) + sum(change[2] for change in changes)
+    item['stock'] += sum(change[0] for change in changes)
+    item['used'] = item.get('used', 0) + sum(change[1] for change in changes)
+    if item['stock'] <= 0:
+        item['value'] = 0.0
+    return item
+
+
+def _creates(transaction, key):
+    """Whether the transaction created the item at key"""
+    if transaction.get('type') == 'transfer':
+        return bool(transaction.get('new_item')) and key[0] == transaction.get('to_site')
+    return transaction.get('type') == 'added' and bool(transaction.get('new_item'))
+
+
+def _undo(item, key, pending, rejected):
+    """Local item with the stock changes of rejected transactions since its last set taken back"""
+    undo = []
+    for transaction in pending:
+        if key not in alerts.touched_items(transaction):
+            continue
+        change = _stock_change(transaction, key)
+        if change is None:
+            undo = []
+        elif id(transaction) in rejected:
+            undo.append(change)
+    if not undo or item is None:
+        return item
+    item = dict(item)
+    item['value'] = valuation.item_value(item) - sum(change[2] for change in undo)
+    item['stock'] -= sum(change[0] for change in undo)
+    item['used'] = item.get('used', 0) - sum(change[1] for change in undo)
+    if item['stock'] <= 0:
+        item['value'] = 0.0
+    return item
+
+
+def _merge_pending(data, pending, local, remote, remote_ids):
+    """Set the items pending touched from their local and merged remote states.
+
+    local and remote map item keys to states; remote holds only the items
+    the merged changes touched.  Returns (kept, rejected) pending transactions.
+    """
+    rejected = {id(t) for t in pending if t.get('request_id') in remote_ids}
+    for key, item in remote.items():
+        if item is not None:
+            continue
+        # A delete by the other replica wins over local stock changes.
+        touching = [t for t in pending if key in alerts.touched_items(t)]
+        if touching and not any(_stock_change(t, key) is None or _creates(t, key) for t in touching):
+            rejected.update(id(t) for t in touching)
+    created = set()
+    for transaction in pending:
+        keys = alerts.touched_items(transaction)
+        if any(key in created for key in keys):
+            rejected.add(id(transaction))
+        if id(transaction) in rejected:
+            created.update(key for key in keys if key not in remote and _creates(transaction, key))
+
+    kept = [t for t in pending if id(t) not in rejected]
+    for key, local_item in local.items():
+        if key in created:
+            item = None
+        elif key in remote:
+            item = _rebase(remote[key], _undo(local_item, key, pending, rejected), _changes(kept, key))
+        else:
+            item = _undo(local_item, key, pending, rejected)
+        _set_item(data, key, item)
+    return kept, [t for t in pending if id(t) in rejected]
+
+
+def _get_item(data, key):
+    site_name, category, item_name = key
+    return data['sites'].get(site_name, {}).get(category, {}).get(item_name)
+
+
+def _set_item(data, key, item):
+    site_name, category, item_name = key
+    site_info = data['sites'].get(site_name)
+    if site_info is None:
+        return
+    if item is None:
+        site_info.get(category, {}).pop(item_name, None)
+    else:
+        site_info.setdefault(category, {})[item_name] = item
+
+
+def _changes(pending, key):
+    return [_stock_change(t, key) for t in pending if key in alerts.touched_items(t)]
+
+
+def _item_states(data, transactions):
+    states = {}
+    for transaction in transactions:
+        for key in alerts.touched_items(transaction):
+            states[key] = _get_item(data, key)
+    return states
+
+
+class ChangeFeed:
+    """One replica's position in the change feed of a data directory"""
+
+    def __init__(self, data_dir=storage.DATA_DIR):
+        self.data_dir = data_dir
+        self.feed_dir = os.path.join(data_dir, FEED_DIR)
+        self.origin = uuid.uuid4().hex
+        self.number = 1
+        self.offset = 0
+        self.seq = 0
+        self.rejected = []
+        self._held = None
+
+    def _path(self, number):
+        return os.path.join(self.feed_dir, f"feed-{number:06d}.jsonl")
+
+    def _numbers(self):
+        try:
+            names = os.listdir(self.feed_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[5:-6]) for name in names if name.startswith('feed-') and name.endswith('.jsonl'))
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive=True):
+        if self._held is not None:
+            yield
+            return
+        if fcntl is None:
+            with _local_lock:
+                yield
+            return
+        os.makedirs(self.feed_dir, exist_ok=True)
+        with open(os.path.join(self.feed_dir, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def begin(self, data):
+        """Take the write lock and apply what other replicas published.
+
+        Until release(), transactions appended to data get the seqs after
+        every published one.  Returns what poll() returns.
+        """
+        if self._held is None:
+            if fcntl is None:
+                _local_lock.acquire()
+                self._held = True
+            else:
+                os.makedirs(self.feed_dir, exist_ok=True)
+                f = open(os.path.join(self.feed_dir, LOCK_FILE), 'a')
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._held = f
+        try:
+            return self._catch_up(data)
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        """Give up the write lock taken by begin()"""
+        held, self._held = self._held, None
+        if held is None:
+            return
+        if fcntl is None:
+            _local_lock.release()
+        else:
+            fcntl.flock(held, fcntl.LOCK_UN)
+            held.close()
+
+    @contextlib.contextmanager
+    def writing(self, data):
+        """begin() ... release() around a block that changes and save()s data"""
+        changes = self.begin(data)
+        try:
+            yield changes
+        finally:
+            self.release()
+
+    def _seek_end(self):
+        numbers = self._numbers()
+        self.number = numbers[-1] if numbers else 1
+        path = self._path(self.number)
+        self.offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def load(self, legacy_base=storage.DATA_FILE):
+        """Load the data from its shards and follow the feed from that point"""
+        with self._locked(exclusive=False):
+            self._seek_end()
+            data = storage.load_data(self.data_dir, legacy_base)
+        self.seq = ledger.last_seq(data) if data else 0
+        return data
+
+    def _read_records(self):
+        """Complete records appended since the last read, or None when they are gone"""
+        records = []
+        while True:
+            # A file is complete once its successor exists, so check first.
+            has_next = os.path.exists(self._path(self.number + 1))
+            try:
+                with open(self._path(self.number), 'rb') as f:
+                    f.seek(self.offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                if has_next or any(n > self.number for n in self._numbers()):
+                    return None
+                return records
+            end = chunk.rfind(b'\n') + 1
+            records.extend(json.loads(line) for line in chunk[:end].splitlines())
+            self.offset += end
+            if not has_next:
+                return records
+            self.number += 1
+            self.offset = 0
+
+    def _reload(self, data):
+        """Replace data with the shards on disk, keeping unpublished local transactions"""
+        pending = ledger.transactions_after(data['transactions'], self.seq)
+        states = _item_states(data, pending)
+        self._seek_end()
+        fresh = storage.load_data(self.data_dir)
+        if fresh is None:
+            return
+        remote_ids = {t['request_id'] for t in ledger.transactions_after(fresh['transactions'], self.seq)
+                      if t.get('request_id')}
+        data.clear()
+        data.update(fresh)
+        self.seq = ledger.last_seq(data)
+        remote = {key: _get_item(data, key) for key in states}
+        kept, rejected = _merge_pending(data, pending, states, remote, remote_ids)
+        self.rejected.extend(rejected)
+        for transaction in kept:
+            ledger.reappend_transaction(data, transaction)
+            inventory.bump_versions(data, transaction)
+
+    def _apply(self, data, records):
+        """Merge other replicas' records into data; returns (their transactions, reset)"""
+        log = data['transactions']
+        pending = ledger.transactions_after(log, self.seq)
+        local = _item_states(data, pending)
+        if pending:
+            del log[-len(pending):]
+            data['system_info']['last_seq'] = self.seq
+        merged = []
+        remote = {}
+        for record in records:
+            for transaction in record['transactions']:
+                log.append(transaction)
+                inventory.bump_versions(data, transaction)
+                merged.append(transaction)
+            for site_name, category, item_name, item in record['items']:
+                remote[(site_name, category, item_name)] = item
+                _set_item(data, (site_name, category, item_name), item)
+            self.seq = max(self.seq, record['last_seq'])
+        data['system_info']['last_seq'] = max(ledger.last_seq(data), self.seq)
+        remote_ids = {t['request_id'] for t in merged if t.get('request_id')}
+        kept, rejected = _merge_pending(data, pending, local, remote, remote_ids)
+        self.rejected.extend(rejected)
+        for transaction in kept:
+            ledger.reappend_transaction(data, transaction)
+        return merged, bool(rejected)
+
+    def _catch_up(self, data, reload=True):
+        position = self.number, self.offset
+        records = self._read_records()
+        if records is not None:
+            records = [r for r in records if r['origin'] != self.origin]
+        if records is None or any(r.get('reset') for r in records):
+            if not reload:
+                self.number, self.offset = position
+                raise StaleDataError("The data was replaced by another session or process; reload and try again")
+            self._reload(data)
+            return [], True
+        return self._apply(data, records) if records else ([], False)
+
+    def poll(self, data):
+        """Apply other replicas' changes to data.
+
+        Returns (their transactions, reset); reset means data was reloaded
+        from disk, or local transactions were rejected, and anything derived
+        from it must be rebuilt.
+        """
+        records = self._read_records()
+        if records is not None:
+            records = [r for r in records if r['origin'] != self.origin]
+            if not records:
+                return [], False
+            if not any(r.get('reset') for r in records):
+                return self._apply(data, records)
+        with self._locked(exclusive=False):
+            self._reload(data)
+        return [], True
+
+    def save(self, data, sites=None, rewrite=False):
+        """Merge other replicas' changes, save data and publish the change.
+
+        With sites only those shards are written and the transactions since
+        the last publish go to the feed; returns what poll() returns.  A full
+        save (sites=None) writes the index and the shards of new sites, or
+        every shard with rewrite, and overwrites every replica's data.  It
+        merges unread changes first and raises StaleDataError when the data
+        was replaced meanwhile; change the data under begin() to rule that out.
+        """
+        with self._locked():
+            if sites is None:
+                changes = self._catch_up(data, reload=False)
+                if rewrite:
+                    storage.save_data(data, data_dir=self.data_dir)
+                else:
+                    storage.save_index(data, data_dir=self.data_dir)
+                record = {'origin': self.origin, 'reset': True}
+            else:
+                changes = self._catch_up(data)
+                pending = ledger.transactions_after(data['transactions'], self.seq)
+                storage.save_sites(data, sites, pending, data_dir=self.data_dir)
+                record = None
+                if pending:
+                    record = {
+                        'origin': self.origin,
+                        'transactions': pending,
+                        'items': [[*key, item] for key, item in _item_states(data, pending).items()],
+                    }
+            if record is not None:
+                record['last_seq'] = ledger.last_seq(data)
+                self._append(record)
+            self.seq = ledger.last_seq(data)
+            return changes
+
+    def _append(self, record):
+        os.makedirs(self.feed_dir, exist_ok=True)
+        if self.offset >= MAX_FILE_BYTES:
+            self.number += 1
+            self.offset = 0
+        line = (json.dumps(record, default=str, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self._path(self.number), 'ab') as f:
+            f.write(line)
+        self.offset += len(line)
+        for number in self._numbers():
+            if number <= self.number - KEEP_FILES:
+                try:
+                    os.remove(self._path(number))
+                except OSError:
+                    pass
@@ -0,0 +1,313 @@
+"""Inventory operations shared by the Streamlit app and the local API.
+
+Each operation validates its input, mutates the data dict in place, appends
+the matching transaction through ledger.append_transaction() and returns it.
+Invalid requests raise InventoryError and leave the data untouched.
+
+Every site carries a ``version`` counter that each operation bumps for the
+sites it changed, so views can cache what they derive from a site's items
+until its version moves.  Adding or removing a site bumps the data's
+``generation`` and a new site is stamped with it, so a site removed and
+added again under the same name never repeats an earlier (generation,
+version) pair.  Operations also keep each item's running cost (see
+valuation).
+"""
+import math
+
+import ledger
+import valuation
+from storage import CATEGORIES
+
+
+class InventoryError(Exception):
+    """Raised when an inventory operation cannot be applied."""
+
+
+def _site(data, site_name):
+    try:
+        return data['sites'][site_name]
+    except KeyError:
+        raise InventoryError(f"Unknown site '{site_name}'") from None
+
+
+def _category(site_info, category):
+    if category not in CATEGORIES:
+        raise InventoryError(f"Unknown category '{category}'")
+    return site_info.setdefault(category, {})
+
+
+def _item(data, site_name, category, item_name):
+    items = _category(_site(data, site_name), category)
+    try:
+        return items[item_name]
+    except KeyError:
+        raise InventoryError(f"Item '{item_name}' not found in {category} at '{site_name}'") from None
+
+
+def _number(value):
+    """Whether value is a finite int or float (JSON may carry NaN and Infinity)"""
+    return not isinstance(value, bool) and isinstance(value, (int, float)) and math.isfinite(value)
+
+
+def _quantity(quantity, allow_zero=False):
+    if not _number(quantity):
+        raise InventoryError(f"Invalid quantity {quantity!r}")
+    if quantity < 0 or (quantity == 0 and not allow_zero):
+        raise InventoryError(f"Quantity must be {'zero or ' if allow_zero else ''}positive")
+    return quantity
+
+
+def touched_sites(transaction):
+    """Sites whose inventory a transaction changed"""
+    if transaction.get('type') == 'transfer':
+        return [transaction['from_site'], transaction['to_site']]
+    return [transaction['site']]
+
+
+def site_version(site_info):
+    return site_info.get('version', 0)
+
+
+def site_generation(site_info):
+    """Generation of the data when the site was added"""
+    return site_info.get('generation', 0)
+
+
+def site_key(site_info):
+    """Changes whenever the site's items change or the site is recreated"""
+    return site_generation(site_info), site_version(site_info)
+
+
+def data_version(data):
+    """Changes whenever any site's items change or a site is added or removed"""
+    return (data['system_info'].get('generation', 0),) + tuple(
+        (site_name, site_version(site_info)) for site_name, site_info in data['sites'].items())
+
+
+def _next_generation(data):
+    system_info = data['system_info']
+    system_info['generation'] = system_info.get('generation', 0) + 1
+    return system_info['generation']
+
+
+def add_site(data, site_name, site_info):
+    """Add a site with empty categories; returns its entry"""
+    if site_name in data['sites']:
+        raise InventoryError(f"Site '{site_name}' already exists")
+    entry = {**site_info, 'generation': _next_generation(data)}
+    for category in CATEGORIES:
+        entry.setdefault(category, {})
+    data['sites'][site_name] = entry
+    data['system_info']['total_sites'] = len(data['sites'])
+    return entry
+
+
+def remove_site(data, site_name):
+    """Remove a site and everything in it; returns its entry or None"""
+    entry = data['sites'].pop(site_name, None)
+    if entry is not None:
+        _next_generation(data)
+        data['system_info']['total_sites'] = len(data['sites'])
+    return entry
+
+
+def bump_versions(data, transaction):
+    """Bump the version of the sites a transaction changed"""
+    for site_name in touched_sites(transaction):
+        site_info = data['sites'].get(site_name)
+        if site_info is not None:
+            site_info['version'] = site_version(site_info) + 1
+
+
+def _record(data, transaction):
+    """Append the transaction and bump the version of the sites it changed"""
+    record = ledger.append_transaction(data, transaction)
+    bump_versions(data, record)
+    return record
+
+
+def receive(data, site_name, category, item_name, quantity, received_by,
+            supplier='', new_item=None, request_id=None,
+            invoice_number='', purchase_date=None, rate=None, notes=''):
+    """Add stock to an item.
+
+    new_item is a dict with unit/min_stock/rate/code; when given the item is
+    (re)created with quantity as its stock, otherwise it must already exist.
+    rate is the purchase rate of this receipt and defaults to the item's rate.
+    """
+    quantity = _quantity(quantity, allow_zero=True)
+    if not item_name or not received_by:
+        raise InventoryError("Item name and receiver are required")
+    for value in (rate, (new_item or {}).get('rate')):
+        if value is not None and (not _number(value) or value < 0):
+            raise InventoryError(f"Invalid rate {value!r}")
+    items = _category(_site(data, site_name), category)
+
+    if new_item is not None:
+        if not new_item.get('unit'):
+            raise InventoryError("Unit is required for a new item")
+        if rate is None:
+            rate = new_item.get('rate', 0.0)
+        items[item_name] = {
+            'stock': 0,
+            'used': 0,
+            'unit': new_item['unit'],
+            'min_stock': new_item.get('min_stock', 0),
+            'category': category,
+            'rate': new_item.get('rate', 0.0),
+            'code': new_item.get('code') or 'N/A',
+            'value': 0.0
+        }
+        item = items[item_name]
+    else:
+        item = _item(data, site_name, category, item_name)
+        if rate is None:
+            rate = item.get('rate', 0.0)
+    value = valuation.receipt(item, quantity, rate)
+    item['stock'] += quantity
+
+    transaction = {
+        'type': 'added',
+        'site': site_name,
+        'category': category,
+        'item': item_name,
+        'quantity': quantity,
+        'new_item': new_item is not None,
+        'supplier': supplier,
+        'received_by': received_by,
+        'invoice_number': invoice_number,
+        'purchase_date': str(purchase_date) if purchase_date else '',
+        'rate': rate,
+        'value': value,
+        'notes': notes
+    }
+    if request_id:
+        transaction['request_id'] = request_id
+    return _record(data, transaction)
+
+
+def consume(data, site_name, category, item_name, quantity, work_area, supervisor,
+            purpose='Construction', request_id=None):
+    """Record usage of an item at a site"""
+    quantity = _quantity(quantity)
+    if not work_area or not supervisor:
+        raise InventoryError("Work area and supervisor are required")
+    item = _item(data, site_name, category, item_name)
+    if quantity > item['stock']:
+        raise InventoryError(f"Insufficient stock for '{item_name}' at '{site_name}': "
+                             f"{item['stock']} {item['unit']} available, {quantity} requested")
+
+    value = valuation.issue(item, quantity)
+    item['stock'] -= quantity
+    item['used'] += quantity
+
+    transaction = {
+        'type': 'used',
+        'site': site_name,
+        'category': category,
+        'item': item_name,
+        'quantity': quantity,
+        'value': value,
+        'work_area': work_area,
+        'supervisor': supervisor,
+        'purpose': purpose
+    }
+    if request_id:
+        transaction['request_id'] = request_id
+    return _record(data, transaction)
+
+
+def transfer(data, from_site, to_site, category, item_name, quantity, authorized_by, driver_name,
+             vehicle_number='', request_id=None):
+    """Move stock of an item from one site to another"""
+    quantity = _quantity(quantity)
+    if from_site == to_site:
+        raise InventoryError("Source and destination sites must differ")
+    if not authorized_by or not driver_name:
+        raise InventoryError("Authorizer and driver are required")
+    item = _item(data, from_site, category, item_name)
+    to_items = _category(_site(data, to_site), category)
+    if quantity > item['stock']:
+        raise InventoryError(f"Insufficient stock for '{item_name}' at '{from_site}': "
+                             f"{item['stock']} {item['unit']} available, {quantity} requested")
+
+    item_data = item.copy()
+    value = valuation.issue(item, quantity)
+    item['stock'] -= quantity
+
+    # The stock arrives at the cost it left with
+    created = item_name not in to_items
+    if not created:
+        to_items[item_name]['value'] = valuation.item_value(to_items[item_name]) + value
+        to_items[item_name]['stock'] += quantity
+    else:
+        to_items[item_name] = item_data
+        to_items[item_name]['stock'] = quantity
+        to_items[item_name]['used'] = 0
+        to_items[item_name]['value'] = value
+
+    transaction = {
+        'type': 'transfer',
+        'from_site': from_site,
+        'to_site': to_site,
+        'category': category,
+        'item': item_name,
+        'quantity': quantity,
+        'value': value,
+        'authorized_by': authorized_by,
+        'driver_name': driver_name,
+        'vehicle_number': vehicle_number
+    }
+    if created:
+        transaction['new_item'] = True
+    if request_id:
+        transaction['request_id'] = request_id
+    return _record(data, transaction)
+
+
+def edit_item(data, site_name, category, item_name, stock, used, unit, rate, min_stock, code, notes=''):
+    """Overwrite an item's details"""
+    item = _item(data, site_name, category, item_name)
+    old_stock = item['stock']
+    old_used = item.get('used', 0)
+    old_value = valuation.item_value(item)
+    value = valuation.revalue(item, stock, rate)
+
+    item['stock'] = stock
+    item['used'] = used
+    item['unit'] = unit
+    item['rate'] = rate
+    item['min_stock'] = min_stock
+    item['code'] = code
+    item['value'] = value
+
+    transaction = {
+        'type': 'edited',
+        'site': site_name,
+        'category': category,
+        'item': item_name,
+        'old_stock': old_stock,
+        'new_stock': stock,
+        'old_used': old_used,
+        'new_used': used,
+        'old_value': old_value,
+        'new_value': value,
+        'notes': notes
+    }
+    return _record(data, transaction)
+
+
+def delete_item(data, site_name, category, item_name):
+    """Remove an item from a site"""
+    item = _item(data, site_name, category, item_name)
+    del data['sites'][site_name][category][item_name]
+
+    transaction = {
+        'type': 'deleted',
+        'site': site_name,
+        'category': category,
+        'item': item_name,
+        'deleted_stock': item['stock'],
+        'deleted_value': valuation.item_value(item)
+    }
+    return _record(data, transaction)
@@ -0,0 +1,84 @@
+"""Hash index from item code to the items carrying it.
+
+CodeIndex maps every item ``code`` to the set of (site, category, item) keys
+with that code, so a scanned or typed code resolves in constant time.  Like
+the alert engine it is built once and then kept current by re-indexing only
+the items touched by each transaction (add, edit, delete, transfer).
+
+The same item at several sites shares its code, which is expected.  A code
+used by more than one distinct (category, item) is a duplicate.
+"""
+import collections
+
+import alerts
+from storage import CATEGORIES
+
+
+NO_CODE = {'', 'N/A', None}
+
+
+def normalize_code(code):
+    """Codes are matched case-insensitively and without surrounding spaces"""
+    if code is None:
+        return None
+    code = str(code).strip().upper()
+    return None if code in NO_CODE else code
+
+
+class CodeIndex:
+    """Item code -> {(site, category, item)} for one data dict"""
+
+    def __init__(self, data):
+        self.data = data
+        self._by_code = collections.defaultdict(set)
+        self._code_of = {}
+        self.rebuild()
+
+    def rebuild(self):
+        self._by_code.clear()
+        self._code_of.clear()
+        for site_name, site_info in self.data['sites'].items():
+            for category in CATEGORIES:
+                for item_name in site_info.get(category, {}):
+                    self._reindex((site_name, category, item_name))
+
+    def on_transaction(self, transaction):
+        for key in alerts.touched_items(transaction):
+            self._reindex(key)
+
+    def forget_site(self, site_name):
+        for key in [k for k in self._code_of if k[0] == site_name]:
+            self._unlink(key)
+
+    def lookup(self, code):
+        """Keys of the items with this code, sorted by site"""
+        return sorted(self._by_code.get(normalize_code(code), ()))
+
+    def conflicts(self, code, category, item_name):
+        """Other items already using code, if it were given to (category, item_name)"""
+        return [k for k in self.lookup(code) if (k[1], k[2]) != (category, item_name)]
+
+    def duplicates(self):
+        """Codes shared by more than one distinct item, with their keys"""
+        return {code: sorted(keys) for code, keys in self._by_code.items()
+                if len({(k[1], k[2]) for k in keys}) > 1}
+
+    def __len__(self):
+        return len(self._by_code)
+
+    def _unlink(self, key):
+        code = self._code_of.pop(key, None)
+        if code is not None:
+            keys = self._by_code[code]
+            keys.discard(key)
+            if not keys:
+                del self._by_code[code]
+
+    def _reindex(self, key):
+        self._unlink(key)
+        site_name, category, item_name = key
+        item = self.data['sites'].get(site_name, {}).get(category, {}).get(item_name)
+        code = normalize_code(item.get('code')) if item else None
+        if code is not None:
+            self._code_of[key] = code
+            self._by_code[code].add(key)
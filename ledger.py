@@ -0,0 +1,124 @@
+"""Transaction log helpers.
+
+Every transaction appended through append_transaction() gets a monotonic
+sequence number ``seq`` and an epoch timestamp ``ts``.  The log in
+``multi_site_data['transactions']`` is therefore always ordered by both, so
+history views can read it newest-first without sorting, clients can page
+with a cursor ("transactions after seq N") and time ranges are found with a
+binary search.
+
+Seqs are unique across sessions and processes when transactions are
+appended under the change feed's write lock (change_feed.ChangeFeed.begin):
+the data is then caught up with every published transaction, so last_seq
+is the shared counter and the lock keeps anyone else from taking the same
+numbers before they are published.
+"""
+import bisect
+import datetime
+import time
+
+
+def _seq(transaction):
+    return transaction['seq']
+
+
+def _ts(transaction):
+    return transaction['ts']
+
+
+def last_seq(data):
+    return data['system_info'].get('last_seq', 0)
+
+
+def append_transaction(data, transaction):
+    """Stamp a transaction with seq/ts/date, append it to the log and return it"""
+    log = data['transactions']
+    system_info = data['system_info']
+
+    seq = last_seq(data) + 1
+    ts = time.time()
+    if log:
+        ts = max(ts, log[-1]['ts'])
+
+    record = {'seq': seq, 'date': str(datetime.datetime.fromtimestamp(ts)), 'ts': ts}
+    record.update(transaction)
+    log.append(record)
+    system_info['last_seq'] = seq
+    return record
+
+
+def reappend_transaction(data, transaction):
+    """Move a recorded transaction to the end of the log with a fresh seq.
+
+    Used when transactions of another replica were merged in before it; ts
+    only moves forward so the log stays ordered by both.
+    """
+    log = data['transactions']
+    if log and log[-1]['ts'] > transaction['ts']:
+        transaction['ts'] = log[-1]['ts']
+        transaction['date'] = str(datetime.datetime.fromtimestamp(transaction['ts']))
+    transaction['seq'] = last_seq(data) + 1
+    log.append(transaction)
+    data['system_info']['last_seq'] = transaction['seq']
+    return transaction
+
+
+def _parse_ts(date):
+    try:
+        return datetime.datetime.fromisoformat(str(date)).timestamp()
+    except ValueError:
+        return None
+
+
+def ensure_sequence(data):
+    """Order the log by seq, backfilling seq/ts on records that predate them.
+
+    Legacy records have neither field; when any are found the whole log is
+    ordered by its ``date`` strings and renumbered from 1.  Returns True when
+    records were backfilled so the caller can persist the migration.
+    """
+    log = data['transactions']
+    system_info = data.setdefault('system_info', {})
+
+    if all('seq' in t and 'ts' in t for t in log):
+        log.sort(key=_seq)
+        system_info['last_seq'] = max(system_info.get('last_seq', 0), log[-1]['seq'] if log else 0)
+        return False
+
+    log.sort(key=lambda t: str(t.get('date', '')))
+    previous_ts = 0.0
+    for seq, transaction in enumerate(log, start=1):
+        ts = _parse_ts(transaction.get('date'))
+        ts = previous_ts if ts is None else max(ts, previous_ts)
+        transaction['seq'] = seq
+        transaction['ts'] = ts
+        previous_ts = ts
+    system_info['last_seq'] = len(log)
+    return True
+
+
+def transactions_after(log, seq, limit=None):
+    """Transactions with a sequence number greater than seq, oldest first"""
+    start = bisect.bisect_right(log, seq, key=_seq)
+    end = None if limit is None else start + limit
+    return log[start:end]
+
+
+def transactions_between(log, start_ts, end_ts):
+    """Transactions with start_ts <= ts < end_ts, oldest first"""
+    lo = bisect.bisect_left(log, start_ts, key=_ts)
+    hi = bisect.bisect_left(log, end_ts, lo=lo, key=_ts)
+    return log[lo:hi]
+
+
+def find_transaction(log, seq):
+    """Return the transaction with the given seq, or None"""
+    i = bisect.bisect_left(log, seq, key=_seq)
+    if i < len(log) and log[i]['seq'] == seq:
+        return log[i]
+    return None
+
+
+def format_time(transaction):
+    """Display timestamp for a transaction"""
+    return datetime.datetime.fromtimestamp(transaction['ts']).strftime('%Y-%m-%d %H:%M:%S')
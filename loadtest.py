@@ -0,0 +1,406 @@
+"""Concurrent-session load test for the Streamlit app.
+
+Drives the app headlessly with Streamlit's AppTest, one simulated user
+session per thread, all in one process as on a real server::
+
+    python loadtest.py [--sessions 8] [--duration 30] [--mix view=6,use=3,transfer=1]
+                       [--data-dir multi_site_data] [--workdir DIR] [--seed 1]
+
+Each session loops over a random mix of actions:
+
+* ``view``     - open the dashboard, a site inventory, All Sites View or the
+  stock matrix
+* ``use``      - record usage of 1 unit of a random item at a random site
+* ``transfer`` - transfer 1 unit of a random item between two random sites
+
+The data directory is copied into a scratch work directory first, so the
+real data is never touched; the app is pointed at it through the
+MATERIALS_APP_DIR environment variable.  Every write is tagged (work area or driver
+name) so that, once the run is over, the saved data can be checked for
+writes that sessions reported as successful but that are missing on disk
+(lost updates).  Snapshot writes are timed to report file-write contention:
+writes of the same file that overlapped in time, and failed writes.
+"""
+import argparse
+import collections
+import contextlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import storage
+
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "multi_site_material_management_fixed.py")
+APP_DIR_ENV = "MATERIALS_APP_DIR"
+DEFAULT_MIX = {'view': 6, 'use': 3, 'transfer': 1}
+VIEW_PAGES = ["🏠 Multi-Site Dashboard", "📦 Site Inventory", "🌐 All Sites View", "🧮 Stock Matrix"]
+TIMEOUT = 60
+
+
+class WriteMonitor:
+    """Times every snapshot write made through storage.write_snapshot"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = []
+        self.failures = []
+        self._original = None
+
+    def install(self):
+        self._original = storage.write_snapshot
+
+        def write_snapshot(data, path, fmt):
+            started = time.perf_counter()
+            try:
+                self._original(data, path, fmt)
+            except Exception as e:
+                with self._lock:
+                    self.failures.append((path, repr(e)))
+                raise
+            finally:
+                with self._lock:
+                    self.writes.append((path, started, time.perf_counter()))
+
+        storage.write_snapshot = write_snapshot
+
+    def uninstall(self):
+        if self._original is not None:
+            storage.write_snapshot = self._original
+
+    def overlapping(self):
+        """Number of writes that started while another write of the same file was running"""
+        by_path = collections.defaultdict(list)
+        for path, started, ended in self.writes:
+            by_path[path].append((started, ended))
+        count = 0
+        for intervals in by_path.values():
+            intervals.sort()
+            running_until = float('-inf')
+            for started, ended in intervals:
+                if started < running_until:
+                    count += 1
+                running_until = max(running_until, ended)
+        return count
+
+
+@contextlib.contextmanager
+def _concurrent_apptests():
+    """Let AppTest sessions run side by side in threads, as a real server does.
+
+    AppTest gives every run its own script cache, so concurrent sessions
+    would compile the script in parallel, which the parser does not support;
+    the app is compiled once instead.  Each run also installs a mock runtime
+    and clears it when done, under the other sessions' feet; the last one
+    installed stays visible while any session is running.  Streamlit is
+    restored on exit.
+    """
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    original_get_bytecode = ScriptCache.__dict__['get_bytecode']
+    original_instance = Runtime.__dict__['instance']
+    compiled = {}
+    lock = threading.Lock()
+    last_runtime = []
+
+    def get_bytecode(self, script_path):
+        with lock:
+            if script_path not in compiled:
+                compiled[script_path] = original_get_bytecode(self, script_path)
+            return compiled[script_path]
+
+    def instance(cls):
+        if cls._instance is not None:
+            last_runtime[:] = [cls._instance]
+            return cls._instance
+        if last_runtime:
+            return last_runtime[0]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    ScriptCache.get_bytecode = get_bytecode
+    Runtime.instance = classmethod(instance)
+    try:
+        yield
+    finally:
+        ScriptCache.get_bytecode = original_get_bytecode
+        Runtime.instance = original_instance
+
+
+class Session:
+    """One simulated user driving an AppTest instance"""
+
+    def __init__(self, number, mix, rng, deadline):
+        self.number = number
+        self.mix = mix
+        self.rng = rng
+        self.deadline = deadline
+        self.results = []
+        self.tags = []
+        self.at = None
+        self._count = 0
+
+    def _page(self, page, site=""):
+        sidebar = self.at.sidebar.selectbox
+        if site:
+            sidebar[0].set_value(site)
+        sidebar[1].set_value(page)
+        self.at.run(timeout=TIMEOUT)
+
+    def _widget(self, elements, label):
+        for element in elements:
+            if element.label.startswith(label):
+                return element
+        return None
+
+    def _pick(self, label):
+        box = self._widget(self.at.selectbox, label)
+        options = [o for o in box.options if o] if box is not None else []
+        if not options:
+            return None
+        value = self.rng.choice(options)
+        box.set_value(value)
+        self.at.run(timeout=TIMEOUT)
+        return value
+
+    def _succeeded(self):
+        return (any('<div class="success-box">' in m.value for m in self.at.markdown)
+                and not self.at.error and not self.at.exception)
+
+    def _sites(self):
+        return [s for s in self.at.sidebar.selectbox[0].options if s]
+
+    def view(self):
+        page = self.rng.choice(VIEW_PAGES)
+        sites = self._sites()
+        self._page(page, self.rng.choice(sites) if sites else "")
+        return not self.at.exception
+
+    def use(self):
+        sites = self._sites()
+        if not sites:
+            return None
+        self._page("➖ Use Items", self.rng.choice(sites))
+        self._pick("Category")
+        if self._pick("Select Item") is None:
+            return None
+        work_area = self._widget(self.at.text_input, "Work Area")
+        if work_area is None:
+            return None
+        tag = f"load-{self.number}-{self._count}"
+        work_area.set_value(tag)
+        self._widget(self.at.button, "➖ Record Usage").click()
+        self.at.run(timeout=TIMEOUT)
+        ok = self._succeeded()
+        if ok:
+            self.tags.append(('used', tag))
+        return ok
+
+    def transfer(self):
+        sites = self._sites()
+        if len(sites) < 2:
+            return None
+        self._page("🔄 Transfer Items")
+        self._pick("From Site")
+        self._pick("Category")
+        if self._pick("Select Item") is None:
+            return None
+        self._pick("To Site")
+        driver = self._widget(self.at.text_input, "Driver")
+        if driver is None:
+            return None
+        tag = f"load-{self.number}-{self._count}"
+        driver.set_value(tag)
+        self._widget(self.at.button, "🔄 Execute Transfer").click()
+        self.at.run(timeout=TIMEOUT)
+        ok = self._succeeded()
+        if ok:
+            self.tags.append(('transfer', tag))
+        return ok
+
+    def _start(self):
+        """Open a new session, as a browser tab would"""
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(APP_FILE, default_timeout=TIMEOUT)
+        started = time.perf_counter()
+        self.at.run()
+        error = self.at.exception[0].value if self.at.exception else None
+        self.results.append(('start', time.perf_counter() - started, error is None, error))
+
+    def run(self):
+        self._start()
+        actions = list(self.mix)
+        weights = [self.mix[a] for a in actions]
+        broken = False
+        while time.perf_counter() < self.deadline:
+            if broken or self.at.exception:
+                self._start()
+                broken = False
+                continue
+            action = self.rng.choices(actions, weights)[0]
+            self._count += 1
+            started = time.perf_counter()
+            error = None
+            try:
+                ok = getattr(self, action)()
+            except Exception as e:
+                ok, error, broken = False, repr(e), True
+            if self.at.exception:
+                ok, error = False, self.at.exception[0].value
+            if ok is not None:
+                self.results.append((action, time.perf_counter() - started, ok, error))
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def _lost_updates(sessions, data):
+    """Tags reported as written by sessions but missing from the saved data"""
+    saved = set()
+    for t in (data or {}).get('transactions', []):
+        if t.get('type') == 'used':
+            saved.add(('used', t.get('work_area')))
+        elif t.get('type') == 'transfer':
+            saved.add(('transfer', t.get('driver_name')))
+    reported = [tag for session in sessions for tag in session.tags]
+    return [tag for tag in reported if tag not in saved]
+
+
+def _prepare_workdir(workdir, data_dir):
+    if os.path.isdir(data_dir):
+        shutil.copytree(data_dir, os.path.join(workdir, storage.DATA_DIR))
+    else:
+        for ext in storage.FORMATS.values():
+            legacy = storage.DATA_FILE + ext
+            if os.path.exists(legacy):
+                shutil.copy(legacy, os.path.join(workdir, legacy))
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        action, _, weight = part.partition('=')
+        if action not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown action '{action}'")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def run(sessions=8, duration=30.0, mix=None, data_dir=storage.DATA_DIR, workdir=None, seed=1):
+    """Run the load test and return its report as a dict"""
+    mix = mix or DEFAULT_MIX
+    workdir = workdir or tempfile.mkdtemp(prefix="loadtest-")
+    data_dir = os.path.abspath(data_dir)
+    _prepare_workdir(workdir, data_dir)
+
+    # The app keeps its files under the work directory; its background
+    # threads get absolute paths, so the process's cwd is left alone.
+    previous_app_dir = os.environ.get(APP_DIR_ENV)
+    os.environ[APP_DIR_ENV] = os.path.abspath(workdir)
+    monitor = WriteMonitor()
+    monitor.install()
+    try:
+        with _concurrent_apptests():
+            deadline = time.perf_counter() + duration
+            simulated = [Session(n, mix, random.Random(seed * 1000 + n), deadline) for n in range(sessions)]
+            threads = [threading.Thread(target=s.run, name=f"session-{s.number}") for s in simulated]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        saved = storage.load_data(os.path.join(workdir, storage.DATA_DIR), os.path.join(workdir, storage.DATA_FILE))
+    finally:
+        monitor.uninstall()
+        if previous_app_dir is None:
+            os.environ.pop(APP_DIR_ENV, None)
+        else:
+            os.environ[APP_DIR_ENV] = previous_app_dir
+
+    by_action = collections.defaultdict(list)
+    errors = collections.Counter()
+    for session in simulated:
+        for action, latency, ok, error in session.results:
+            by_action[action].append((latency, ok))
+            if error:
+                errors[error] += 1
+
+    actions = {}
+    for action, samples in by_action.items():
+        latencies = [latency for latency, _ in samples]
+        actions[action] = {
+            'count': len(samples),
+            'failed': sum(1 for _, ok in samples if not ok),
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': max(latencies),
+        }
+
+    completed = sum(stats['count'] for action, stats in actions.items() if action != 'start')
+    writes_ok = sum(stats['count'] - stats['failed'] for action, stats in actions.items()
+                    if action in ('use', 'transfer'))
+    write_times = [ended - began for _, began, ended in monitor.writes]
+    return {
+        'workdir': workdir,
+        'sessions': sessions,
+        'elapsed': elapsed,
+        'throughput': completed / elapsed if elapsed else 0.0,
+        'write_throughput': writes_ok / elapsed if elapsed else 0.0,
+        'actions': actions,
+        'errors': dict(errors),
+        'lost_updates': _lost_updates(simulated, saved),
+        'file_writes': len(monitor.writes),
+        'file_write_p95': _percentile(write_times, 95),
+        'file_write_overlaps': monitor.overlapping(),
+        'file_write_failures': monitor.failures,
+    }
+
+
+def print_report(report):
+    print(f"Sessions: {report['sessions']}, elapsed {report['elapsed']:.1f}s, work dir {report['workdir']}")
+    print(f"Throughput: {report['throughput']:.2f} actions/s, {report['write_throughput']:.2f} writes/s")
+    print()
+    print(f"{'action':<10}{'count':>7}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for action, stats in sorted(report['actions'].items()):
+        print(f"{action:<10}{stats['count']:>7}{stats['failed']:>8}"
+              + "".join(f"{stats[k] * 1000:>10.0f}" for k in ('p50', 'p95', 'p99', 'max')))
+    print()
+    print(f"Lost updates: {len(report['lost_updates'])}")
+    print(f"File writes: {report['file_writes']}, p95 {report['file_write_p95'] * 1000:.1f} ms, "
+          f"overlapping writes of the same file: {report['file_write_overlaps']}, "
+          f"failed: {len(report['file_write_failures'])}")
+    for path, error in report['file_write_failures'][:5]:
+        print(f"  {path}: {error}")
+    for error, count in report['errors'].items():
+        print(f"Error x{count}: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent simulated sessions")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--mix", type=_parse_mix, default=DEFAULT_MIX,
+                        help="action weights, e.g. view=6,use=3,transfer=1")
+    parser.add_argument("--data-dir", default=storage.DATA_DIR, help="data to copy into the work directory")
+    parser.add_argument("--workdir", help="scratch directory (default: a new temporary directory)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    report = run(args.sessions, args.duration, args.mix, args.data_dir, args.workdir, args.seed)
+    print_report(report)
+    return 1 if report['lost_updates'] or report['file_write_failures'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
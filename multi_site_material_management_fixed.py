@@ -3,8 +3,37 @@ import json
 import datetime
 import pandas as pd
 import plotly.express as px
-import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import contextlib
 import io
+import itertools
+import os
+
+import alerts
+import backup
+import change_feed
+import inventory
+import item_index
+import ledger
+import procurement
+import read_replica
+import reconcile
+import render_cache
+import reports
+import stock_matrix
+import storage
+import sync
+import valuation
+
+
+# Every file the app keeps lives under APP_DIR: the working directory, or
+# MATERIALS_APP_DIR when set (loadtest.py points it at a scratch copy).
+APP_DIR = os.path.abspath(os.environ.get("MATERIALS_APP_DIR", "."))
+DATA_DIR = os.path.join(APP_DIR, storage.DATA_DIR)
+REPORT_DIR = os.path.join(APP_DIR, reports.REPORT_DIR)
+SNAPSHOT_DIR = os.path.join(APP_DIR, read_replica.SNAPSHOT_DIR)
+BACKUP_DIR = os.path.join(APP_DIR, backup.BACKUP_DIR)
 
 
 # Page configuration
@@ -87,10 +116,13 @@ st.markdown("""
 
 
 # Initialize session state
+if 'change_feed' not in st.session_state:
+    st.session_state.change_feed = change_feed.ChangeFeed(DATA_DIR)
+
 if 'multi_site_data' not in st.session_state:
-    if os.path.exists("multi_site_materials.json"):
-        with open("multi_site_materials.json", "r", encoding="utf-8") as f:
-            st.session_state.multi_site_data = json.load(f)
+    loaded_data = st.session_state.change_feed.load(os.path.join(APP_DIR, storage.DATA_FILE))
+    if loaded_data is not None:
+        st.session_state.multi_site_data = loaded_data
     else:
         st.session_state.multi_site_data = {
             "sites": {
@@ -140,15 +172,150 @@ if 'multi_site_data' not in st.session_state:
         }
 
 
-def save_data():
-    """Save data to JSON file"""
-    try:
-        with open("multi_site_materials.json", 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.multi_site_data, f, indent=2, default=str, ensure_ascii=False)
+if 'alert_engine' not in st.session_state:
+    st.session_state.alert_engine = alerts.AlertEngine(st.session_state.multi_site_data)
+
+if 'code_index' not in st.session_state:
+    st.session_state.code_index = item_index.CodeIndex(st.session_state.multi_site_data)
+
+if 'spend_rollup' not in st.session_state:
+    st.session_state.spend_rollup = procurement.SpendRollup(st.session_state.multi_site_data,
+                                                            st.session_state.change_feed.data_dir)
+
+if 'render_cache' not in st.session_state:
+    st.session_state.render_cache = render_cache.RenderCache()
+
+alerts.start_notifier(os.path.join(APP_DIR, alerts.OUTBOX_FILE))
+report_scheduler = reports.start_scheduler(DATA_DIR, REPORT_DIR)
+snapshot_publisher = read_replica.start_publisher(DATA_DIR, SNAPSHOT_DIR)
+
+
+def track_transaction(transaction, notify=True):
+    """Update alerts, the item code index and spend rollup for a transaction just applied"""
+    st.session_state.alert_engine.on_transaction(transaction, notify)
+    st.session_state.code_index.on_transaction(transaction)
+    st.session_state.spend_rollup.on_transaction(transaction)
+
+
+def apply_changes(transactions, reset):
+    """Bring alerts, indexes and caches up to date with other replicas' changes.
+
+    Returns True when anything changed.
+    """
+    feed = st.session_state.change_feed
+    rejected, feed.rejected = feed.rejected, []
+    if rejected:
+        st.warning(f"⚠️ {len(rejected)} unsaved change(s) were discarded: another session deleted the item "
+                   "or had already recorded them")
+    if reset:
+        st.session_state.alert_engine.rebuild()
+        st.session_state.code_index.rebuild()
+        st.session_state.spend_rollup.rebuild()
+        st.session_state.render_cache.clear()
         return True
+    for transaction in transactions:
+        track_transaction(transaction, notify=False)
+    return bool(transactions)
+
+
+def poll_changes():
+    """Apply what other sessions and server processes saved since the last poll"""
+    try:
+        return apply_changes(*st.session_state.change_feed.poll(st.session_state.multi_site_data))
+    except Exception as e:
+        st.error(f"Error reading changes from other sessions: {e}")
+        return False
+
+
+@st.fragment(run_every=change_feed.POLL_INTERVAL)
+def watch_changes():
+    """Rerun the page when another session or process changed the data.
+
+    Full runs poll at the top of main(); polling again while one is running
+    could rerun it and drop a button click, so only the timed reruns of this
+    fragment poll here.
+    """
+    if st.session_state.get('watched_run') != st.session_state.run_count:
+        st.session_state.watched_run = st.session_state.run_count
+        return
+    if poll_changes():
+        st.rerun()
+
+
+def show_item_alerts(site_name, category, item_name):
+    """Show the active alerts of one item as warnings"""
+    for alert in st.session_state.alert_engine.item_alerts(site_name, category, item_name):
+        st.warning(f"{alerts.RULE_LABELS[alert['rule']]} - {item_name.replace('_', ' ').title()} at {site_name}: {alert['message']}")
+
+
+def code_conflict_message(code, category, item_name):
+    """Error text when code is already used by a different item, else None"""
+    conflicts = st.session_state.code_index.conflicts(code, category, item_name)
+    if not conflicts:
+        return None
+    used_by = ", ".join(f"{item.replace('_', ' ').title()} ({site})" for site, _, item in conflicts[:3])
+    return f"❌ Item code '{code}' is already used by {used_by}"
+
+
+def save_data(*sites, rewrite=False):
+    """Save data using the configured storage format.
+
+    Pass the affected site names to rewrite only their shards; with no
+    arguments the site index and the shards of new sites are written, and
+    with rewrite every shard.  Changes saved
+    by other sessions meanwhile are merged in first.  The spend rollup
+    of the changed sites is saved with them.  A backup is
+    taken when the last one is older than backup.INTERVAL; the sites'
+    reports and the analytics snapshot are rebuilt in the background.
+    """
+    try:
+        changes = st.session_state.change_feed.save(st.session_state.multi_site_data, sites or None, rewrite)
     except Exception as e:
         st.error(f"Error saving data: {e}")
         return False
+    apply_changes(*changes)
+    try:
+        st.session_state.spend_rollup.save()
+    except Exception as e:
+        st.error(f"Error saving the spend rollup: {e}")
+    report_scheduler.refresh(*sites)
+    snapshot_publisher.request()
+    try:
+        backup.Backups(BACKUP_DIR).maybe_create(st.session_state.multi_site_data)
+    except Exception as e:
+        st.error(f"Error creating backup: {e}")
+    return True
+
+
+@contextlib.contextmanager
+def writing():
+    """Hold the write lock while changing the data and saving it.
+
+    Other sessions' changes are applied first, and transactions appended in
+    the block get seqs no other session or process can take; call save_data()
+    before leaving it.
+    """
+    feed = st.session_state.change_feed
+    apply_changes(*feed.begin(st.session_state.multi_site_data))
+    try:
+        yield
+    finally:
+        feed.release()
+
+
+def analytics_snapshot():
+    """Published analytics snapshot; the live data until one is published"""
+    return read_replica.current(st.session_state.multi_site_data, SNAPSHOT_DIR)
+
+
+def show_snapshot_age(snapshot):
+    """Caption telling how current the analytics figures are"""
+    if snapshot.live:
+        st.caption("📸 Figures from live data")
+    else:
+        age = snapshot.age()
+        when = "just now" if age < 60 else f"{int(age // 60)} min ago"
+        st.caption(f"📸 Figures from analytics snapshot #{snapshot.meta['generation']}, published {when}")
 
 
 def show_dashboard():
@@ -164,23 +331,15 @@ def show_dashboard():
     # Global metrics
     col1, col2, col3, col4 = st.columns(4)
 
+    snapshot = analytics_snapshot()
+    per_site = {row['site']: row for row in snapshot.items.group_by('site').aggregate(
+        [('item', 'count'), ('value', 'sum')]).to_pylist()}
+
     total_sites = len(sites)
-    total_items = sum(len(site['materials']) + len(site['tools and accessories']) + len(site['machines']) 
-                     for site in sites.values())
-
-    total_stock_value = sum(
-        item['stock'] * item.get('rate', 0)
-        for site in sites.values()
-        for category in ['materials', 'tools and accessories', 'machines']
-        for item in site[category].values()
-    )
+    total_items = sum(per_site.get(site_name, {}).get('item_count', 0) for site_name in sites)
+    total_stock_value = sum(per_site.get(site_name, {}).get('value_sum', 0) for site_name in sites)
 
-    total_low_stock = sum(
-        1 for site in sites.values()
-        for category in ['materials', 'tools and accessories', 'machines']
-        for item in site[category].values()
-       if item.get('stock', 0) <= item.get('min_stock', 0)
-    )
+    total_low_stock = st.session_state.alert_engine.count('below_min')
 
     with col1:
         st.metric("🏢 Total Sites", total_sites)
@@ -198,24 +357,38 @@ def show_dashboard():
 
     site_data = []
     for site_name, site_info in sites.items():
-        site_items = len(site_info['materials']) + len(site_info['tools and accessories']) + len(site_info['machines'])
-        site_value = sum(
-            item['stock'] * item.get('rate', 0)
-            for category in ['materials', 'tools and accessories', 'machines']
-            for item in site_info[category].values()
-        )
-
+        totals = per_site.get(site_name, {})
         site_data.append({
             'Site Name': site_name,
             'Location': site_info['location'],
             'Manager': site_info['site_manager'],
-            'Total Items': site_items,
-            'Stock Value': f"₹{site_value:,.0f}"
+            'Total Items': totals.get('item_count', 0),
+            'Stock Value': f"₹{totals.get('value_sum', 0):,.0f}"
         })
 
     if site_data:
         df = pd.DataFrame(site_data)
         st.dataframe(df, use_container_width=True)
+    show_snapshot_age(snapshot)
+
+    st.divider()
+
+    # Active alerts
+    st.subheader("🔔 Active Alerts")
+
+    active_alerts = st.session_state.alert_engine.active_alerts()
+    if active_alerts:
+        df = pd.DataFrame([{
+            'Alert': alerts.RULE_LABELS[a['rule']],
+            'Site': a['site'],
+            'Item': a['item'].replace('_', ' ').title(),
+            'Category': a['category'].title(),
+            'Details': a['message'],
+            'Since': datetime.datetime.fromtimestamp(a['raised_ts']).strftime('%Y-%m-%d %H:%M')
+        } for a in active_alerts])
+        st.dataframe(df, use_container_width=True)
+    else:
+        st.success("✅ No active alerts")
 
 
 def show_site_management():
@@ -254,30 +427,27 @@ def show_site_management():
         project_type = st.selectbox("🏗️ Project Type *", ["painting work"], key="new_project_type")
 
         if st.button("➕ Add Site", key="add_site_btn", type="primary"):
-            if not site_name or not location or not site_manager or not contact:
-                st.error("❌ Please fill in all required fields!")
-            elif site_name in st.session_state.multi_site_data['sites']:
-                st.error(f"❌ Site '{site_name}' already exists!")
-            else:
-                st.session_state.multi_site_data['sites'][site_name] = {
-                    "location": location,
-                    "site_manager": site_manager,
-                    "contact": contact,
-                    "project_type": project_type,
-                    "materials": {},
-                    "tools and accessories": {},
-                    "machines": {}
-                }
+            with writing():
+                if not site_name or not location or not site_manager or not contact:
+                    st.error("❌ Please fill in all required fields!")
+                elif site_name in st.session_state.multi_site_data['sites']:
+                    st.error(f"❌ Site '{site_name}' already exists!")
+                else:
+                    inventory.add_site(st.session_state.multi_site_data, site_name, {
+                        "location": location,
+                        "site_manager": site_manager,
+                        "contact": contact,
+                        "project_type": project_type
+                    })
 
-                st.session_state.multi_site_data['system_info']['total_sites'] = len(st.session_state.multi_site_data['sites'])
-                st.session_state.multi_site_data['system_info']['last_updated'] = str(datetime.datetime.now())
+                    st.session_state.multi_site_data['system_info']['last_updated'] = str(datetime.datetime.now())
 
-                if save_data():
-                    st.markdown(f'<div class="success-box">✅ Site "{site_name}" added successfully!</div>', unsafe_allow_html=True)
-                    st.balloons()
-                    st.rerun()
-                else:
-                    st.markdown('<div class="error-box">❌ Failed to save site data.</div>', unsafe_allow_html=True)
+                    if save_data():
+                        st.markdown(f'<div class="success-box">✅ Site "{site_name}" added successfully!</div>', unsafe_allow_html=True)
+                        st.balloons()
+                        st.rerun()
+                    else:
+                        st.markdown('<div class="error-box">❌ Failed to save site data.</div>', unsafe_allow_html=True)
 
     with tab3:
         st.subheader("❌ Remove Site")
@@ -293,16 +463,44 @@ def show_site_management():
                 st.error("⚠️ This will permanently delete all inventory data for this site!")
 
                 if st.button(f"🗑️ Confirm Removal of '{site_to_remove}'", key="confirm_remove", type="secondary"):
-                    del st.session_state.multi_site_data['sites'][site_to_remove]
+                    with writing():
+                        inventory.remove_site(st.session_state.multi_site_data, site_to_remove)
+                        st.session_state.alert_engine.forget_site(site_to_remove)
+                        st.session_state.code_index.forget_site(site_to_remove)
+                        st.session_state.spend_rollup.forget_site(site_to_remove)
+                        st.session_state.render_cache.forget_site(site_to_remove)
 
-                    st.session_state.multi_site_data['system_info']['total_sites'] = len(st.session_state.multi_site_data['sites'])
-                    st.session_state.multi_site_data['system_info']['last_updated'] = str(datetime.datetime.now())
+                        st.session_state.multi_site_data['system_info']['last_updated'] = str(datetime.datetime.now())
 
-                    if save_data():
-                        st.markdown(f'<div class="success-box">✅ Site "{site_to_remove}" removed successfully!</div>', unsafe_allow_html=True)
-                        st.rerun()
-                    else:
-                        st.markdown('<div class="error-box">❌ Failed to save changes.</div>', unsafe_allow_html=True)
+                        if save_data():
+                            st.markdown(f'<div class="success-box">✅ Site "{site_to_remove}" removed successfully!</div>', unsafe_allow_html=True)
+                            st.rerun()
+                        else:
+                            st.markdown('<div class="error-box">❌ Failed to save changes.</div>', unsafe_allow_html=True)
+
+
+def build_inventory_view(site_data):
+    """Item counts and display tables of one site's inventory"""
+    counts = {category: len(site_data[category]) for category in storage.CATEGORIES}
+    tables = {}
+    for category in storage.CATEGORIES:
+        items_data = []
+        for item_name, item_info in site_data[category].items():
+            items_data.append({
+                'Item Name': item_name.replace('_', ' ').title(),
+                'Stock': item_info['stock'],
+                'Unit': item_info['unit'],
+                'Used': item_info['used'],
+                'Min Stock': item_info['min_stock'],
+                'Rate (₹)': f"₹{item_info.get('rate', 0):,.2f}",
+                'Avg Cost (₹)': f"₹{valuation.average_cost(item_info):,.2f}",
+                'Value (₹)': f"₹{valuation.item_value(item_info):,.2f}",
+                'Code': item_info.get('code', 'N/A')
+            })
+
+        if items_data:
+            tables[category] = pd.DataFrame(items_data)
+    return {'counts': counts, 'tables': tables}
 
 
 def show_inventory(selected_site):
@@ -318,38 +516,24 @@ def show_inventory(selected_site):
     """, unsafe_allow_html=True)
 
     site_data = st.session_state.multi_site_data['sites'][selected_site]
+    view = st.session_state.render_cache.get(
+        'inventory', selected_site, inventory.site_key(site_data),
+        lambda: build_inventory_view(site_data))
 
     col1, col2, col3 = st.columns(3)
 
     with col1:
-        st.metric("Materials", len(site_data['materials']))
+        st.metric("Materials", view['counts']['materials'])
     with col2:
-        st.metric("tools and accessories", len(site_data['tools and accessories']))
+        st.metric("tools and accessories", view['counts']['tools and accessories'])
     with col3:
-        st.metric("Machines & Accessories", len(site_data['machines']))
+        st.metric("Machines & Accessories", view['counts']['machines'])
 
     st.divider()
 
-    for category in ['materials', 'tools and accessories', 'machines']:
-        if site_data[category]:
-            st.subheader(f"📦 {category.title()}")
-
-            items_data = []
-            for item_name, item_info in site_data[category].items():
-                items_data.append({
-                    'Item Name': item_name.replace('_', ' ').title(),
-                    'Stock': item_info['stock'],
-                    'Unit': item_info['unit'],
-                    'Used': item_info['used'],
-                    'Min Stock': item_info['min_stock'],
-                    'Rate (₹)': f"₹{item_info.get('rate', 0):,.2f}",
-                    'Value (₹)': f"₹{item_info['stock'] * item_info.get('rate', 0):,.2f}",
-                    'Code': item_info.get('code', 'N/A')
-                })
-
-            if items_data:
-                df = pd.DataFrame(items_data)
-                st.dataframe(df, use_container_width=True)
+    for category, df in view['tables'].items():
+        st.subheader(f"📦 {category.title()}")
+        st.dataframe(df, use_container_width=True)
 
 
 def show_all_sites_inventory():
@@ -380,40 +564,38 @@ def show_all_sites_inventory():
     
     st.divider()
     
-    # Collect all items from all sites
-    all_items = []
-    
-    for site_name, site_data in sites.items():
-        for category in ['materials', 'tools and accessories', 'machines']:
-            if selected_category != "All Categories" and category != selected_category:
-                continue
-            
-            for item_name, item_info in site_data[category].items():
-                # Apply filters
-                if search_item and search_item.lower() not in item_name.lower():
-                    continue
-                
-                if show_low_stock_only and item_info['stock'] > item_info['min_stock']:
-                    continue
-                
-                all_items.append({
-                    'Site': site_name,
-                    'Item': item_name.replace('_', ' ').title(),
-                    'Category': category.title(),
-                    'Stock': item_info['stock'],
-                    'Unit': item_info['unit'],
-                    'Used': item_info['used'],
-                    'Min Stock': item_info['min_stock'],
-                    'Rate (₹)': f"₹{item_info.get('rate', 0):,.2f}",
-                    'Total Value (₹)': f"₹{item_info['stock'] * item_info.get('rate', 0):,.2f}",
-                    'Code': item_info.get('code', 'N/A'),
-                    'Status': '🔴 Low Stock' if item_info['stock'] <= item_info['min_stock'] else '🟢 OK'
-                })
-    
-    if all_items:
+    # Filter the analytics snapshot column-wise
+    snapshot = analytics_snapshot()
+    items = snapshot.items
+    mask = pc.is_in(items['site'], value_set=pa.array(list(sites), pa.string()))
+    if selected_category != "All Categories":
+        mask = pc.and_(mask, pc.equal(items['category'], selected_category))
+    if search_item:
+        mask = pc.and_(mask, pc.match_substring(items['item'], search_item, ignore_case=True))
+    if show_low_stock_only:
+        mask = pc.and_(mask, pc.less_equal(items['stock'], items['min_stock']))
+    rows = items.filter(mask).to_pandas()
+
+    low_stock = rows['stock'] <= rows['min_stock']
+    all_items = pd.DataFrame({
+        'Site': rows['site'],
+        'Item': rows['item'].str.replace('_', ' ').str.title(),
+        'Category': rows['category'].str.title(),
+        'Stock': rows['stock'],
+        'Unit': rows['unit'],
+        'Used': rows['used'],
+        'Min Stock': rows['min_stock'],
+        'Rate (₹)': rows['rate'].map('₹{:,.2f}'.format),
+        'Total Value (₹)': rows['value'].map('₹{:,.2f}'.format),
+        'Code': rows['code'],
+        'Status': low_stock.map({True: '🔴 Low Stock', False: '🟢 OK'})
+    })
+
+    if not all_items.empty:
         # Display as table
-        df = pd.DataFrame(all_items)
+        df = all_items
         st.dataframe(df, use_container_width=True)
+        show_snapshot_age(snapshot)
         
         # Summary statistics
         st.divider()
@@ -425,11 +607,7 @@ def show_all_sites_inventory():
             st.metric("Total Items", len(df))
         
         with col2:
-            # Calculate total value (remove currency formatting for calculation)
-            total_value = sum(
-                float(item['Total Value (₹)'].replace('₹', '').replace(',', ''))
-                for item in all_items
-            )
+            total_value = rows['value'].sum()
             st.metric("Total Stock Value", f"₹{total_value:,.0f}")
         
         with col3:
@@ -468,6 +646,71 @@ def show_all_sites_inventory():
         st.info("No items found matching your filters.")
 
 
+def show_stock_matrix():
+    """Item x site matrix of stock, value or shortfall"""
+    st.header("🧮 Item × Site Stock Matrix")
+
+    data = st.session_state.multi_site_data
+    if not data['sites']:
+        st.warning("⚠️ No sites available.")
+        return
+
+    prepared = st.session_state.render_cache.get(
+        'stock_matrix', None, inventory.data_version(data), lambda: stock_matrix.prepare(data))
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        layer = st.radio("📐 Show", list(stock_matrix.LAYERS), format_func=lambda x: stock_matrix.LAYERS[x],
+                         horizontal=True)
+    with col2:
+        category = st.selectbox(
+            "📦 Filter by Category",
+            [""] + storage.CATEGORIES,
+            format_func=lambda x: x.title() if x else "All Categories",
+            key="matrix_category"
+        )
+    with col3:
+        search = st.text_input("🔍 Search Item", placeholder="Search item name...", key="matrix_search")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        sort = st.selectbox("↕️ Sort by", list(stock_matrix.SORTS), format_func=lambda x: stock_matrix.SORTS[x])
+    with col2:
+        descending = st.checkbox("Descending", value=sort != 'item')
+    with col3:
+        limit = st.number_input("Rows Shown", min_value=10, max_value=2000, value=200, step=50)
+
+    selected = stock_matrix.select(prepared, category, search, sort, descending, limit=None)
+    if selected.empty:
+        st.info("No items found matching your filters.")
+        return
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Items", len(selected))
+    with col2:
+        st.metric("Sites", len(prepared['sites']))
+    with col3:
+        st.metric("Total Stock Value", f"₹{selected['value'].sum():,.0f}")
+    with col4:
+        st.metric("Items Below Min Somewhere", int((selected['sites_short'] > 0).sum()))
+
+    shown = selected.head(int(limit))
+    matrix = stock_matrix.pivot(prepared, shown, layer)
+    if len(selected) > len(shown):
+        st.caption(f"Showing the first {len(shown)} of {len(selected)} items. Blank cells: item not stocked at that site.")
+    else:
+        st.caption("Blank cells: item not stocked at that site.")
+    st.dataframe(matrix.round(2), use_container_width=True)
+
+    st.download_button(
+        label="📥 Download Matrix as CSV",
+        data=matrix.to_csv(),
+        file_name=f"stock_matrix_{layer}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        mime="text/csv"
+    )
+
+
 def show_add_items(selected_site):
     """Add items interface"""
     if not selected_site:
@@ -496,6 +739,8 @@ def show_add_items(selected_site):
             current_stock = site_data[category][item_name]['stock']
             unit = site_data[category][item_name]['unit']
             st.info(f"Current Stock: {current_stock} {unit}")
+            rate = st.number_input("Purchase Rate per Unit (₹)", min_value=0.0,
+                                   value=float(site_data[category][item_name].get('rate', 0) or 0), step=0.01)
         else:
             item_name = st.text_input("Item Name *").lower().replace(' ', '_')
             unit = st.text_input("Unit *", placeholder="pieces, kg, liters, etc.")
@@ -515,46 +760,43 @@ def show_add_items(selected_site):
 
     if st.button("➕ Add to Inventory", type="primary"):
         try:
-            if item_option == "New Item":
-                if item_name and unit and quantity >= 0 and received_by:
-                    site_data[category][item_name] = {
-                        'stock': quantity,
-                        'used': 0,
-                        'unit': unit,
-                        'min_stock': min_stock,
-                        'category': category,
-                        'rate': rate,
-                        'code': item_code or 'N/A'
-                    }
-                    success_msg = f"✅ New item '{item_name.replace('_', ' ').title()}' added with {quantity} {unit}"
-                else:
-                    st.error("❌ Please fill all required fields for new item")
-                    return
-            else:
-                if item_name and quantity >= 0 and received_by:
-                    site_data[category][item_name]['stock'] += quantity
-                    success_msg = f"✅ Added {quantity} {site_data[category][item_name]['unit']} to '{item_name.replace('_', ' ').title()}'"
+            with writing():
+                site_data = st.session_state.multi_site_data['sites'][selected_site]
+                if item_option == "New Item":
+                    if item_name and unit and quantity >= 0 and received_by:
+                        conflict = code_conflict_message(item_code, category, item_name)
+                        if conflict:
+                            st.error(conflict)
+                            return
+                        transaction = inventory.receive(
+                            st.session_state.multi_site_data, selected_site, category, item_name, quantity, received_by,
+                            supplier=supplier,
+                            new_item={'unit': unit, 'min_stock': min_stock, 'rate': rate, 'code': item_code},
+                            invoice_number=invoice_number, purchase_date=purchase_date, rate=rate, notes=notes
+                        )
+                        success_msg = f"✅ New item '{item_name.replace('_', ' ').title()}' added with {quantity} {unit}"
+                    else:
+                        st.error("❌ Please fill all required fields for new item")
+                        return
                 else:
-                    st.error("❌ Please fill all required fields")
-                    return
+                    if item_name and quantity >= 0 and received_by:
+                        transaction = inventory.receive(
+                            st.session_state.multi_site_data, selected_site, category, item_name, quantity, received_by,
+                            supplier=supplier, invoice_number=invoice_number, purchase_date=purchase_date,
+                            rate=rate, notes=notes
+                        )
+                        success_msg = f"✅ Added {quantity} {site_data[category][item_name]['unit']} to '{item_name.replace('_', ' ').title()}'"
+                    else:
+                        st.error("❌ Please fill all required fields")
+                        return
 
-            transaction = {
-                'date': str(datetime.datetime.now()),
-                'type': 'added',
-                'site': selected_site,
-                'category': category,
-                'item': item_name,
-                'quantity': quantity,
-                'supplier': supplier,
-                'received_by': received_by
-            }
-            st.session_state.multi_site_data['transactions'].append(transaction)
+                track_transaction(transaction)
 
-            if save_data():
-                st.markdown(f'<div class="success-box">{success_msg}</div>', unsafe_allow_html=True)
-                st.info(f"New stock level: {site_data[category][item_name]['stock']} {site_data[category][item_name]['unit']}")
-            else:
-                st.error("❌ Failed to save data")
+                if save_data(selected_site):
+                    st.markdown(f'<div class="success-box">{success_msg}</div>', unsafe_allow_html=True)
+                    st.info(f"New stock level: {site_data[category][item_name]['stock']} {site_data[category][item_name]['unit']}")
+                else:
+                    st.error("❌ Failed to save data")
 
         except Exception as e:
             st.error(f"❌ Error adding item: {str(e)}")
@@ -607,37 +849,69 @@ def show_use_items(selected_site):
     if st.button("➖ Record Usage", type="primary") and available_items and item_name:
         if quantity > 0 and work_area and supervisor:
             try:
-                site_data[category][item_name]['stock'] -= quantity
-                site_data[category][item_name]['used'] += quantity
-
-                transaction = {
-                    'date': str(datetime.datetime.now()),
-                    'type': 'used',
-                    'site': selected_site,
-                    'category': category,
-                    'item': item_name,
-                    'quantity': quantity,
-                    'work_area': work_area,
-                    'supervisor': supervisor,
-                    'purpose': purpose
-                }
-                st.session_state.multi_site_data['transactions'].append(transaction)
-
-                if save_data():
-                    remaining = site_data[category][item_name]['stock']
-                    st.markdown(f'<div class="success-box">✅ Recorded usage of {quantity} {unit}</div>', unsafe_allow_html=True)
-                    st.info(f"Remaining stock: {remaining} {unit}")
-
-                    if remaining <= site_data[category][item_name]['min_stock']:
-                        st.warning(f"⚠️ Low stock alert for {item_name.replace('_', ' ').title()}!")
-                else:
-                    st.error("❌ Failed to save usage data")
+                with writing():
+                    site_data = st.session_state.multi_site_data['sites'][selected_site]
+                    transaction = inventory.consume(
+                        st.session_state.multi_site_data, selected_site, category, item_name, quantity,
+                        work_area, supervisor, purpose
+                    )
+                    track_transaction(transaction)
+
+                    if save_data(selected_site):
+                        remaining = site_data[category][item_name]['stock']
+                        st.markdown(f'<div class="success-box">✅ Recorded usage of {quantity} {unit}</div>', unsafe_allow_html=True)
+                        st.info(f"Remaining stock: {remaining} {unit}")
+
+                        show_item_alerts(selected_site, category, item_name)
+                    else:
+                        st.error("❌ Failed to save usage data")
 
             except Exception as e:
                 st.error(f"❌ Error recording usage: {str(e)}")
         else:
             st.error("❌ Please fill all required fields")
 
+    st.divider()
+    with st.expander("📴 Import Offline Records"):
+        st.write("Upload an offline outbox (JSON lines, one record per line) captured while the site had no connectivity. "
+                 "Records already synced are skipped.")
+        outbox_file = st.file_uploader("Outbox File", type=["jsonl", "json"], key="offline_outbox")
+
+        if outbox_file is not None and st.button("📤 Sync Offline Records"):
+            try:
+                records = sync.parse_outbox(outbox_file.getvalue())
+            except ValueError as e:
+                st.error(f"❌ Could not read outbox file: {str(e)}")
+                return
+
+            with writing():
+                # Caught up under the lock, so the log has every record already synced
+                applied = sync.request_index(st.session_state.multi_site_data['transactions'])
+                results, transactions = sync.apply_batch(st.session_state.multi_site_data, records, applied)
+                for transaction in transactions:
+                    track_transaction(transaction)
+
+                if transactions and not save_data(*sync.touched_sites(transactions)):
+                    sync.undo_batch(st.session_state.multi_site_data, transactions, applied)
+                    apply_changes([], True)
+                    st.error("❌ Failed to save synced records; nothing was imported")
+                    return
+
+            counts = pd.Series([r['status'] for r in results]).value_counts()
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("✅ Applied", int(counts.get('applied', 0)))
+            with col2:
+                st.metric("🔁 Duplicates", int(counts.get('duplicate', 0)))
+            with col3:
+                st.metric("⚠️ Conflicts", int(counts.get('conflict', 0)))
+            with col4:
+                st.metric("❌ Invalid", int(counts.get('invalid', 0)))
+
+            problems = [r for r in results if r['status'] not in sync.APPLIED_STATUSES]
+            if problems:
+                st.dataframe(pd.DataFrame(problems), use_container_width=True)
+
 
 def show_edit_items(selected_site):
     """Edit/Update existing items"""
@@ -726,32 +1000,25 @@ def show_edit_items(selected_site):
                 st.write("")
 
             if st.button("✅ Save Changes", type="primary", key="update_item"):
+                conflict = code_conflict_message(new_code, category, item_name)
+                if conflict:
+                    st.error(conflict)
+                    return
                 try:
-                    site_data[category][item_name]['stock'] = new_stock
-                    site_data[category][item_name]['used'] = new_used
-                    site_data[category][item_name]['unit'] = new_unit
-                    site_data[category][item_name]['rate'] = new_rate
-                    site_data[category][item_name]['min_stock'] = new_min_stock
-                    site_data[category][item_name]['code'] = new_code
-
-                    transaction = {
-                        'date': str(datetime.datetime.now()),
-                        'type': 'edited',
-                        'site': selected_site,
-                        'category': category,
-                        'item': item_name,
-                        'old_stock': item_data['stock'],
-                        'new_stock': new_stock,
-                        'notes': update_notes
-                    }
-                    st.session_state.multi_site_data['transactions'].append(transaction)
-
-                    if save_data():
-                        st.markdown(f'<div class="success-box">✅ Item "{item_name.replace("_", " ").title()}" updated successfully!</div>', unsafe_allow_html=True)
-                        st.balloons()
-                        st.rerun()
-                    else:
-                        st.markdown('<div class="error-box">❌ Failed to save changes.</div>', unsafe_allow_html=True)
+                    with writing():
+                        transaction = inventory.edit_item(
+                            st.session_state.multi_site_data, selected_site, category, item_name,
+                            stock=new_stock, used=new_used, unit=new_unit, rate=new_rate,
+                            min_stock=new_min_stock, code=new_code, notes=update_notes
+                        )
+                        track_transaction(transaction)
+
+                        if save_data(selected_site):
+                            st.markdown(f'<div class="success-box">✅ Item "{item_name.replace("_", " ").title()}" updated successfully!</div>', unsafe_allow_html=True)
+                            st.balloons()
+                            st.rerun()
+                        else:
+                            st.markdown('<div class="error-box">❌ Failed to save changes.</div>', unsafe_allow_html=True)
 
                 except Exception as e:
                     st.markdown(f'<div class="error-box">❌ Error updating item: {str(e)}</div>', unsafe_allow_html=True)
@@ -764,23 +1031,15 @@ def show_edit_items(selected_site):
             with col1:
                 if st.button("🗑️ Confirm Delete", type="secondary", key="delete_item"):
                     try:
-                        del site_data[category][item_name]
-
-                        transaction = {
-                            'date': str(datetime.datetime.now()),
-                            'type': 'deleted',
-                            'site': selected_site,
-                            'category': category,
-                            'item': item_name,
-                            'deleted_stock': item_data['stock']
-                        }
-                        st.session_state.multi_site_data['transactions'].append(transaction)
+                        with writing():
+                            transaction = inventory.delete_item(st.session_state.multi_site_data, selected_site, category, item_name)
+                            track_transaction(transaction)
 
-                        if save_data():
-                            st.markdown(f'<div class="success-box">✅ Item deleted successfully!</div>', unsafe_allow_html=True)
-                            st.rerun()
-                        else:
-                            st.markdown('<div class="error-box">❌ Failed to delete item.</div>', unsafe_allow_html=True)
+                            if save_data(selected_site):
+                                st.markdown(f'<div class="success-box">✅ Item deleted successfully!</div>', unsafe_allow_html=True)
+                                st.rerun()
+                            else:
+                                st.markdown('<div class="error-box">❌ Failed to delete item.</div>', unsafe_allow_html=True)
 
                     except Exception as e:
                         st.markdown(f'<div class="error-box">❌ Error deleting item: {str(e)}</div>', unsafe_allow_html=True)
@@ -798,11 +1057,13 @@ def show_edit_items(selected_site):
 
             if item_transactions:
                 trans_data = []
-                for t in sorted(item_transactions, key=lambda x: x['date'], reverse=True):
+                for t in reversed(item_transactions):
                     trans_data.append({
-                        'Date': t['date'][:19],
+                        'Seq': t['seq'],
+                        'Date': ledger.format_time(t),
                         'Action': t['type'].title(),
                         'Quantity': t.get('quantity', t.get('new_stock', 'N/A')),
+                        'Value (₹)': f"₹{t.get('value', t.get('new_value')):,.2f}" if 'value' in t or 'new_value' in t else '',
                         'Details': t.get('notes', '')
                     })
 
@@ -819,10 +1080,10 @@ def show_edit_items(selected_site):
             with col2:
                 st.metric("Used", item_data.get('used', 0))
             with col3:
-                st.metric("Rate", f"₹{item_data.get('rate', 0):,.2f}")
+                st.metric("Avg Cost", f"₹{valuation.average_cost(item_data):,.2f}",
+                          help=f"Rate: ₹{item_data.get('rate', 0):,.2f}")
             with col4:
-                total_value = item_data['stock'] * item_data.get('rate', 0)
-                st.metric("Total Value", f"₹{total_value:,.2f}")
+                st.metric("Total Value", f"₹{valuation.item_value(item_data):,.2f}")
 
 
 def show_transfers():
@@ -876,45 +1137,165 @@ def show_transfers():
     if st.button("🔄 Execute Transfer", type="primary"):
         if available_items and item_name and quantity > 0 and to_site and authorized_by and driver_name:
             try:
-                from_site_data = st.session_state.multi_site_data['sites'][from_site]
-                to_site_data = st.session_state.multi_site_data['sites'][to_site]
+                with writing():
+                    transaction = inventory.transfer(
+                        st.session_state.multi_site_data, from_site, to_site, category, item_name, quantity,
+                        authorized_by, driver_name, vehicle_number
+                    )
+                    track_transaction(transaction)
+
+                    from_site_data = st.session_state.multi_site_data['sites'][from_site]
+                    to_site_data = st.session_state.multi_site_data['sites'][to_site]
+
+                    if save_data(from_site, to_site):
+                        st.markdown(f'<div class="success-box">✅ Successfully transferred {quantity} {unit} of {item_name.replace("_", " ").title()}</div>', unsafe_allow_html=True)
+                        st.info(f"From {from_site}: {from_site_data[category][item_name]['stock']} {unit} remaining")
+                        st.info(f"To {to_site}: {to_site_data[category][item_name]['stock']} {unit} total")
+                        show_item_alerts(from_site, category, item_name)
+                    else:
+                        st.error("❌ Failed to save transfer data")
 
-                item_data = from_site_data[category][item_name].copy()
+            except Exception as e:
+                st.error(f"❌ Error executing transfer: {str(e)}")
+        else:
+            st.error("❌ Please fill all required fields")
 
-                from_site_data[category][item_name]['stock'] -= quantity
 
-                if item_name in to_site_data[category]:
-                    to_site_data[category][item_name]['stock'] += quantity
-                else:
-                    to_site_data[category][item_name] = item_data
-                    to_site_data[category][item_name]['stock'] = quantity
-                    to_site_data[category][item_name]['used'] = 0
-
-                transaction = {
-                    'date': str(datetime.datetime.now()),
-                    'type': 'transfer',
-                    'from_site': from_site,
-                    'to_site': to_site,
-                    'category': category,
-                    'item': item_name,
-                    'quantity': quantity,
-                    'authorized_by': authorized_by,
-                    'driver_name': driver_name,
-                    'vehicle_number': vehicle_number
-                }
-                st.session_state.multi_site_data['transactions'].append(transaction)
+def show_quick_scan(selected_site):
+    """Scan-driven quick entry: jump from an item code straight to use/add"""
+    st.header("📷 Quick Scan")
+
+    code_index = st.session_state.code_index
+    duplicates = code_index.duplicates()
+    if duplicates:
+        with st.expander(f"⚠️ {len(duplicates)} item codes are shared by different items"):
+            st.dataframe(pd.DataFrame([{
+                'Code': code,
+                'Items': ", ".join(f"{item.replace('_', ' ').title()} ({site})" for site, _, item in keys)
+            } for code, keys in sorted(duplicates.items())]), use_container_width=True)
+
+    code = st.text_input("🔍 Scan or Type Item Code", key="scan_code", placeholder="e.g., SA-HE-001")
+
+    if not code:
+        st.info("Scan a barcode/QR code or type an item code and press Enter.")
+        return
+
+    matches = code_index.lookup(code)
+    if not matches:
+        st.error(f"❌ No item found with code '{code}'")
+        return
 
-                if save_data():
-                    st.markdown(f'<div class="success-box">✅ Successfully transferred {quantity} {item_data["unit"]} of {item_name.replace("_", " ").title()}</div>', unsafe_allow_html=True)
-                    st.info(f"From {from_site}: {from_site_data[category][item_name]['stock']} {item_data['unit']} remaining")
-                    st.info(f"To {to_site}: {to_site_data[category][item_name]['stock']} {item_data['unit']} total")
+    # Items at the selected site first
+    matches.sort(key=lambda k: k[0] != selected_site)
+    if len(matches) > 1:
+        site_name, category, item_name = st.radio(
+            "📍 Select Record",
+            matches,
+            format_func=lambda k: f"{k[2].replace('_', ' ').title()} @ {k[0]} ({k[1].title()})"
+        )
+    else:
+        site_name, category, item_name = matches[0]
+
+    item = st.session_state.multi_site_data['sites'][site_name][category][item_name]
+
+    st.markdown(f"""
+    <div class="site-header">
+        <h2>📦 {item_name.replace('_', ' ').title()} @ {site_name}</h2>
+    </div>
+    """, unsafe_allow_html=True)
+
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Stock", f"{item['stock']} {item['unit']}")
+    with col2:
+        st.metric("Used", item.get('used', 0))
+    with col3:
+        st.metric("Min Stock", item.get('min_stock', 0))
+    with col4:
+        st.metric("Rate", f"₹{item.get('rate', 0):,.2f}")
+
+    show_item_alerts(site_name, category, item_name)
+
+    with st.form("quick_entry", clear_on_submit=True):
+        action = st.radio("Action", ["➖ Use", "➕ Add"], horizontal=True)
+        quantity = st.number_input(f"Quantity ({item['unit']}) *", min_value=1, value=1)
+        col1, col2 = st.columns(2)
+        with col1:
+            person = st.text_input("Supervisor / Received By *", value="Site Supervisor")
+        with col2:
+            work_area = st.text_input("Work Area (for usage)", placeholder="e.g., Block A - 3rd Floor")
+        submitted = st.form_submit_button("✅ Record", type="primary")
+
+    if submitted:
+        with writing():
+            try:
+                if action == "➖ Use":
+                    transaction = inventory.consume(
+                        st.session_state.multi_site_data, site_name, category, item_name, quantity,
+                        work_area, person
+                    )
                 else:
-                    st.error("❌ Failed to save transfer data")
+                    transaction = inventory.receive(
+                        st.session_state.multi_site_data, site_name, category, item_name, quantity, person
+                    )
+            except inventory.InventoryError as e:
+                st.error(f"❌ {str(e)}")
+                return
+
+            track_transaction(transaction)
+            if save_data(site_name):
+                item = st.session_state.multi_site_data['sites'][site_name][category][item_name]
+                st.markdown(f'<div class="success-box">✅ {action[2:]} {quantity} {item["unit"]} recorded. '
+                            f'Stock now {item["stock"]} {item["unit"]}</div>', unsafe_allow_html=True)
+            else:
+                st.error("❌ Failed to save data")
 
-            except Exception as e:
-                st.error(f"❌ Error executing transfer: {str(e)}")
-        else:
-            st.error("❌ Please fill all required fields")
+
+def show_procurement(selected_site):
+    """Vendor spend and purchase price trends from the spend rollup"""
+    st.subheader("🧾 Procurement")
+    rollup = st.session_state.spend_rollup
+
+    vendors = rollup.vendor_spend(selected_site)
+    if not vendors:
+        st.info("No receipts recorded for this site.")
+        return
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Total Spend", f"₹{sum(v['spend'] for v in vendors):,.0f}")
+    with col2:
+        st.metric("Suppliers", len(vendors))
+    with col3:
+        st.metric("Receipts", sum(v['receipts'] for v in vendors))
+
+    df = pd.DataFrame([{
+        'Supplier': v['supplier'],
+        'Spend (₹)': f"₹{v['spend']:,.2f}",
+        'Quantity': v['quantity'],
+        'Receipts': v['receipts'],
+        'Items': v['items'],
+        'Last Purchase': v['last_month']
+    } for v in vendors])
+    st.dataframe(df, use_container_width=True)
+
+    monthly = pd.DataFrame([{'Month': month, 'Supplier': supplier, 'Spend (₹)': spend}
+                            for (month, supplier), spend in sorted(rollup.monthly_spend(selected_site).items())])
+    fig = px.bar(monthly, x='Month', y='Spend (₹)', color='Supplier', title="Monthly Spend by Supplier")
+    st.plotly_chart(fig, use_container_width=True)
+
+    priced = rollup.priced_items(selected_site)
+    if priced:
+        category, item_name = st.selectbox(
+            "📈 Price Trend for Item", priced, key="price_trend_item",
+            format_func=lambda key: f"{key[1].replace('_', ' ').title()} ({key[0].title()})")
+        trend = pd.DataFrame(rollup.price_trend(selected_site, category, item_name))
+        trend = trend.rename(columns={'month': 'Month', 'supplier': 'Supplier', 'rate': 'Avg Rate (₹)',
+                                      'quantity': 'Quantity', 'receipts': 'Receipts'})
+        fig = px.line(trend, x='Month', y='Avg Rate (₹)', color='Supplier', markers=True,
+                      title=f"Purchase Rate: {item_name.replace('_', ' ').title()}")
+        st.plotly_chart(fig, use_container_width=True)
+        st.dataframe(trend, use_container_width=True)
 
 
 def show_reports(selected_site):
@@ -929,24 +1310,67 @@ def show_reports(selected_site):
         col1, col2, col3 = st.columns(3)
 
         total_items = len(site_data['materials']) + len(site_data['tools and accessories']) + len(site_data['machines'])
-        total_value = sum(item['stock'] * item.get('rate', 0) for category in ['materials', 'tools and accessories', 'machines'] for item in site_data[category].values())
+        total_value = sum(valuation.item_value(item) for category in ['materials', 'tools and accessories', 'machines'] for item in site_data[category].values())
 
         with col1:
             st.metric("Total Items", total_items)
         with col2:
             st.metric("Stock Value", f"₹{total_value:,.0f}")
         with col3:
-            transactions = len([t for t in st.session_state.multi_site_data['transactions'] if t.get('site') == selected_site])
+            transactions = analytics_snapshot().site_transaction_count(selected_site)
             st.metric("Transactions", transactions)
 
+        st.subheader("🗂️ Scheduled Reports")
+        st.caption("Daily and weekly reports are prepared in the background and refreshed when the site changes.")
+
+        period_cols = st.columns(len(reports.PERIODS))
+        for col, period in zip(period_cols, reports.PERIODS):
+            with col:
+                meta, path = reports.latest_report(selected_site, period, REPORT_DIR)
+                st.write(f"**{period.title()} Report**")
+                if meta is None:
+                    st.info("⏳ Being prepared...")
+                    continue
+                st.write(f"🕒 Generated {reports.freshness(meta)} "
+                         f"({datetime.datetime.fromtimestamp(meta['generated_at']):%Y-%m-%d %H:%M})")
+                summary = meta['summary']
+                st.write(f"Consumption: ₹{summary['consumed_value']:,.0f} · "
+                         f"Transfers in/out: {summary['transfers_in']}/{summary['transfers_out']}")
+                try:
+                    with open(path, 'rb') as f:
+                        workbook = f.read()
+                except OSError as e:
+                    st.error(f"Error reading report: {e}")
+                    continue
+                st.download_button(
+                    label=f"📥 Download {period.title()} Report",
+                    data=workbook,
+                    file_name=f"{period}_report_{storage.shard_id(selected_site)}_"
+                              f"{datetime.datetime.fromtimestamp(meta['generated_at']):%Y%m%d_%H%M}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key=f"download_{period}_report"
+                )
+
+        if selected_site in report_scheduler.errors:
+            st.error(f"Error building reports: {report_scheduler.errors[selected_site]}")
+        if selected_site in report_scheduler.pending():
+            st.info("🔄 Reports are being rebuilt...")
+        elif st.button("🔄 Rebuild Reports Now"):
+            report_scheduler.submit(selected_site)
+            st.success("✅ Reports queued; they will be ready shortly.")
+
+        show_procurement(selected_site)
+
         st.subheader("📋 Recent Transactions")
-        site_transactions = [t for t in st.session_state.multi_site_data['transactions'] 
-                           if t.get('site') == selected_site or t.get('from_site') == selected_site or t.get('to_site') == selected_site]
+        recent = list(itertools.islice(
+            (t for t in reversed(st.session_state.multi_site_data['transactions'])
+             if t.get('site') == selected_site or t.get('from_site') == selected_site or t.get('to_site') == selected_site),
+            10))
 
-        if site_transactions:
-            recent = sorted(site_transactions, key=lambda x: x['date'], reverse=True)[:10]
+        if recent:
             df = pd.DataFrame([{
-                'Date': t['date'][:19],
+                'Seq': t['seq'],
+                'Date': ledger.format_time(t),
                 'Type': t['type'].title(),
                 'Item': t['item'].replace('_', ' ').title(),
                 'Quantity': t.get('Quantity', t.get('quantity', 'N/A'))
@@ -987,10 +1411,117 @@ def show_settings():
                 mime="application/json"
             )
 
+        format_labels = {"json": "JSON (readable)", "binary": "Binary (compact, faster)"}
+        current_format = system_info.get('storage_format', storage.DEFAULT_FORMAT)
+        storage_format = st.selectbox(
+            "🗄️ Storage Format",
+            list(storage.FORMATS),
+            index=list(storage.FORMATS).index(current_format),
+            format_func=lambda x: format_labels[x],
+            help="Existing JSON data is still read when the binary format is selected. "
+                 "Binary files are about 15-20x smaller and load and save about 3-4x faster; "
+                 "most of the remaining load time is building the records in memory, which "
+                 "costs the same for both formats."
+        )
+
+        if storage_format != current_format:
+            with writing():
+                st.session_state.multi_site_data['system_info']['storage_format'] = storage_format
+                if save_data(rewrite=True):
+                    st.success(f"✅ Data now stored as {format_labels[storage_format]}")
+
         if st.button("🔄 Refresh Data"):
             st.success("✅ Data refreshed!")
             st.rerun()
 
+    st.divider()
+    st.subheader("🗄️ Backups")
+    st.write(f"A backup is taken on save when the last one is over {backup.INTERVAL // 60} minutes old. "
+             f"Backups hold only the changes since the previous one, with a full backup every {backup.FULL_EVERY}.")
+
+    backups = backup.Backups(BACKUP_DIR)
+    if st.button("💾 Back Up Now"):
+        try:
+            entry = backups.create(st.session_state.multi_site_data)
+            st.success(f"✅ Backup {entry['id']} created ({entry['kind']}, {entry['size'] / 1024:,.1f} KB)")
+        except Exception as e:
+            st.error(f"Error creating backup: {e}")
+
+    entries = backups.entries()
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Backups", len(entries))
+    with col2:
+        st.metric("Latest", datetime.datetime.fromtimestamp(entries[-1]['created_at']).strftime('%Y-%m-%d %H:%M')
+                  if entries else "Never")
+    with col3:
+        st.metric("Total Size", f"{sum(e['size'] for e in entries) / 1024:,.0f} KB")
+
+    if entries:
+        df = pd.DataFrame([{
+            'Backup': e['id'],
+            'Type': e['kind'].title(),
+            'Created': datetime.datetime.fromtimestamp(e['created_at']).strftime('%Y-%m-%d %H:%M:%S'),
+            'Last Seq': e['last_seq'],
+            'Transactions': e['transactions'],
+            'Size (KB)': round(e['size'] / 1024, 1)
+        } for e in reversed(entries)])
+        st.dataframe(df, use_container_width=True)
+
+        restore_id = st.selectbox("♻️ Restore To", [""] + [e['id'] for e in reversed(entries)], key="restore_backup")
+        if restore_id:
+            st.warning("⚠️ Restoring replaces the current data for all sites with this backup.")
+            confirm = st.checkbox("I understand, restore this backup", key="confirm_restore")
+            if st.button("♻️ Restore Backup", disabled=not confirm):
+                try:
+                    restored = backups.restore(restore_id)
+                except backup.BackupError as e:
+                    st.error(f"❌ {e}")
+                else:
+                    with writing():
+                        restored = backup.prepare_restore(restored, st.session_state.multi_site_data)
+                        st.session_state.multi_site_data = restored
+                        st.session_state.alert_engine = alerts.AlertEngine(restored)
+                        st.session_state.code_index = item_index.CodeIndex(restored)
+                        st.session_state.spend_rollup = procurement.SpendRollup(
+                            restored, st.session_state.change_feed.data_dir, rescan=True)
+                        st.session_state.render_cache.clear()
+                        if save_data(rewrite=True):
+                            st.success(f"✅ Restored backup {restore_id}")
+                            st.rerun()
+
+    st.divider()
+    st.subheader("🧮 Ledger Reconciliation")
+    st.write("Replays the transaction log and compares the expected stock and used quantities with the live inventory.")
+
+    if st.button("🧮 Run Reconciliation"):
+        report = reconcile.reconcile(st.session_state.multi_site_data)
+        counts = reconcile.summarize(report)
+
+        cols = st.columns(len(counts))
+        for col, (status, count) in zip(cols, counts.items()):
+            with col:
+                st.metric(reconcile.STATUS_LABELS[status], int(count))
+
+        mismatches = report[report['status'].isin(reconcile.MISMATCH_STATUSES)]
+        if mismatches.empty:
+            st.success("✅ Inventory matches the transaction log")
+        else:
+            st.warning(f"⚠️ {len(mismatches)} items differ from the transaction log")
+            display = mismatches.assign(
+                status=mismatches['status'].map(reconcile.STATUS_LABELS),
+                item=mismatches['item'].str.replace('_', ' ').str.title()
+            )
+            st.dataframe(display, use_container_width=True)
+
+        st.download_button(
+            label="📥 Download Reconciliation Report",
+            data=report.to_csv(index=False),
+            file_name=f"reconciliation_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+            mime="text/csv"
+        )
+
 
 def main():
     st.markdown("""
@@ -1000,7 +1531,11 @@ def main():
     </div>
     """, unsafe_allow_html=True)
 
+    st.session_state.run_count = st.session_state.get('run_count', 0) + 1
+    poll_changes()
+
     with st.sidebar:
+        watch_changes()
         st.title("🧭 Navigation")
 
         sites = list(st.session_state.multi_site_data['sites'].keys())
@@ -1024,10 +1559,12 @@ def main():
                 "🏢 Site Management", 
                 "📦 Site Inventory",
                 "🌐 All Sites View",
+                "🧮 Stock Matrix",
                 "➕ Add Items",
                 "➖ Use Items",
                 "🔧 Edit Items",
                 "🔄 Transfer Items",
+                "📷 Quick Scan",
                 "📊 Reports",
                 "⚙️ Settings"
             ]
@@ -1041,6 +1578,8 @@ def main():
         show_inventory(selected_site)
     elif page == "🌐 All Sites View":
         show_all_sites_inventory()
+    elif page == "🧮 Stock Matrix":
+        show_stock_matrix()
     elif page == "➕ Add Items":
         show_add_items(selected_site)
     elif page == "➖ Use Items":
@@ -1049,6 +1588,8 @@ def main():
         show_edit_items(selected_site)
     elif page == "🔄 Transfer Items":
         show_transfers()
+    elif page == "📷 Quick Scan":
+        show_quick_scan(selected_site)
     elif page == "📊 Reports":
         show_reports(selected_site)
     elif page == "⚙️ Settings":
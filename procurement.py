@@ -0,0 +1,240 @@
+"""Materialized procurement spend rollup.
+
+SpendRollup keeps one cell per (supplier, site, category, item, month) with
+the quantity received, the spend and the number of receipts, summed over the
+``added`` transactions.  Each new receipt updates its cell, so vendor spend
+and price trends are read from the cells instead of the transaction history.
+
+Given a data directory the cells are kept on disk next to the shards::
+
+    multi_site_data/spend/index.json      {"last_seq": n}
+    multi_site_data/spend/<shard>.json    one site's cells
+
+save() writes the sites that received something since the last save and
+then the index, so every site file is complete up to the index's last_seq
+(or its own, if later).  Loading reads the files and applies only the
+receipts after that seq; a site whose file is missing or belongs to an
+earlier site of the same name (see inventory.add_site) is scanned again.
+Writers save while holding the change feed's write lock.
+
+The month is taken from the receipt's purchase_date, falling back to the
+date it was recorded.  Receipts recorded before rates were kept on the
+transaction count towards quantity but not towards spend or prices.
+"""
+import collections
+import datetime
+import json
+import os
+import threading
+
+import inventory
+import ledger
+import storage
+
+
+UNSPECIFIED = "Unspecified"
+SPEND_DIR = "spend"
+INDEX_FILE = "index.json"
+
+
+def _month(transaction):
+    date = transaction.get('purchase_date') or transaction.get('date')
+    if date:
+        return str(date)[:7]
+    return datetime.datetime.fromtimestamp(transaction['ts']).strftime('%Y-%m')
+
+
+def _amount(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _write_atomic(path, blob):
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SpendRollup:
+    """(supplier, site, category, item, month) -> receipts for one data dict"""
+
+    def __init__(self, data, data_dir=None, rescan=False):
+        self.data = data
+        self.data_dir = data_dir
+        # cell -> [quantity, spend, priced quantity, receipts]
+        self.cells = {}
+        self._by_site = collections.defaultdict(set)
+        self._by_item = collections.defaultdict(set)
+        # Sites whose cells changed since they were last saved, and the
+        # {site: generation} of the sites in the saved index
+        self._dirty = set()
+        self._saved = {}
+        self.scanned = 0
+        self.rebuild(rescan)
+
+    def _clear(self):
+        self.cells.clear()
+        self._by_site.clear()
+        self._by_item.clear()
+
+    def rebuild(self, rescan=False):
+        """Load the saved cells and catch up, or scan the whole history"""
+        self._clear()
+        if not rescan and self.data_dir and self._load():
+            return
+        self._clear()
+        self._saved = {}
+        self.scanned = len(self.data['transactions'])
+        for transaction in self.data['transactions']:
+            self.on_transaction(transaction)
+
+    def _path(self, site_name=None):
+        name = INDEX_FILE if site_name is None else storage.shard_id(site_name) + '.json'
+        return os.path.join(self.data_dir, SPEND_DIR, name)
+
+    def _load(self):
+        index = _read_json(self._path())
+        if not index or index.get('last_seq', 0) > ledger.last_seq(self.data):
+            return False
+        self._saved = index.get('sites', {})
+        # Receipts after this seq still have to be applied, per site
+        applied = {}
+        for site_name, site_info in self.data['sites'].items():
+            generation = inventory.site_generation(site_info)
+            if self._saved.get(site_name) != generation:
+                # Added after the index was written: nothing saved yet
+                applied[site_name] = index['last_seq']
+                continue
+            saved = _read_json(self._path(site_name))
+            if not saved or saved.get('site') != site_name or saved.get('generation') != generation:
+                applied[site_name] = 0
+                self._dirty.add(site_name)
+                continue
+            applied[site_name] = max(saved['last_seq'], index['last_seq'])
+            for supplier, category, item_name, month, *cell in saved['cells']:
+                self._add_cell((supplier, site_name, category, item_name, month), cell)
+        start = min(applied.values(), default=index['last_seq'])
+        pending = ledger.transactions_after(self.data['transactions'], start)
+        self.scanned = len(pending)
+        for transaction in pending:
+            if transaction.get('seq', 0) > applied.get(transaction.get('site'), start):
+                self.on_transaction(transaction)
+        return True
+
+    def save(self):
+        """Write the sites changed or added since the last save, then the index"""
+        if not self.data_dir:
+            return 0
+        sites = {site_name: inventory.site_generation(site_info)
+                 for site_name, site_info in self.data['sites'].items()}
+        changed = {site_name for site_name, generation in sites.items()
+                   if site_name in self._dirty or self._saved.get(site_name) != generation}
+        removed = set(self._saved) - set(sites)
+        if not changed and not removed:
+            return 0
+        os.makedirs(os.path.join(self.data_dir, SPEND_DIR), exist_ok=True)
+        last_seq = ledger.last_seq(self.data)
+        for site_name in sorted(changed):
+            cells = [[key[0], key[2], key[3], key[4]] + self.cells[key]
+                     for key in sorted(self._by_site.get(site_name, ()))]
+            blob = json.dumps({'site': site_name, 'generation': sites[site_name],
+                               'last_seq': last_seq, 'cells': cells})
+            _write_atomic(self._path(site_name), blob.encode('utf-8'))
+        for site_name in removed:
+            try:
+                os.remove(self._path(site_name))
+            except FileNotFoundError:
+                pass
+        _write_atomic(self._path(), json.dumps({'last_seq': last_seq, 'sites': sites}).encode('utf-8'))
+        self._dirty.clear()
+        self._saved = sites
+        return len(changed)
+
+    def _add_cell(self, key, values=None):
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = [0.0, 0.0, 0.0, 0]
+            self._by_site[key[1]].add(key)
+            self._by_item[key[1:4]].add(key)
+        if values:
+            cell[:] = values
+        return cell
+
+    def on_transaction(self, transaction):
+        """Add a receipt to its cell; other transactions are ignored"""
+        if transaction.get('type') != 'added':
+            return
+        quantity = _amount(transaction.get('quantity'))
+        if quantity is None:
+            return
+        site_name, category, item_name = transaction.get('site'), transaction.get('category'), transaction.get('item')
+        key = ((transaction.get('supplier') or '').strip() or UNSPECIFIED,
+               site_name, category, item_name, _month(transaction))
+        cell = self._add_cell(key)
+        self._dirty.add(site_name)
+        cell[0] += quantity
+        rate = _amount(transaction.get('rate'))
+        if rate is not None:
+            cell[1] += quantity * rate
+            cell[2] += quantity
+        cell[3] += 1
+
+    def forget_site(self, site_name):
+        for key in self._by_site.pop(site_name, ()):
+            del self.cells[key]
+            self._by_item.pop(key[1:4], None)
+        self._dirty.discard(site_name)
+
+    def _keys(self, site=None):
+        return self.cells.keys() if site is None else self._by_site.get(site, ())
+
+    def vendor_spend(self, site=None):
+        """Per-supplier totals, highest spend first"""
+        totals = {}
+        for key in self._keys(site):
+            quantity, spend, _, receipts = self.cells[key]
+            row = totals.setdefault(key[0], {'supplier': key[0], 'spend': 0.0, 'quantity': 0.0, 'receipts': 0,
+                                             'items': set(), 'last_month': key[4]})
+            row['spend'] += spend
+            row['quantity'] += quantity
+            row['receipts'] += receipts
+            row['items'].add(key[2:4])
+            row['last_month'] = max(row['last_month'], key[4])
+        rows = sorted(totals.values(), key=lambda r: (-r['spend'], r['supplier']))
+        for row in rows:
+            row['items'] = len(row['items'])
+        return rows
+
+    def monthly_spend(self, site=None):
+        """{(month, supplier): spend}"""
+        spend = collections.defaultdict(float)
+        for key in self._keys(site):
+            spend[(key[4], key[0])] += self.cells[key][1]
+        return dict(spend)
+
+    def priced_items(self, site):
+        """(category, item) keys of a site with at least one priced receipt"""
+        return sorted({key[2:4] for key in self._keys(site) if self.cells[key][2]})
+
+    def price_trend(self, site_name, category, item_name):
+        """Average purchase rate per month and supplier, oldest month first"""
+        rows = []
+        for key in self._by_item.get((site_name, category, item_name), ()):
+            quantity, spend, priced, receipts = self.cells[key]
+            if priced:
+                rows.append({'month': key[4], 'supplier': key[0], 'rate': spend / priced,
+                             'quantity': quantity, 'receipts': receipts})
+        return sorted(rows, key=lambda r: (r['month'], r['supplier']))
+
+    def __len__(self):
+        return len(self.cells)
@@ -0,0 +1,328 @@
+"""Read-only analytics snapshot in Arrow format.
+
+A background publisher turns the saved site shards into two columnar Arrow
+IPC files, one row per item and one row per transaction, and publishes them
+as an immutable generation::
+
+    analytics_snapshot/items-<gen>.arrow
+    analytics_snapshot/transactions-<gen>.arrow
+    analytics_snapshot/current.json          generation, time, last seq
+
+A new generation is written beside the old one and current.json is replaced
+atomically, so readers never see a half-written snapshot and writers never
+wait for readers.  Publishers in any process take a lock file in the
+snapshot directory to number and prune generations, so two never write the
+same generation and only generations older than the current one are
+removed.  Files are uncompressed, so any process opens them with
+a memory map and reads the columns zero-copy; the opened generation is
+cached per process.
+
+The publisher only re-reads the shards written since the last generation.
+Analytics pages read through current(), which falls back to building the
+same tables from the live data when nothing has been published yet.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # no flock: publishers are only serialized within a process
+    fcntl = None
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import storage
+import valuation
+from storage import CATEGORIES
+
+
+SNAPSHOT_DIR = "analytics_snapshot"
+CURRENT_FILE = "current.json"
+LOCK_FILE = "lock"
+INTERVAL = 30
+KEEP_GENERATIONS = 3
+
+ITEM_SCHEMA = pa.schema([
+    ('site', pa.string()),
+    ('category', pa.string()),
+    ('item', pa.string()),
+    ('code', pa.string()),
+    ('unit', pa.string()),
+    ('stock', pa.float64()),
+    ('used', pa.float64()),
+    ('min_stock', pa.float64()),
+    ('rate', pa.float64()),
+    ('value', pa.float64()),
+])
+TRANSACTION_SCHEMA = pa.schema([
+    ('seq', pa.int64()),
+    ('ts', pa.float64()),
+    ('type', pa.string()),
+    ('site', pa.string()),
+    ('from_site', pa.string()),
+    ('to_site', pa.string()),
+    ('category', pa.string()),
+    ('item', pa.string()),
+    ('quantity', pa.float64()),
+])
+
+_local_lock = threading.Lock()
+_opened_lock = threading.Lock()
+_opened = {}
+_publisher_lock = threading.Lock()
+_publishers = {}
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def items_table(site_name, site_info):
+    """Arrow table of one site's items"""
+    columns = {name: [] for name in ITEM_SCHEMA.names}
+    for category in CATEGORIES:
+        for item_name, item in site_info.get(category, {}).items():
+            stock = _number(item.get('stock')) or 0.0
+            rate = _number(item.get('rate')) or 0.0
+            columns['site'].append(site_name)
+            columns['category'].append(category)
+            columns['item'].append(item_name)
+            columns['code'].append(str(item.get('code', 'N/A')))
+            columns['unit'].append(item.get('unit', ''))
+            columns['stock'].append(stock)
+            columns['used'].append(_number(item.get('used')) or 0.0)
+            columns['min_stock'].append(_number(item.get('min_stock')) or 0.0)
+            columns['rate'].append(rate)
+            columns['value'].append(valuation.item_value(item))
+    return pa.table(columns, schema=ITEM_SCHEMA)
+
+
+def transactions_table(transactions):
+    """Arrow table of transactions with the columns analytics need"""
+    columns = {name: [] for name in TRANSACTION_SCHEMA.names}
+    for t in transactions:
+        columns['seq'].append(t.get('seq'))
+        columns['ts'].append(t.get('ts'))
+        columns['type'].append(t.get('type'))
+        columns['site'].append(t.get('site'))
+        columns['from_site'].append(t.get('from_site'))
+        columns['to_site'].append(t.get('to_site'))
+        columns['category'].append(t.get('category'))
+        columns['item'].append(t.get('item'))
+        columns['quantity'].append(_number(t.get('quantity')))
+    return pa.table(columns, schema=TRANSACTION_SCHEMA)
+
+
+class Snapshot:
+    """Items and transactions tables of one generation"""
+
+    def __init__(self, items, transactions, meta):
+        self.items = items
+        self.transactions = transactions
+        self.meta = meta
+
+    @property
+    def live(self):
+        return self.meta.get('generation') is None
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.meta['created_at']
+
+    def site_transaction_count(self, site_name):
+        return pc.sum(pc.equal(self.transactions['site'], site_name)).as_py() or 0
+
+
+def _from_live(data):
+    items = pa.concat_tables([items_table(site_name, site_info) for site_name, site_info in data['sites'].items()]
+                             or [ITEM_SCHEMA.empty_table()])
+    return Snapshot(items, transactions_table(data['transactions']), {
+        'generation': None,
+        'created_at': time.time(),
+        'last_seq': data['system_info'].get('last_seq', 0)
+    })
+
+
+def _read_table(path):
+    source = pa.memory_map(path, 'r')
+    return pa.ipc.open_file(source).read_all()
+
+
+def _read_meta(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def open_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """Latest published snapshot, memory-mapped, or None"""
+    # A generation can be pruned between reading current.json and opening
+    # its files when several newer ones are published meanwhile; read again.
+    for _ in range(3):
+        meta = _read_meta(snapshot_dir)
+        if meta is None:
+            return None
+        key = (os.path.abspath(snapshot_dir), meta['generation'])
+        with _opened_lock:
+            snapshot = _opened.get(key)
+            if snapshot is not None:
+                return snapshot
+            try:
+                snapshot = Snapshot(_read_table(os.path.join(snapshot_dir, meta['items'])),
+                                    _read_table(os.path.join(snapshot_dir, meta['transactions'])), meta)
+            except FileNotFoundError:
+                continue
+            for old in [k for k in _opened if k[0] == key[0]]:
+                del _opened[old]
+            _opened[key] = snapshot
+            return snapshot
+    return None
+
+
+def current(data, snapshot_dir=SNAPSHOT_DIR):
+    """Published snapshot, or tables built from the live data when there is none"""
+    return open_snapshot(snapshot_dir) or _from_live(data)
+
+
+def _write_table(table, path):
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _publishing(snapshot_dir):
+    """Exclusive lock on the snapshot directory across processes"""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    if fcntl is None:
+        with _local_lock:
+            yield
+        return
+    with open(os.path.join(snapshot_dir, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Publisher:
+    """Publishes new generations from the saved shards"""
+
+    def __init__(self, data_dir=storage.DATA_DIR, snapshot_dir=SNAPSHOT_DIR, interval=INTERVAL):
+        self.data_dir = data_dir
+        self.snapshot_dir = snapshot_dir
+        self.interval = interval
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _shard_tables(self, site_name, shards):
+        path = storage.shard_path(site_name, self.data_dir)
+        mtime = os.path.getmtime(path) if path else None
+        cached = self._shards.get(site_name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2], False
+
+        loaded = storage.load_site(site_name, self.data_dir)
+        site_info, transactions = loaded if loaded is not None else ({}, [])
+        # A transfer is stored in both shards; keep the sending site's copy.
+        own = [t for t in transactions
+               if not (t.get('type') == 'transfer' and t.get('from_site') != site_name
+                       and t.get('from_site') in shards)]
+        items, log = items_table(site_name, site_info), transactions_table(own)
+        self._shards[site_name] = (mtime, items, log)
+        return items, log, True
+
+    def publish_once(self, force=False):
+        """Publish a new generation if any shard changed; returns its metadata or None"""
+        with self._lock:
+            shards = storage.site_shards(self.data_dir)
+            changed = force or set(self._shards) != set(shards)
+            parts = []
+            for site_name in shards:
+                items, log, site_changed = self._shard_tables(site_name, shards)
+                parts.append((items, log))
+                changed = changed or site_changed
+            for site_name in [s for s in self._shards if s not in shards]:
+                del self._shards[site_name]
+            if not changed:
+                return None
+
+            items = pa.concat_tables([p[0] for p in parts] or [ITEM_SCHEMA.empty_table()]).combine_chunks()
+            log = pa.concat_tables([p[1] for p in parts] or [TRANSACTION_SCHEMA.empty_table()])
+            log = log.take(pc.sort_indices(log, sort_keys=[('seq', 'ascending')])).combine_chunks()
+
+            with _publishing(self.snapshot_dir):
+                previous = _read_meta(self.snapshot_dir)
+                generation = previous['generation'] + 1 if previous else 1
+                meta = {
+                    'generation': generation,
+                    'created_at': time.time(),
+                    'last_seq': pc.max(log['seq']).as_py() or 0 if len(log) else 0,
+                    'items': f"items-{generation}.arrow",
+                    'transactions': f"transactions-{generation}.arrow",
+                }
+                _write_table(items, os.path.join(self.snapshot_dir, meta['items']))
+                _write_table(log, os.path.join(self.snapshot_dir, meta['transactions']))
+                current_path = os.path.join(self.snapshot_dir, CURRENT_FILE)
+                tmp_path = f"{current_path}.tmp{os.getpid()}.{threading.get_ident()}"
+                with open(tmp_path, 'w', encoding="utf-8") as f:
+                    json.dump(meta, f)
+                os.replace(tmp_path, current_path)
+                self._prune(generation)
+            return meta
+
+    def _prune(self, generation):
+        """Remove generations older than the KEEP_GENERATIONS before generation (lock held)"""
+        for name in os.listdir(self.snapshot_dir):
+            prefix, _, rest = name.partition('-')
+            if prefix in ('items', 'transactions') and rest.endswith('.arrow'):
+                try:
+                    old = int(rest[:-len('.arrow')])
+                except ValueError:
+                    continue
+                if old <= generation - KEEP_GENERATIONS:
+                    try:
+                        os.remove(os.path.join(self.snapshot_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def request(self):
+        """Ask the background loop to publish soon"""
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="snapshot-publisher", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.publish_once()
+            except Exception as e:
+                print(f"Snapshot publisher error: {e}", file=sys.stderr)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+def start_publisher(data_dir=storage.DATA_DIR, snapshot_dir=SNAPSHOT_DIR):
+    """Start the background snapshot publisher (once per process and directory) and return it"""
+    key = (os.path.abspath(data_dir), os.path.abspath(snapshot_dir))
+    with _publisher_lock:
+        if key not in _publishers:
+            _publishers[key] = Publisher(data_dir, snapshot_dir)
+            _publishers[key].start()
+        return _publishers[key]
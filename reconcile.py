@@ -0,0 +1,199 @@
+"""Ledger reconciliation and integrity check.
+
+Replays the whole transaction log with pandas group-bys to rebuild the
+expected ``stock`` and ``used`` of every (site, category, item), then diffs
+that against the live inventory.
+
+Replay rules:
+
+* ``added``    - stock += quantity (a ``new_item`` receipt starts from 0)
+* ``used``     - stock -= quantity, used += quantity
+* ``transfer`` - stock -= quantity at from_site, += quantity at to_site
+  (a ``new_item`` transfer creates the item at to_site, starting from 0)
+* ``edited``   - stock is set to new_stock (and used to new_used when recorded)
+* ``deleted``  - the item is gone; stock and used restart from 0
+
+Items with no set-point (edit, delete, new-item receipt or transfer) in the
+log have an unknown opening balance, so their rows are marked
+``baseline = False`` and reported as ``untracked`` rather than compared,
+like items with no transactions at all.
+
+Usable from Settings or on the command line::
+
+    python reconcile.py [--data-dir multi_site_data] [--csv report.csv]
+
+The command exits with status 1 when stock or used mismatches are found.
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import storage
+
+
+KEY = ['site', 'category', 'item']
+_LOG_COLUMNS = ['seq', 'type', 'site', 'from_site', 'to_site', 'category', 'item',
+                'quantity', 'new_stock', 'new_used', 'new_item']
+
+STATUS_LABELS = {
+    'ok': '🟢 OK',
+    'stock_mismatch': '🔴 Stock Mismatch',
+    'used_mismatch': '🟠 Used Mismatch',
+    'missing_live': '🔴 Missing From Inventory',
+    'deleted_but_live': '🔴 Deleted But Still In Inventory',
+    'untracked': '⚪ No Opening Balance',
+}
+MISMATCH_STATUSES = ['stock_mismatch', 'used_mismatch', 'missing_live', 'deleted_but_live']
+
+
+def _events(transactions):
+    """One row per (transaction, site) with stock/used deltas and set-points"""
+    log = pd.DataFrame.from_records(transactions, columns=_LOG_COLUMNS)
+    quantity = pd.to_numeric(log['quantity'], errors='coerce').fillna(0)
+    kind = log['type']
+
+    transfers = kind == 'transfer'
+    outgoing = log.loc[transfers, ['seq', 'from_site', 'category', 'item']].rename(columns={'from_site': 'site'})
+    outgoing['d_stock'] = -quantity[transfers]
+    incoming = log.loc[transfers, ['seq', 'to_site', 'category', 'item']].rename(columns={'to_site': 'site'})
+    incoming['d_stock'] = quantity[transfers]
+    for frame in (outgoing, incoming):
+        frame['d_used'] = 0.0
+        frame['kind'] = 'transfer'
+        frame['stock_set'] = np.nan
+        frame['used_set'] = np.nan
+    # The destination item was created by the transfer, like a new-item receipt
+    arrived = log.loc[transfers, 'new_item'].fillna(False).astype(bool)
+    incoming.loc[arrived, ['stock_set', 'used_set']] = 0.0
+
+    local = log.loc[~transfers, ['seq', 'site', 'category', 'item']].copy()
+    local_kind = kind[~transfers]
+    local_quantity = quantity[~transfers]
+    local['kind'] = local_kind
+    local['d_stock'] = np.select([local_kind == 'added', local_kind == 'used'],
+                                 [local_quantity, -local_quantity], 0.0)
+    local['d_used'] = np.where(local_kind == 'used', local_quantity, 0.0)
+
+    new_stock = pd.to_numeric(log.loc[~transfers, 'new_stock'], errors='coerce')
+    new_used = pd.to_numeric(log.loc[~transfers, 'new_used'], errors='coerce')
+    created = (local_kind == 'added') & log.loc[~transfers, 'new_item'].fillna(False).astype(bool)
+    edited = local_kind == 'edited'
+    deleted = local_kind == 'deleted'
+
+    # A set-point fixes the value *before* the row's own delta is applied.
+    local['stock_set'] = np.select([edited, deleted | created], [new_stock, 0.0], np.nan)
+    local['used_set'] = np.select([edited & new_used.notna(), deleted | created], [new_used, 0.0], np.nan)
+
+    events = pd.concat([local, outgoing, incoming], ignore_index=True)
+    return events.dropna(subset=KEY)
+
+
+def _replay(events, value, delta):
+    """Expected value per key: last set-point plus the deltas after it"""
+    points = events.loc[events[value].notna(), KEY + ['seq', value]]
+    last_point = points.sort_values('seq').groupby(KEY, sort=False).tail(1)
+    last_point = last_point.rename(columns={'seq': 'set_seq', value: 'base'})
+
+    merged = events[KEY + ['seq', delta]].merge(last_point, on=KEY, how='left')
+    after = merged['set_seq'].isna() | (merged['seq'] >= merged['set_seq'])
+    totals = merged[after].groupby(KEY, sort=False).agg(
+        delta=(delta, 'sum'), base=('base', 'first'))
+    return totals['base'].fillna(0) + totals['delta'], totals['base'].notna()
+
+
+def expected_state(transactions):
+    """DataFrame of expected stock/used per key rebuilt from the log"""
+    if not transactions:
+        return pd.DataFrame(columns=KEY + ['expected_stock', 'expected_used', 'baseline', 'deleted'])
+    events = _events(transactions)
+    stock, stock_baseline = _replay(events, 'stock_set', 'd_stock')
+    used, _ = _replay(events, 'used_set', 'd_used')
+    last_kind = events.sort_values('seq', kind='stable').groupby(KEY, sort=False)['kind'].last()
+
+    expected = pd.DataFrame({
+        'expected_stock': stock,
+        'expected_used': used,
+        'baseline': stock_baseline,
+        'deleted': last_kind == 'deleted',
+    })
+    return expected.reset_index()
+
+
+def live_state(data):
+    """DataFrame of the live stock/used per key"""
+    rows = [(site_name, category, item_name, item.get('stock', 0), item.get('used', 0))
+            for site_name, site_info in data['sites'].items()
+            for category in storage.CATEGORIES
+            for item_name, item in site_info.get(category, {}).items()]
+    return pd.DataFrame(rows, columns=KEY + ['stock', 'used'])
+
+
+def reconcile(data, tolerance=1e-6):
+    """Full reconciliation report, one row per key seen in the log or the inventory"""
+    expected = expected_state(data['transactions'])
+    live = live_state(data)
+    report = expected.merge(live, on=KEY, how='outer', indicator=True)
+
+    in_live = report['_merge'] != 'left_only'
+    in_log = report['_merge'] != 'right_only'
+    deleted = report['deleted'].fillna(False).astype(bool)
+    baseline = report['baseline'].fillna(False).astype(bool)
+    stock_diff = report['stock'].fillna(0) - report['expected_stock'].fillna(0)
+    used_diff = report['used'].fillna(0) - report['expected_used'].fillna(0)
+
+    report['stock_diff'] = stock_diff
+    report['used_diff'] = used_diff
+    report['status'] = np.select(
+        [~in_log,
+         in_log & ~in_live & ~deleted,
+         in_live & deleted,
+         in_live & ~baseline,
+         in_live & (stock_diff.abs() > tolerance),
+         in_live & (used_diff.abs() > tolerance)],
+        ['untracked', 'missing_live', 'deleted_but_live', 'untracked', 'stock_mismatch', 'used_mismatch'],
+        'ok')
+    report['baseline'] = baseline
+
+    # Items deleted and never re-added are consistent, nothing to report.
+    report = report[in_live | ~deleted]
+    columns = KEY + ['stock', 'expected_stock', 'stock_diff', 'used', 'expected_used', 'used_diff',
+                     'baseline', 'status']
+    return report[columns].sort_values(KEY, ignore_index=True)
+
+
+def summarize(report):
+    """Count of report rows per status"""
+    return report['status'].value_counts().reindex(list(STATUS_LABELS), fill_value=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile inventory against the transaction log")
+    parser.add_argument("--data-dir", default=storage.DATA_DIR, help="sharded data directory")
+    parser.add_argument("--csv", help="write the full report to this CSV file")
+    parser.add_argument("--all", action="store_true", help="print every row, not only mismatches")
+    args = parser.parse_args(argv)
+
+    data = storage.load_data(args.data_dir)
+    if data is None:
+        print(f"No data found in {args.data_dir}", file=sys.stderr)
+        return 2
+
+    report = reconcile(data)
+    if args.csv:
+        report.to_csv(args.csv, index=False)
+
+    for status, count in summarize(report).items():
+        print(f"{STATUS_LABELS[status]}: {count}")
+
+    shown = report if args.all else report[report['status'].isin(MISMATCH_STATUSES)]
+    if not shown.empty:
+        print()
+        print(shown.to_string(index=False))
+
+    return 1 if report['status'].isin(MISMATCH_STATUSES).any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Version-keyed LRU cache for prepared per-site views.
+
+Views that turn a site's items into DataFrames and metrics store the result
+under ``(view, site, version)``.  Because every inventory operation bumps
+the site's version (see inventory.site_version), a cached entry is reused
+until that site changes and is then simply never asked for again; stale
+entries fall out through LRU eviction once the memory cap is reached.
+"""
+import collections
+import sys
+
+import pandas as pd
+
+
+MAX_BYTES = 32 * 1024 * 1024
+
+
+def _sizeof(value):
+    """Approximate memory held by a cached value"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_sizeof(k) + _sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class RenderCache:
+    """LRU mapping of (view, site, version) -> prepared value, capped by size"""
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, view, site_name, version, build):
+        """Cached value for the key, calling build() and storing it on a miss"""
+        key = (view, site_name, version)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        value = build()
+        size = _sizeof(value)
+        if size <= self.max_bytes:
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+        return value
+
+    def forget_site(self, site_name):
+        for key in [k for k in self._entries if k[1] == site_name]:
+            self.bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,360 @@
+"""Precomputed per-site reports.
+
+A background scheduler builds a daily and a weekly Excel report for every
+site and keeps the latest one in a cache directory, so the Reports page can
+serve it immediately instead of building it while the user waits::
+
+    reports_cache/<shard>/daily.xlsx    daily.json
+    reports_cache/<shard>/weekly.xlsx   weekly.json
+
+Each workbook has a Summary sheet and one sheet each for stock valuation,
+consumption and transfers over the period (the last 1 or 7 days).  The JSON
+file next to it holds the summary figures and when the report was generated.
+
+Jobs read a site's shard straight from the data directory, never the live
+in-memory data, and run in parallel across sites on a worker pool.  A report
+is rebuilt when its shard has been written since, or when it is older than
+the period's MAX_AGE.  On the command line::
+
+    python reports.py [--data-dir multi_site_data] [--workers 4] [--processes] [--force]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import ledger
+import storage
+from storage import CATEGORIES
+from valuation import average_cost, item_value
+
+
+REPORT_DIR = "reports_cache"
+PERIODS = {'daily': 1, 'weekly': 7}
+MAX_AGE = {'daily': 3600, 'weekly': 6 * 3600}
+WORKERS = 4
+INTERVAL = 300
+
+_scheduler_lock = threading.Lock()
+_schedulers = {}
+
+
+def _paths(site_name, period, report_dir):
+    base = os.path.join(report_dir, storage.shard_id(site_name), period)
+    return base + ".xlsx", base + ".json"
+
+
+def _write_atomic(path, blob):
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def _valuation(site_info):
+    rows = [{
+        'Category': category.title(),
+        'Item': item_name.replace('_', ' ').title(),
+        'Code': item.get('code', 'N/A'),
+        'Stock': item['stock'],
+        'Unit': item['unit'],
+        'Min Stock': item.get('min_stock', 0),
+        'Rate (₹)': item.get('rate', 0),
+        'Avg Cost (₹)': average_cost(item),
+        'Value (₹)': item_value(item)
+    } for category in CATEGORIES for item_name, item in site_info.get(category, {}).items()]
+    return pd.DataFrame(rows, columns=['Category', 'Item', 'Code', 'Stock', 'Unit', 'Min Stock',
+                                       'Rate (₹)', 'Avg Cost (₹)', 'Value (₹)'])
+
+
+def _consumption(site_info, transactions):
+    rows = []
+    for t in transactions:
+        if t.get('type') != 'used':
+            continue
+        item = site_info.get(t['category'], {}).get(t['item'], {})
+        rows.append({
+            'Category': t['category'].title(),
+            'Item': t['item'].replace('_', ' ').title(),
+            'Unit': item.get('unit', ''),
+            'Quantity': t['quantity'],
+            'Value (₹)': t['value'] if 'value' in t else t['quantity'] * item.get('rate', 0),
+            'Work Areas': t.get('work_area', '')
+        })
+    columns = ['Category', 'Item', 'Unit', 'Quantity', 'Value (₹)', 'Issues', 'Work Areas']
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    df = pd.DataFrame(rows)
+    grouped = df.groupby(['Category', 'Item', 'Unit'], as_index=False).agg(**{
+        'Quantity': ('Quantity', 'sum'),
+        'Value (₹)': ('Value (₹)', 'sum'),
+        'Issues': ('Quantity', 'size'),
+        'Work Areas': ('Work Areas', lambda areas: ", ".join(sorted(set(areas) - {''})))
+    })
+    return grouped[columns].sort_values('Value (₹)', ascending=False, ignore_index=True)
+
+
+def _transfers(site_name, transactions):
+    rows = [{
+        'Seq': t['seq'],
+        'Date': ledger.format_time(t),
+        'Direction': 'Out' if t['from_site'] == site_name else 'In',
+        'Other Site': t['to_site'] if t['from_site'] == site_name else t['from_site'],
+        'Category': t['category'].title(),
+        'Item': t['item'].replace('_', ' ').title(),
+        'Quantity': t['quantity'],
+        'Authorized By': t.get('authorized_by', ''),
+        'Driver': t.get('driver_name', ''),
+        'Vehicle': t.get('vehicle_number', '')
+    } for t in transactions if t.get('type') == 'transfer']
+    return pd.DataFrame(rows, columns=['Seq', 'Date', 'Direction', 'Other Site', 'Category', 'Item',
+                                       'Quantity', 'Authorized By', 'Driver', 'Vehicle'])
+
+
+def _build(site_name, period, site_info, transactions, source_mtime, report_dir, end_ts):
+    start_ts = end_ts - PERIODS[period] * 86400
+    window = ledger.transactions_between(transactions, start_ts, end_ts)
+
+    valuation = _valuation(site_info)
+    consumption = _consumption(site_info, window)
+    transfers = _transfers(site_name, window)
+    summary = {
+        'items': len(valuation),
+        'stock_value': float(valuation['Value (₹)'].sum()),
+        'below_min': int((valuation['Stock'] <= valuation['Min Stock']).sum()),
+        'transactions': len(window),
+        'consumed_value': float(consumption['Value (₹)'].sum()),
+        'transfers_in': int((transfers['Direction'] == 'In').sum()),
+        'transfers_out': int((transfers['Direction'] == 'Out').sum())
+    }
+    meta = {
+        'site': site_name,
+        'period': period,
+        'start_ts': start_ts,
+        'end_ts': end_ts,
+        'generated_at': time.time(),
+        'source_mtime': source_mtime,
+        'last_seq': transactions[-1]['seq'] if transactions else 0,
+        'summary': summary
+    }
+
+    summary_df = pd.DataFrame([
+        ('Site', site_name),
+        ('Period', f"{datetime.datetime.fromtimestamp(start_ts):%Y-%m-%d %H:%M} to "
+                   f"{datetime.datetime.fromtimestamp(end_ts):%Y-%m-%d %H:%M}"),
+        ('Items', summary['items']),
+        ('Stock Value (₹)', round(summary['stock_value'], 2)),
+        ('Items At Or Below Minimum', summary['below_min']),
+        ('Transactions', summary['transactions']),
+        ('Consumption Value (₹)', round(summary['consumed_value'], 2)),
+        ('Transfers In', summary['transfers_in']),
+        ('Transfers Out', summary['transfers_out'])
+    ], columns=['Metric', 'Value'])
+    summary_df['Value'] = summary_df['Value'].astype(str)
+
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        summary_df.to_excel(writer, sheet_name='Summary', index=False)
+        valuation.to_excel(writer, sheet_name='Stock Valuation', index=False)
+        consumption.to_excel(writer, sheet_name='Consumption', index=False)
+        transfers.to_excel(writer, sheet_name='Transfers', index=False)
+
+    xlsx_path, meta_path = _paths(site_name, period, report_dir)
+    os.makedirs(os.path.dirname(xlsx_path), exist_ok=True)
+    _write_atomic(xlsx_path, buffer.getvalue())
+    _write_atomic(meta_path, json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+    return meta
+
+
+def build_reports(site_name, periods=tuple(PERIODS), data_dir=storage.DATA_DIR, report_dir=REPORT_DIR, now=None):
+    """Build a site's reports for the given periods from one read of its shard.
+
+    Returns the metadata of each report written.
+    """
+    source = storage.shard_path(site_name, data_dir)
+    source_mtime = os.path.getmtime(source) if source else None
+    loaded = storage.load_site(site_name, data_dir)
+    if loaded is None:
+        raise KeyError(f"No data for site '{site_name}' in {data_dir}")
+    site_info, transactions = loaded
+    end_ts = time.time() if now is None else now
+    return [_build(site_name, period, site_info, transactions, source_mtime, report_dir, end_ts)
+            for period in periods]
+
+
+def latest_report(site_name, period, report_dir=REPORT_DIR):
+    """(metadata, workbook path) of the cached report, or (None, None)"""
+    xlsx_path, meta_path = _paths(site_name, period, report_dir)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f), xlsx_path
+    except (OSError, ValueError):
+        return None, None
+
+
+def is_due(site_name, period, data_dir=storage.DATA_DIR, report_dir=REPORT_DIR, now=None):
+    """Whether the cached report is missing, older than its shard or past MAX_AGE"""
+    meta, _ = latest_report(site_name, period, report_dir)
+    if meta is None:
+        return True
+    now = time.time() if now is None else now
+    source = storage.shard_path(site_name, data_dir)
+    source_mtime = os.path.getmtime(source) if source else None
+    return source_mtime != meta['source_mtime'] or now - meta['generated_at'] >= MAX_AGE[period]
+
+
+def freshness(meta, now=None):
+    """Age of a report as display text, e.g. '12 min ago'"""
+    age = (time.time() if now is None else now) - meta['generated_at']
+    if age < 60:
+        return "just now"
+    if age < 3600:
+        return f"{int(age // 60)} min ago"
+    if age < 86400:
+        return f"{int(age // 3600)} h ago"
+    return f"{int(age // 86400)} days ago"
+
+
+class ReportScheduler:
+    """Rebuilds due reports on a worker pool, one job per site"""
+
+    def __init__(self, data_dir=storage.DATA_DIR, report_dir=REPORT_DIR, workers=WORKERS,
+                 interval=INTERVAL, processes=False):
+        self.data_dir = data_dir
+        self.report_dir = report_dir
+        self.interval = interval
+        pool = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+        self._pool = pool(max_workers=workers)
+        self._lock = threading.RLock()
+        self._running = {}
+        # Sites saved again while a build of theirs was running
+        self._changed = set()
+        self._wake = threading.Event()
+        self._thread = None
+        self.errors = {}
+
+    def submit(self, site_name, periods=tuple(PERIODS)):
+        """Queue a build of a site's reports unless one covering periods is already running"""
+        periods = tuple(periods)
+        with self._lock:
+            for (running_site, running_periods), future in self._running.items():
+                if running_site == site_name and set(periods) <= set(running_periods):
+                    return future
+            future = self._pool.submit(build_reports, site_name, periods, self.data_dir, self.report_dir)
+            key = (site_name, periods)
+            self._running[key] = future
+            future.add_done_callback(lambda f, key=key: self._done(key, f))
+            return future
+
+    def _done(self, key, future):
+        site_name = key[0]
+        with self._lock:
+            self._running.pop(key, None)
+            error = future.exception()
+            if error is None:
+                self.errors.pop(site_name, None)
+            else:
+                self.errors[site_name] = str(error)
+                print(f"Reports for {site_name} failed: {error}", file=sys.stderr)
+            if site_name in self._changed and not self._building(site_name):
+                self._changed.discard(site_name)
+                try:
+                    self.submit(site_name)
+                except RuntimeError:
+                    pass  # the pool was shut down, e.g. at interpreter exit
+
+    def _building(self, site_name):
+        return any(running_site == site_name for running_site, _ in self._running)
+
+    def run_once(self, force=False):
+        """Build every due report and wait for them.
+
+        Returns (metadata of the reports built, {site: error}).
+        """
+        futures = {}
+        for site_name in storage.site_shards(self.data_dir):
+            due = [period for period in PERIODS
+                   if force or is_due(site_name, period, self.data_dir, self.report_dir)]
+            if due:
+                futures[site_name] = self.submit(site_name, due)
+        concurrent.futures.wait(futures.values())
+        built = [meta for f in futures.values() if f.exception() is None for meta in f.result()]
+        failed = {site_name: str(f.exception()) for site_name, f in futures.items() if f.exception() is not None}
+        return built, failed
+
+    def pending(self):
+        """Sites with a build running"""
+        with self._lock:
+            return sorted({site_name for site_name, _ in self._running})
+
+    def refresh(self, *sites):
+        """Rebuild the reports of sites just saved, or wake the loop for a full check.
+
+        A build already running may have read the shard before the save, so
+        the site is built again once it is done.
+        """
+        if not sites:
+            self._wake.set()
+            return
+        with self._lock:
+            for site_name in sites:
+                if self._building(site_name):
+                    self._changed.add(site_name)
+                else:
+                    self.submit(site_name)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="report-scheduler", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Report scheduler error: {e}", file=sys.stderr)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+
+def start_scheduler(data_dir=storage.DATA_DIR, report_dir=REPORT_DIR):
+    """Start the background report scheduler (once per process and directory) and return it"""
+    key = (os.path.abspath(data_dir), os.path.abspath(report_dir))
+    with _scheduler_lock:
+        if key not in _schedulers:
+            _schedulers[key] = ReportScheduler(data_dir, report_dir)
+            _schedulers[key].start()
+        return _schedulers[key]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the per-site daily and weekly reports")
+    parser.add_argument("--data-dir", default=storage.DATA_DIR, help="sharded data directory")
+    parser.add_argument("--report-dir", default=REPORT_DIR)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--processes", action="store_true", help="use a process pool instead of threads")
+    parser.add_argument("--force", action="store_true", help="rebuild reports that are not due")
+    args = parser.parse_args(argv)
+
+    scheduler = ReportScheduler(args.data_dir, args.report_dir, args.workers, processes=args.processes)
+    started = time.perf_counter()
+    built, failed = scheduler.run_once(force=args.force)
+    for meta in built:
+        print(f"{meta['site']} ({meta['period']}): ₹{meta['summary']['stock_value']:,.0f} stock, "
+              f"{meta['summary']['transactions']} transactions")
+    for site_name, error in failed.items():
+        print(f"{site_name} failed: {error}", file=sys.stderr)
+    print(f"Built {len(built)} reports in {time.perf_counter() - started:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
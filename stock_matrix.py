@@ -0,0 +1,112 @@
+"""Item x site stock matrix.
+
+All items of all sites are loaded once into a single columnar frame (one row
+per site and item) together with per-item totals.  The result depends only on
+the data version (see inventory.data_version), so the app caches it and each
+rerun only filters and sorts the item totals and pivots the rows on screen.
+
+Layers:
+
+* ``stock``     - stock on hand
+* ``value``     - running cost of the stock (see valuation)
+* ``shortfall`` - how far stock is below min_stock (0 when at or above)
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import valuation
+from storage import CATEGORIES
+
+
+KEY = ['category', 'item']
+LAYERS = {'stock': 'Stock', 'value': 'Value (₹)', 'shortfall': 'Shortfall vs Min'}
+SORTS = {
+    'value': 'Total Value',
+    'stock': 'Total Stock',
+    'shortfall': 'Total Shortfall',
+    'sites_short': 'Sites Below Min',
+    'sites': 'Sites Stocking',
+    'item': 'Item Name',
+}
+
+
+def items_frame(data):
+    """One row per (site, category, item), built column by column"""
+    columns = {name: [] for name in ('site', 'category', 'item', 'unit', 'stock', 'min_stock', 'value')}
+    for site_name, site_info in data['sites'].items():
+        for category in CATEGORIES:
+            items = site_info.get(category, {})
+            if not items:
+                continue
+            values = items.values()
+            columns['site'].extend(itertools.repeat(site_name, len(items)))
+            columns['category'].extend(itertools.repeat(category, len(items)))
+            columns['item'].extend(items)
+            columns['unit'].extend(item['unit'] for item in values)
+            columns['stock'].extend(item['stock'] for item in values)
+            columns['min_stock'].extend(item.get('min_stock', 0) for item in values)
+            columns['value'].extend(valuation.item_value(item) for item in values)
+
+    frame = pd.DataFrame(columns)
+    frame['site'] = pd.Categorical(frame['site'], categories=list(data['sites']))
+    for column in ('category', 'item', 'unit'):
+        # object first: with no items an empty column would get float categories
+        frame[column] = frame[column].astype(object).astype('category')
+    for column in ('stock', 'min_stock', 'value'):
+        frame[column] = pd.to_numeric(frame[column], errors='coerce').fillna(0).astype(float)
+    frame['shortfall'] = (frame['min_stock'] - frame['stock']).clip(lower=0)
+    frame['below_min'] = frame['shortfall'] > 0
+    return frame
+
+
+def prepare(data):
+    """Columnar frame plus per-item totals; cache this per data version"""
+    frame = items_frame(data)
+    grouped = frame.groupby(KEY, sort=True, observed=True)
+    frame['item_id'] = grouped.ngroup()
+    totals = grouped.agg(
+        unit=('unit', 'first'),
+        stock=('stock', 'sum'),
+        value=('value', 'sum'),
+        shortfall=('shortfall', 'sum'),
+        sites=('site', 'size'),
+        sites_short=('below_min', 'sum')
+    ).reset_index()
+    return {'frame': frame, 'totals': totals, 'sites': list(data['sites'])}
+
+
+def select(prepared, category=None, search='', sort='value', descending=True, limit=200):
+    """Per-item totals matching the filters, sorted, at most limit rows"""
+    totals = prepared['totals']
+    mask = np.ones(len(totals), dtype=bool)
+    if category:
+        mask &= (totals['category'] == category).to_numpy()
+    if search:
+        mask &= totals['item'].str.contains(search.lower().replace(' ', '_'), case=False, regex=False).to_numpy()
+    selected = totals[mask]
+    if sort == 'item':
+        selected = selected.sort_values('item', ascending=not descending, kind='stable')
+    else:
+        selected = selected.sort_values([sort, 'item'], ascending=[not descending, True], kind='stable')
+    return selected.head(limit) if limit else selected
+
+
+def pivot(prepared, selected, layer):
+    """Matrix of one layer: a row per selected item, a column per site, with totals"""
+    frame = prepared['frame']
+    ids = selected.index.to_numpy()
+    rows = frame[np.isin(frame['item_id'].to_numpy(), ids)]
+
+    matrix = rows.pivot(index='item_id', columns='site', values=layer)
+    matrix = matrix.reindex(index=ids, columns=prepared['sites'])
+    matrix.columns = list(matrix.columns)
+    matrix.index = pd.MultiIndex.from_arrays(
+        [selected['category'].str.title(), selected['item'].str.replace('_', ' ').str.title()],
+        names=['Category', 'Item'])
+    matrix['Total'] = selected[layer].to_numpy()
+
+    total_row = matrix.sum(axis=0, skipna=True).to_frame().T
+    total_row.index = pd.MultiIndex.from_tuples([('Total', 'All Items Shown')], names=matrix.index.names)
+    return pd.concat([matrix, total_row])
@@ -0,0 +1,269 @@
+"""Offline capture queue and idempotent batched sync.
+
+A device that loses connectivity keeps recording into a local outbox: a
+JSON-lines file with one operation per line.  Each record carries a
+``request_id`` generated on the device and the ``captured_at`` time::
+
+    {"op": "use", "request_id": "…", "captured_at": "2025-11-04T16:15:30",
+     "site": "…", "category": "materials", "item": "…", "quantity": 5,
+     "work_area": "…", "supervisor": "…", "purpose": "Construction"}
+
+When the device is back online the whole outbox is applied as one batch,
+either through ``POST /sync`` on the local API, the importer on the Use Items
+page, or the command line::
+
+    python sync.py push  outbox.jsonl [--host 127.0.0.1] [--port 8765]
+    python sync.py import outbox.jsonl [--data-dir multi_site_data]
+
+Every record gets one of these statuses:
+
+* ``applied``   - applied now
+* ``duplicate`` - its request_id was applied before; skipped
+* ``conflict``  - valid but cannot be applied (e.g. insufficient stock)
+* ``invalid``   - missing fields or unknown operation
+
+Duplicates are found through a request_id index of the ledger.  Writers
+build or catch it up under the change feed's write lock, so it holds every
+record any replica saved; a sync then costs time proportional to the batch,
+not to the history.  A batch is atomic: an unexpected error in one record
+makes it ``invalid`` without stopping the others, and when the batch cannot
+be saved undo_batch() takes all of it back, so the client can resend it.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import uuid
+
+import change_feed
+import inventory
+import storage
+import valuation
+
+
+APPLIED_STATUSES = ('applied', 'duplicate')
+
+
+def request_index(transactions):
+    """Map of request_id -> seq for every transaction that has one"""
+    return {t['request_id']: t['seq'] for t in transactions if t.get('request_id')}
+
+
+def new_record(op, **fields):
+    """Outbox record for an operation, stamped with a fresh request_id"""
+    return {
+        'op': op,
+        'request_id': str(uuid.uuid4()),
+        'captured_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        **fields
+    }
+
+
+def parse_outbox(raw):
+    """Records from outbox content: JSON lines, a JSON list, or {"records": [...]}"""
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    text = raw.strip()
+    if not text:
+        return []
+    if text.startswith('[') or text.startswith('{"records"'):
+        parsed = json.loads(text)
+        return parsed['records'] if isinstance(parsed, dict) else parsed
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _run(data, operation):
+    op = operation.get('op')
+    request_id = operation['request_id']
+    if op == 'add':
+        item_exists = operation['item'] in data['sites'].get(operation['site'], {}).get(operation['category'], {})
+        new_item = None
+        if not item_exists and operation.get('unit'):
+            new_item = {k: operation[k] for k in ('unit', 'min_stock', 'rate', 'code') if k in operation}
+        return inventory.receive(
+            data, operation['site'], operation['category'], operation['item'], operation['quantity'],
+            operation.get('received_by', 'Offline Sync'), supplier=operation.get('supplier', ''),
+            new_item=new_item, request_id=request_id, invoice_number=operation.get('invoice_number', ''),
+            purchase_date=operation.get('purchase_date'), rate=operation.get('rate'), notes=operation.get('notes', ''))
+    if op == 'use':
+        return inventory.consume(
+            data, operation['site'], operation['category'], operation['item'], operation['quantity'],
+            operation['work_area'], operation['supervisor'], operation.get('purpose', 'Construction'),
+            request_id=request_id)
+    if op == 'transfer':
+        return inventory.transfer(
+            data, operation['from_site'], operation['to_site'], operation['category'], operation['item'],
+            operation['quantity'], operation['authorized_by'], operation['driver_name'],
+            operation.get('vehicle_number', ''), request_id=request_id)
+    raise KeyError(f"unknown operation '{op}'")
+
+
+def apply_operation(data, operation, applied):
+    """Apply one record; returns (result, transaction or None) and updates applied"""
+    request_id = operation.get('request_id') if isinstance(operation, dict) else None
+    result = {'request_id': request_id}
+    if not request_id:
+        return {**result, 'status': 'invalid', 'error': "request_id is required"}, None
+    if request_id in applied:
+        return {**result, 'status': 'duplicate', 'seq': applied[request_id]}, None
+
+    try:
+        transaction = _run(data, operation)
+    except inventory.InventoryError as e:
+        return {**result, 'status': 'conflict', 'error': str(e)}, None
+    except (KeyError, TypeError) as e:
+        return {**result, 'status': 'invalid', 'error': f"Invalid operation: {e}"}, None
+    except Exception as e:
+        return {**result, 'status': 'invalid', 'error': f"Could not apply operation: {e}"}, None
+
+    if operation.get('captured_at'):
+        transaction['captured_at'] = operation['captured_at']
+    applied[request_id] = transaction['seq']
+    return {**result, 'status': 'applied', 'seq': transaction['seq']}, transaction
+
+
+def apply_batch(data, operations, applied):
+    """Apply records in order; returns (results, applied transactions)"""
+    results = []
+    transactions = []
+    for operation in operations:
+        result, transaction = apply_operation(data, operation, applied)
+        results.append(result)
+        if transaction is not None:
+            transactions.append(transaction)
+    return results, transactions
+
+
+def _take_back(data, site_name, category, item_name, stock, used, value, created):
+    items = data['sites'][site_name][category]
+    if created:
+        items.pop(item_name, None)
+        return
+    item = items[item_name]
+    item['value'] = valuation.item_value(item) + value
+    item['stock'] += stock
+    item['used'] = item.get('used', 0) + used
+
+
+def undo_batch(data, transactions, applied):
+    """Take back what apply_batch() applied, e.g. when it could not be saved.
+
+    transactions must still be the last ones in the log.
+    """
+    if not transactions:
+        return
+    for transaction in reversed(transactions):
+        category, item_name = transaction['category'], transaction['item']
+        quantity, value = transaction['quantity'], transaction.get('value', 0)
+        if transaction['type'] == 'transfer':
+            _take_back(data, transaction['to_site'], category, item_name, -quantity, 0, -value,
+                       transaction.get('new_item'))
+            _take_back(data, transaction['from_site'], category, item_name, quantity, 0, value, False)
+        elif transaction['type'] == 'used':
+            _take_back(data, transaction['site'], category, item_name, quantity, -quantity, value, False)
+        else:
+            _take_back(data, transaction['site'], category, item_name, -quantity, 0, -value,
+                       transaction.get('new_item'))
+        inventory.bump_versions(data, transaction)
+        applied.pop(transaction.get('request_id'), None)
+    del data['transactions'][-len(transactions):]
+    data['system_info']['last_seq'] = transactions[0]['seq'] - 1
+
+
+def touched_sites(transactions):
+    return sorted({site for t in transactions for site in inventory.touched_sites(t)})
+
+
+class Outbox:
+    """Device-side queue of records waiting to be synced"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, op, **fields):
+        """Queue an operation and return its record"""
+        record = new_record(op, **fields)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return record
+
+    def pending(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            return parse_outbox(f.read())
+
+    def push(self, client):
+        """Send every pending record in one /sync call.
+
+        Applied and duplicate records leave the outbox; conflicts and invalid
+        records move to ``<path>.rejected.jsonl`` with their error.
+        """
+        records = self.pending()
+        if not records:
+            return []
+        status, body = client.post('/sync', {'records': records})
+        if status != 200:
+            raise RuntimeError(body.get('error', f"Sync failed with HTTP {status}"))
+
+        results = body['results']
+        rejected = [{**record, 'error': result.get('error'), 'status': result['status']}
+                    for record, result in zip(records, results) if result['status'] not in APPLIED_STATUSES]
+        if rejected:
+            with open(self.path + '.rejected.jsonl', 'a', encoding='utf-8') as f:
+                for record in rejected:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        # Keep anything queued while the request was in flight.
+        remaining = self.pending()[len(records):]
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for record in remaining:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return results
+
+
+def _print_results(results):
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if result['status'] not in APPLIED_STATUSES:
+            print(f"{result['status']}: {result.get('request_id')}: {result.get('error')}")
+    print(", ".join(f"{status}: {count}" for status, count in counts.items()) or "Nothing to sync")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync an offline outbox")
+    sub = parser.add_subparsers(dest="command", required=True)
+    push = sub.add_parser("push", help="send the outbox to the local API")
+    push.add_argument("outbox")
+    push.add_argument("--host", default="127.0.0.1")
+    push.add_argument("--port", type=int, default=8765)
+    direct = sub.add_parser("import", help="apply the outbox directly to the data directory")
+    direct.add_argument("outbox")
+    direct.add_argument("--data-dir", default=storage.DATA_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "push":
+        import api
+        client = api.Client(args.host, args.port)
+        try:
+            results = Outbox(args.outbox).push(client)
+        finally:
+            client.close()
+    else:
+        feed = change_feed.ChangeFeed(args.data_dir)
+        data = feed.load()
+        if data is None:
+            print(f"No data found in {args.data_dir}", file=sys.stderr)
+            return 2
+        with feed.writing(data):
+            results, transactions = apply_batch(data, Outbox(args.outbox).pending(), request_index(data['transactions']))
+            if transactions:
+                feed.save(data, touched_sites(transactions))
+
+    _print_results(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
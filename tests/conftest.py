@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def _in_tmp_path(tmp_path, monkeypatch):
+    """Run every test in its own directory; modules write to relative paths"""
+    monkeypatch.chdir(tmp_path)
+
+
+def make_data(*site_names):
+    """Empty data dict with the given sites"""
+    return {
+        'sites': {name: {'location': 'Pune', 'materials': {}, 'tools and accessories': {}, 'machines': {}}
+                  for name in site_names},
+        'transactions': [],
+        'system_info': {'total_sites': len(site_names)},
+    }
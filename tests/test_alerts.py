@@ -0,0 +1,92 @@
+import time
+
+import alerts
+import inventory
+from conftest import make_data
+
+
+def stocked_data(stock=1000, min_stock=5):
+    data = make_data('Site A')
+    data['sites']['Site A']['materials']['cement'] = {
+        'stock': stock, 'used': 0, 'unit': 'bags', 'min_stock': min_stock, 'category': 'materials', 'rate': 350.0}
+    return data
+
+
+def use(data, engine, quantity):
+    transaction = inventory.consume(data, 'Site A', 'materials', 'cement', quantity, 'Block A', 'Supervisor')
+    return engine.on_transaction(transaction, notify=False)
+
+
+def test_below_min_is_raised_and_cleared():
+    data = stocked_data(stock=10, min_stock=5)
+    engine = alerts.AlertEngine(data)
+    assert engine.count() == 0
+    raised = use(data, engine, 6)
+    assert [a['rule'] for a in raised if a['rule'] == 'below_min'] == ['below_min']
+
+    transaction = inventory.receive(data, 'Site A', 'materials', 'cement', 50, 'Store')
+    engine.on_transaction(transaction, notify=False)
+    assert engine.count('below_min') == 0
+
+
+def test_stockout_uses_daily_usage():
+    data = stocked_data(stock=100, min_stock=0)
+    engine = alerts.AlertEngine(data)
+    # 95 used in the window is about 6.8 a day, leaving 5 units: under a day.
+    use(data, engine, 95)
+    active = engine.item_alerts('Site A', 'materials', 'cement')
+    assert [a['rule'] for a in active] == ['stockout']
+    assert active[0]['days_left'] < alerts.STOCKOUT_HORIZON_DAYS
+
+
+def test_spike_compares_against_mean_usage():
+    data = stocked_data()
+    engine = alerts.AlertEngine(data)
+    for _ in range(alerts.SPIKE_MIN_HISTORY):
+        use(data, engine, 10)
+    # Over three times the daily average (50 / 14 days) but not the mean usage.
+    assert not [a for a in use(data, engine, 20) if a['rule'] == 'spike']
+    spikes = [a for a in use(data, engine, 40) if a['rule'] == 'spike']
+    assert len(spikes) == 1 and spikes[0]['quantity'] == 40
+
+
+def test_spike_with_zero_quantity_history():
+    data = stocked_data()
+    engine = alerts.AlertEngine(data)
+    for _ in range(alerts.SPIKE_MIN_HISTORY):
+        engine.on_transaction({'type': 'used', 'site': 'Site A', 'category': 'materials', 'item': 'cement',
+                               'quantity': 0, 'ts': time.time()}, notify=False)
+    assert not [a for a in use(data, engine, 5) if a['rule'] == 'spike']
+
+
+def test_spike_expires():
+    data = stocked_data()
+    engine = alerts.AlertEngine(data)
+    for _ in range(alerts.SPIKE_MIN_HISTORY):
+        use(data, engine, 1)
+    use(data, engine, 50)
+    assert engine.count('spike') == 1
+    for alert in engine.active.values():
+        alert['expires_ts'] = time.time() - 1
+    assert not [a for a in engine.active_alerts() if a['rule'] == 'spike']
+
+
+def test_stockout_is_re_evaluated_as_usage_ages(monkeypatch):
+    data = stocked_data(stock=100, min_stock=0)
+    engine = alerts.AlertEngine(data)
+    start = time.time()
+    first = inventory.consume(data, 'Site A', 'materials', 'cement', 60, 'Block A', 'Supervisor')
+    first['ts'] = start - 10 * alerts._DAY
+    engine.rebuild()
+    # 60 + 30 used in the window is about 6.4 a day, leaving 10 units.
+    use(data, engine, 30)
+    assert engine.count('stockout') == 1
+
+    # Once the first usage leaves the window, 30 over 14 days is about 2.1 a
+    # day: under five days left, so the alert stays with the new estimate.
+    monkeypatch.setattr(alerts.time, 'time', lambda: start + 5 * alerts._DAY)
+    [alert] = engine.item_alerts('Site A', 'materials', 'cement')
+    assert alert['rule'] == 'stockout' and alert['days_left'] == 4.7
+
+    monkeypatch.setattr(alerts.time, 'time', lambda: start + 15 * alerts._DAY)
+    assert engine.active_alerts() == []
@@ -0,0 +1,92 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+import api
+import change_feed
+import storage
+import sync
+from conftest import make_data
+
+
+@pytest.fixture
+def server():
+    data = make_data('Site A', 'Site B')
+    data['system_info']['last_seq'] = 0
+    storage.save_data(data)
+    server = api.make_server(api.Store(flush_interval=0), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    client = api.Client(port=server.server_address[1])
+    yield client
+    client.close()
+
+
+def add(quantity, **fields):
+    return sync.new_record('add', site='Site A', category='materials', item='cement', quantity=quantity,
+                           unit='bags', rate=350.0, code='CEM-1', **fields)
+
+
+def test_batch_is_saved_and_resending_is_a_duplicate(client):
+    first, second = add(10), add(5)
+    status, body = client.batch([first, second])
+    assert status == 200
+    assert [(r['status'], r['seq']) for r in body['results']] == [('applied', 1), ('applied', 2)]
+
+    status, body = client.batch([second, {**add(1), 'site': 'Nowhere'}])
+    assert [r['status'] for r in body['results']] == ['duplicate', 'conflict']
+    assert body['results'][0]['seq'] == 2
+
+    data = change_feed.ChangeFeed().load()
+    assert data['sites']['Site A']['materials']['cement']['stock'] == 15
+    status, body = client.site_inventory('Site A')
+    assert body['inventory']['materials']['cement']['stock'] == 15
+
+
+def test_transactions_page_with_a_cursor(client):
+    client.batch([add(1) for _ in range(5)])
+    seqs, after = [], 0
+    while True:
+        status, body = client.get('/transactions', after=after, limit=2)
+        if not body['transactions']:
+            break
+        seqs.append([t['seq'] for t in body['transactions']])
+        after = body['next_after']
+    assert seqs == [[1, 2], [3, 4], [5]]
+    assert client.get('/transactions', after='x')[0] == 400
+    status, body = client.get('/transactions', limit=-1)
+    assert status == 400 and 'limit' in body['error']
+
+
+def test_items_are_found_by_code(client):
+    client.batch([add(3)])
+    status, body = client.get('/items', code='cem-1')
+    assert [(i['site'], i['item'], i['stock']) for i in body['items']] == [('Site A', 'cement', 3)]
+    assert client.get('/items')[0] == 400
+    assert client.get('/sites/Nowhere/inventory')[0] == 404
+
+
+def test_malformed_bodies_get_a_json_error(server, client):
+    for payload in ([], "records", 3):
+        status, body = client.post('/batch', payload)
+        assert status == 400 and body['error'] == "Body must be a JSON object"
+
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    connection.putrequest('POST', '/batch')
+    connection.putheader('Content-Length', 'ten')
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == 400
+    assert json.loads(response.read()) == {'error': "Invalid Content-Length"}
+    connection.close()
+
+    # The shared connection still works after the errors.
+    assert client.get('/health') == (200, {'status': 'ok'})
@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+import backup
+import change_feed
+import inventory
+import ledger
+import storage
+from conftest import make_data
+
+
+def header():
+    return {'location': 'Pune', 'site_manager': 'Manager', 'contact': '1', 'project_type': 'painting work'}
+
+
+def new_item(unit='bags'):
+    return {'unit': unit, 'min_stock': 1, 'rate': 10.0}
+
+
+def sample_data():
+    data = make_data()
+    inventory.add_site(data, 'Site A', header())
+    inventory.add_site(data, 'Site B', header())
+    inventory.receive(data, 'Site A', 'materials', 'cement', 50, 'Store', new_item=new_item())
+    inventory.receive(data, 'Site B', 'materials', 'sand', 10, 'Store', new_item=new_item('kg'))
+    return data
+
+
+def test_deltas_restore_every_point():
+    data = sample_data()
+    backups = backup.Backups()
+    states = [backup.storage.decode_binary(backup.storage.encode_binary(data))]
+    assert backups.create(data)['kind'] == 'full'
+
+    inventory.consume(data, 'Site A', 'materials', 'cement', 5, 'Block A', 'Supervisor')
+    inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 10, 'Manager', 'Driver')
+    states.append(backup.storage.decode_binary(backup.storage.encode_binary(data)))
+    entry = backups.create(data)
+    assert entry['kind'] == 'delta' and entry['transactions'] == 2
+
+    inventory.delete_item(data, 'Site B', 'materials', 'sand')
+    states.append(backup.storage.decode_binary(backup.storage.encode_binary(data)))
+    backups.create(data)
+
+    for entry, state in zip(backups.entries(), states):
+        assert backups.restore(entry['id']) == state
+
+
+def test_recreated_site_is_stored_whole():
+    data = sample_data()
+    backups = backup.Backups()
+    backups.create(data)
+
+    inventory.remove_site(data, 'Site A')
+    inventory.add_site(data, 'Site A', header())
+    # Enough changes to take the new site past the old one's version.
+    for unit in ('kg', 'l', 'm'):
+        inventory.receive(data, 'Site A', 'materials', f'paint_{unit}', 1, 'Store', new_item=new_item(unit))
+    assert inventory.site_version(data['sites']['Site A']) >= backups.entries()[-1]['site_versions']['Site A']
+
+    assert backups.create(data)['kind'] == 'delta'
+    restored = backups.restore()
+    assert 'cement' not in restored['sites']['Site A']['materials']
+    assert restored == data
+
+
+def test_corrupt_backup_fails_its_checksum():
+    data = sample_data()
+    backups = backup.Backups()
+    backups.create(data)
+    inventory.consume(data, 'Site A', 'materials', 'cement', 5, 'Block A', 'Supervisor')
+    delta = backups.create(data)
+    assert [error for _, error in backups.verify()] == [None, None]
+
+    with open(os.path.join(backups.backup_dir, delta['file']), 'r+b') as f:
+        f.seek(10)
+        f.write(b'\x00\x00\x00')
+    errors = dict((entry['id'], error) for entry, error in backups.verify())
+    assert errors[delta['id']] and 'checksum' in errors[delta['id']]
+    with pytest.raises(backup.BackupError, match='checksum'):
+        backups.restore()
+    # Backups before the damaged one still restore.
+    assert backups.restore(backups.entries()[0]['id'])['sites']['Site A']['materials']['cement']['stock'] == 50
+
+
+def test_restore_keeps_counting_seqs_from_the_highest_published():
+    data = sample_data()
+    backups = backup.Backups()
+    first = backups.create(data)
+    inventory.consume(data, 'Site A', 'materials', 'cement', 5, 'Block A', 'Supervisor')
+    published = ledger.last_seq(data)
+    backups.create(data)
+    storage.save_data(data)
+    replica = change_feed.ChangeFeed()
+    replica_data = replica.load()
+
+    assert backup.main(['restore', first['id'], '--to', storage.DATA_DIR]) == 0
+    restored = change_feed.ChangeFeed().load()
+    assert restored['sites']['Site A']['materials']['cement']['stock'] == 50
+    assert ledger.last_seq(restored) == published
+
+    # Other replicas reload, and the next transaction gets a seq never handed out before.
+    with replica.writing(replica_data) as (_, reset):
+        assert reset and replica_data == restored
+        transaction = inventory.consume(replica_data, 'Site A', 'materials', 'cement', 1, 'Block A', 'Supervisor')
+        replica.save(replica_data, ['Site A'])
+    assert transaction['seq'] == published + 1
+    restored = change_feed.ChangeFeed().load()
+
+    # The restored data cannot be a delta of the backup taken before it.
+    assert backups.create(restored)['kind'] == 'full'
+    assert backups.restore() == restored
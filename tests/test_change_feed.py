@@ -0,0 +1,192 @@
+import copy
+import multiprocessing
+
+import pytest
+
+import change_feed
+import inventory
+import storage
+import sync
+from conftest import make_data
+
+
+def seed(stock=1000):
+    data = make_data('Site A', 'Site B')
+    data['sites']['Site A']['materials']['cement'] = {
+        'stock': stock, 'used': 0, 'unit': 'bags', 'min_stock': 5, 'category': 'materials', 'rate': 350.0}
+    storage.save_data(data)
+    return data
+
+
+def _receive_many(count, seqs):
+    feed = change_feed.ChangeFeed()
+    data = feed.load()
+    for _ in range(count):
+        with feed.writing(data):
+            transaction = inventory.receive(data, 'Site A', 'materials', 'cement', 1, 'Store')
+            feed.save(data, ['Site A'])
+        seqs.put(transaction['seq'])
+
+
+def test_writers_holding_the_lock_get_unique_seqs():
+    seed()
+    context = multiprocessing.get_context('fork')
+    seqs = context.Queue()
+    workers = [context.Process(target=_receive_many, args=(20, seqs)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    handed_out = sorted(seqs.get(timeout=30) for _ in range(60))
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    # Seqs are never renumbered after the writer saw them.
+    assert handed_out == list(range(1, 61))
+    data = change_feed.ChangeFeed().load()
+    assert [t['seq'] for t in data['transactions']] == handed_out
+    assert data['sites']['Site A']['materials']['cement']['stock'] == 1060
+
+
+def test_writing_applies_other_replicas_first():
+    seed()
+    first, second = change_feed.ChangeFeed(), change_feed.ChangeFeed()
+    data_1, data_2 = first.load(), second.load()
+    with first.writing(data_1):
+        inventory.consume(data_1, 'Site A', 'materials', 'cement', 4, 'Block A', 'Supervisor')
+        first.save(data_1, ['Site A'])
+
+    with second.writing(data_2) as (transactions, reset):
+        assert [t['seq'] for t in transactions] == [1] and not reset
+        transaction = inventory.consume(data_2, 'Site A', 'materials', 'cement', 6, 'Block B', 'Supervisor')
+        assert transaction['seq'] == 2
+        second.save(data_2, ['Site A'])
+    assert data_2['sites']['Site A']['materials']['cement']['stock'] == 990
+
+
+def replicas(count=2):
+    feeds = [change_feed.ChangeFeed() for _ in range(count)]
+    return [(feed, feed.load()) for feed in feeds]
+
+
+def cement(data, site_name='Site A'):
+    return data['sites'][site_name]['materials'].get('cement')
+
+
+def test_full_save_merges_unread_changes_first():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    inventory.consume(data_1, 'Site A', 'materials', 'cement', 30, 'Block A', 'Supervisor')
+    first.save(data_1, ['Site A'])
+
+    data_2['sites']['Site C'] = {'location': 'Nashik', 'materials': {}, 'tools and accessories': {}, 'machines': {}}
+    second.save(data_2)
+    assert cement(data_2)['stock'] == 970
+
+    data = change_feed.ChangeFeed().load()
+    assert set(data['sites']) == {'Site A', 'Site B', 'Site C'}
+    assert cement(data)['stock'] == 970
+    assert [t['type'] for t in data['transactions']] == ['used']
+
+
+def test_full_save_refuses_to_overwrite_a_reset():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    data_1['sites']['Site C'] = {'location': 'Nashik', 'materials': {}, 'tools and accessories': {}, 'machines': {}}
+    first.save(data_1)
+
+    data_2['sites'].pop('Site B')
+    with pytest.raises(change_feed.StaleDataError):
+        second.save(data_2)
+    # The reset is still unread, so the next poll reloads.
+    assert second.poll(data_2) == ([], True)
+    assert set(data_2['sites']) == {'Site A', 'Site B', 'Site C'}
+
+
+def test_remote_delete_wins_over_local_usage():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    inventory.delete_item(data_1, 'Site A', 'materials', 'cement')
+    first.save(data_1, ['Site A'])
+
+    used = inventory.consume(data_2, 'Site A', 'materials', 'cement', 10, 'Block A', 'Supervisor')
+    transactions, reset = second.save(data_2, ['Site A'])
+    assert reset and second.rejected == [used]
+    assert cement(data_2) is None
+    assert [t['type'] for t in data_2['transactions']] == ['deleted']
+
+    data = change_feed.ChangeFeed().load()
+    assert cement(data) is None
+    assert [t['type'] for t in data['transactions']] == ['deleted']
+
+
+def test_rejected_transfer_takes_back_the_item_it_created():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    inventory.delete_item(data_1, 'Site A', 'materials', 'cement')
+    first.save(data_1, ['Site A'])
+
+    moved = inventory.transfer(data_2, 'Site A', 'Site B', 'materials', 'cement', 40, 'Manager', 'Driver')
+    assert moved['new_item']
+    used = inventory.consume(data_2, 'Site B', 'materials', 'cement', 5, 'Block B', 'Supervisor')
+    second.save(data_2, ['Site A', 'Site B'])
+    assert second.rejected == [moved, used]
+    assert cement(data_2) is None and cement(data_2, 'Site B') is None
+
+
+def test_local_usage_is_rebased_on_remote_changes():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    inventory.receive(data_1, 'Site A', 'materials', 'cement', 50, 'Store', rate=400.0)
+    first.save(data_1, ['Site A'])
+
+    inventory.consume(data_2, 'Site A', 'materials', 'cement', 10, 'Block A', 'Supervisor')
+    second.save(data_2, ['Site A'])
+    assert not second.rejected
+    assert cement(data_2)['stock'] == 1040
+    assert [t['seq'] for t in data_2['transactions']] == [1, 2]
+
+
+def test_record_applied_on_two_replicas_is_kept_once():
+    seed()
+    (first, data_1), (second, data_2) = replicas()
+    record = sync.new_record('use', site='Site A', category='materials', item='cement', quantity=7,
+                             work_area='Block A', supervisor='Supervisor')
+    for feed, data in ((first, data_1), (second, data_2)):
+        results, transactions = sync.apply_batch(data, [record], sync.request_index(data['transactions']))
+        assert results[0]['status'] == 'applied'
+        feed.save(data, sync.touched_sites(transactions))
+
+    assert [t['request_id'] for t in second.rejected] == [record['request_id']]
+    assert cement(data_2)['stock'] == 993
+    data = change_feed.ChangeFeed().load()
+    assert [t.get('request_id') for t in data['transactions']] == [record['request_id']]
+    assert cement(data)['stock'] == 993
+
+
+def test_first_writes_on_an_empty_store_are_kept():
+    # Two sessions start from the same default data before anything is saved.
+    defaults = make_data('Site A', 'Site B')
+    defaults['sites']['Site A']['materials']['cement'] = {
+        'stock': 100, 'used': 0, 'unit': 'bags', 'min_stock': 5, 'category': 'materials', 'rate': 350.0}
+    writers = []
+    for _ in range(2):
+        feed = change_feed.ChangeFeed()
+        assert feed.load() is None
+        writers.append((feed, copy.deepcopy(defaults)))
+
+    for (feed, data), quantity in zip(writers, (3, 4)):
+        with feed.writing(data):
+            inventory.consume(data, 'Site A', 'materials', 'cement', quantity, 'Block A', 'Supervisor')
+            feed.save(data, ['Site A'])
+
+    # A session started afterwards sees both writes, and its own write keeps them.
+    late = change_feed.ChangeFeed()
+    data = late.load()
+    assert [t['quantity'] for t in data['transactions']] == [3, 4]
+    with late.writing(data):
+        inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 10, 'Manager', 'Driver')
+        late.save(data, ['Site A', 'Site B'])
+
+    data = change_feed.ChangeFeed().load()
+    assert [t['seq'] for t in data['transactions']] == [1, 2, 3]
+    assert cement(data)['stock'] == 83 and cement(data, 'Site B')['stock'] == 10
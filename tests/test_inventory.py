@@ -0,0 +1,84 @@
+import copy
+import json
+
+import pytest
+
+import inventory
+import render_cache
+import sync
+from conftest import make_data
+
+
+def header():
+    return {'location': 'Pune', 'site_manager': 'Manager', 'contact': '1', 'project_type': 'painting work'}
+
+
+def test_add_site_creates_empty_categories():
+    data = make_data()
+    entry = inventory.add_site(data, 'Site A', header())
+    assert data['sites']['Site A'] is entry
+    assert all(entry[category] == {} for category in ('materials', 'tools and accessories', 'machines'))
+    assert data['system_info']['total_sites'] == 1
+    with pytest.raises(inventory.InventoryError):
+        inventory.add_site(data, 'Site A', header())
+
+
+def test_recreated_site_never_repeats_a_version():
+    data = make_data()
+    inventory.add_site(data, 'Site A', header())
+    inventory.receive(data, 'Site A', 'materials', 'cement', 5, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 1, 'rate': 10.0})
+    seen_data = inventory.data_version(data)
+    seen_site = inventory.site_key(data['sites']['Site A'])
+
+    assert inventory.remove_site(data, 'Site A') is not None
+    assert inventory.remove_site(data, 'Site A') is None
+    assert data['system_info']['total_sites'] == 0
+
+    inventory.add_site(data, 'Site A', header())
+    inventory.receive(data, 'Site A', 'materials', 'sand', 5, 'Store',
+                      new_item={'unit': 'kg', 'min_stock': 1, 'rate': 2.0})
+    assert inventory.site_version(data['sites']['Site A']) == 1
+    assert inventory.data_version(data) != seen_data
+    assert inventory.site_key(data['sites']['Site A']) != seen_site
+
+
+def test_render_cache_misses_for_a_recreated_site():
+    data = make_data()
+    inventory.add_site(data, 'Site A', header())
+    cache = render_cache.RenderCache()
+    key = inventory.site_key(data['sites']['Site A'])
+    assert cache.get('inventory', 'Site A', key, lambda: 'first') == 'first'
+
+    inventory.remove_site(data, 'Site A')
+    inventory.add_site(data, 'Site A', header())
+    key = inventory.site_key(data['sites']['Site A'])
+    assert cache.get('inventory', 'Site A', key, lambda: 'second') == 'second'
+
+
+@pytest.mark.parametrize('field, value', [('quantity', float('nan')), ('quantity', float('inf')),
+                                          ('rate', float('nan')), ('rate', float('-inf'))])
+def test_non_finite_numbers_are_rejected(field, value):
+    data = make_data('Site A')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 5, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 1, 'rate': 10.0})
+    before = copy.deepcopy(data)
+    kwargs = {'quantity': 1, 'rate': 10.0, field: value}
+    with pytest.raises(inventory.InventoryError):
+        inventory.receive(data, 'Site A', 'materials', 'cement', kwargs['quantity'], 'Store', rate=kwargs['rate'])
+    with pytest.raises(inventory.InventoryError):
+        inventory.receive(data, 'Site A', 'materials', 'sand', kwargs['quantity'], 'Store',
+                          new_item={'unit': 'kg', 'rate': kwargs['rate']})
+    assert data == before
+
+
+def test_batch_with_a_nan_quantity_is_invalid():
+    data = make_data('Site A')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 5, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 1, 'rate': 10.0})
+    record = json.loads('{"op": "use", "request_id": "r1", "site": "Site A", "category": "materials", '
+                        '"item": "cement", "quantity": NaN, "work_area": "Block A", "supervisor": "S"}')
+    results, transactions = sync.apply_batch(data, [record], {})
+    assert results[0]['status'] == 'conflict' and transactions == []
+    assert data['sites']['Site A']['materials']['cement']['stock'] == 5
+    assert len(data['transactions']) == 1
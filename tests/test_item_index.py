@@ -0,0 +1,53 @@
+import inventory
+import item_index
+from conftest import make_data
+
+
+def indexed_data():
+    data = make_data('Site A', 'Site B')
+    index = item_index.CodeIndex(data)
+    index.on_transaction(inventory.receive(data, 'Site A', 'materials', 'cement', 20, 'Store',
+                                           new_item={'unit': 'bags', 'min_stock': 5, 'rate': 350.0,
+                                                     'code': ' cm-1 '}))
+    return data, index
+
+
+def test_received_and_transferred_items_are_found_by_code():
+    data, index = indexed_data()
+    assert index.lookup('CM-1') == [('Site A', 'materials', 'cement')]
+    assert index.lookup('cm-1 ') == index.lookup('CM-1')
+
+    index.on_transaction(inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 5,
+                                            'Manager', 'Driver'))
+    assert index.lookup('CM-1') == [('Site A', 'materials', 'cement'), ('Site B', 'materials', 'cement')]
+    assert index.duplicates() == {}
+    assert index.lookup('N/A') == [] and len(index) == 1
+
+
+def test_edited_code_moves_the_item():
+    data, index = indexed_data()
+    index.on_transaction(inventory.edit_item(data, 'Site A', 'materials', 'cement', stock=20, used=0,
+                                             unit='bags', rate=350.0, min_stock=5, code='CM-2'))
+    assert index.lookup('CM-1') == []
+    assert index.lookup('CM-2') == [('Site A', 'materials', 'cement')]
+
+    index.on_transaction(inventory.edit_item(data, 'Site A', 'materials', 'cement', stock=20, used=0,
+                                             unit='bags', rate=350.0, min_stock=5, code='N/A'))
+    assert index.lookup('CM-2') == [] and len(index) == 0
+
+
+def test_deleted_item_is_no_longer_found():
+    data, index = indexed_data()
+    index.on_transaction(inventory.receive(data, 'Site B', 'materials', 'sand', 10, 'Store',
+                                           new_item={'unit': 'kg', 'min_stock': 1, 'rate': 50.0,
+                                                     'code': 'CM-1'}))
+    assert index.duplicates() == {'CM-1': [('Site A', 'materials', 'cement'), ('Site B', 'materials', 'sand')]}
+    assert index.conflicts('CM-1', 'materials', 'cement') == [('Site B', 'materials', 'sand')]
+
+    index.on_transaction(inventory.delete_item(data, 'Site B', 'materials', 'sand'))
+    assert index.lookup('CM-1') == [('Site A', 'materials', 'cement')]
+    assert index.duplicates() == {}
+
+    inventory.remove_site(data, 'Site A')
+    index.forget_site('Site A')
+    assert index.lookup('CM-1') == [] and len(index) == 0
@@ -0,0 +1,64 @@
+import ledger
+from conftest import make_data
+
+
+def logged_data(count):
+    data = make_data('Site A')
+    for i in range(count):
+        ledger.append_transaction(data, {'type': 'used', 'quantity': i})
+    return data
+
+
+def test_append_stamps_increasing_seq_and_ts():
+    data = logged_data(5)
+    log = data['transactions']
+    assert [t['seq'] for t in log] == [1, 2, 3, 4, 5]
+    assert all(a['ts'] <= b['ts'] for a, b in zip(log, log[1:]))
+    assert ledger.last_seq(data) == 5
+
+
+def test_transactions_after_pages_with_a_cursor():
+    log = logged_data(10)['transactions']
+    pages, after = [], 0
+    while True:
+        page = ledger.transactions_after(log, after, limit=4)
+        if not page:
+            break
+        pages.append([t['seq'] for t in page])
+        after = page[-1]['seq']
+    assert pages == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    assert ledger.transactions_after(log, 10) == []
+
+
+def test_find_and_time_range():
+    log = logged_data(6)['transactions']
+    for ts, transaction in enumerate(log):
+        transaction['ts'] = float(ts)
+    assert ledger.find_transaction(log, 4) is log[3]
+    assert ledger.find_transaction(log, 7) is None
+    assert [t['seq'] for t in ledger.transactions_between(log, 2.0, 5.0)] == [3, 4, 5]
+
+
+def test_reappend_moves_a_transaction_to_the_end():
+    data = logged_data(3)
+    moved = data['transactions'].pop(0)
+    moved['ts'] = 0.0
+    ledger.reappend_transaction(data, moved)
+    assert moved['seq'] == 4 and moved['ts'] == data['transactions'][-2]['ts']
+    assert [t['seq'] for t in data['transactions']] == [2, 3, 4]
+
+
+def test_ensure_sequence_backfills_legacy_records():
+    data = make_data('Site A')
+    data['transactions'] = [
+        {'type': 'used', 'date': '2024-01-03 10:00:00'},
+        {'type': 'added', 'date': '2024-01-01 09:00:00'},
+        {'type': 'used', 'date': 'not a date'},
+    ]
+    assert ledger.ensure_sequence(data)
+    log = data['transactions']
+    assert [t['seq'] for t in log] == [1, 2, 3]
+    assert [t['type'] for t in log[:2]] == ['added', 'used']
+    assert all(a['ts'] <= b['ts'] for a, b in zip(log, log[1:]))
+    assert ledger.last_seq(data) == 3
+    assert not ledger.ensure_sequence(data)
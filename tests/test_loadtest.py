@@ -0,0 +1,38 @@
+import os
+
+import inventory
+import loadtest
+import storage
+from conftest import make_data
+
+
+def test_short_run_keeps_every_write_and_restores_the_process(tmp_path):
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+
+    data = make_data()
+    for site_name in ('Site A', 'Site B'):
+        inventory.add_site(data, site_name, {'location': 'Pune', 'site_manager': 'Manager', 'contact': '1',
+                                             'project_type': 'painting work'})
+    for item_name in ('cement', 'sand'):
+        inventory.receive(data, 'Site A', 'materials', item_name, 500, 'Store',
+                          new_item={'unit': 'bags', 'min_stock': 1, 'rate': 10.0})
+    storage.save_data(data)
+    patched = (Runtime.__dict__['instance'], ScriptCache.__dict__['get_bytecode'])
+    cwd = os.getcwd()
+
+    report = loadtest.run(sessions=2, duration=4, mix={'use': 1, 'transfer': 1},
+                          workdir=str(tmp_path / 'work'))
+
+    assert report['lost_updates'] == [] and report['file_write_failures'] == []
+    written = sum(stats['count'] - stats['failed'] for action, stats in report['actions'].items()
+                  if action in ('use', 'transfer'))
+    saved = storage.load_data(str(tmp_path / 'work' / storage.DATA_DIR))
+    assert written > 0
+    assert len(saved['transactions']) == len(data['transactions']) + written
+    assert (Runtime.__dict__['instance'], ScriptCache.__dict__['get_bytecode']) == patched
+    assert os.getcwd() == cwd and loadtest.APP_DIR_ENV not in os.environ
+    # The app kept its files in the work directory, not the current one.
+    assert os.path.isdir(tmp_path / 'work' / 'analytics_snapshot')
+    assert not os.path.exists(tmp_path / 'analytics_snapshot')
+    assert storage.load_data()['transactions'] == data['transactions']
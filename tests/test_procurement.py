@@ -0,0 +1,74 @@
+import inventory
+import procurement
+from conftest import make_data
+
+
+def header():
+    return {'location': 'Pune', 'site_manager': 'Manager', 'contact': '1', 'project_type': 'painting work'}
+
+
+def receive(data, site_name, item_name, quantity, rate, supplier='Acme'):
+    site_items = data['sites'][site_name]['materials']
+    new_item = None if item_name in site_items else {'unit': 'bags', 'min_stock': 1, 'rate': rate}
+    return inventory.receive(data, site_name, 'materials', item_name, quantity, 'Store', new_item=new_item,
+                             rate=rate, supplier=supplier)
+
+
+def stocked_data():
+    data = make_data()
+    inventory.add_site(data, 'Site A', header())
+    inventory.add_site(data, 'Site B', header())
+    receive(data, 'Site A', 'cement', 10, 350.0)
+    receive(data, 'Site A', 'cement', 10, 370.0, supplier='Bharat')
+    receive(data, 'Site B', 'sand', 4, 50.0)
+    return data
+
+
+def test_vendor_spend_and_price_trend():
+    rollup = procurement.SpendRollup(stocked_data())
+    assert [(r['supplier'], r['spend'], r['receipts']) for r in rollup.vendor_spend()] == [
+        ('Acme', 3700.0, 2), ('Bharat', 3700.0, 1)]
+    assert [r['rate'] for r in rollup.price_trend('Site A', 'materials', 'cement')] == [350.0, 370.0]
+    assert rollup.priced_items('Site B') == [('materials', 'sand')]
+
+
+def test_saved_cells_are_caught_up_instead_of_rescanned(tmp_path):
+    data = stocked_data()
+    rollup = procurement.SpendRollup(data, str(tmp_path))
+    assert rollup.save() == 2
+
+    for transaction in (receive(data, 'Site B', 'sand', 6, 60.0),
+                        inventory.consume(data, 'Site A', 'materials', 'cement', 2, 'Block A', 'Supervisor')):
+        rollup.on_transaction(transaction)
+    # Only the site that received something is written again.
+    assert rollup.save() == 1
+
+    receive(data, 'Site A', 'cement', 5, 360.0)
+    loaded = procurement.SpendRollup(data, str(tmp_path))
+    assert loaded.scanned == 1
+    assert loaded.cells == procurement.SpendRollup(data).cells
+
+
+def test_recreated_site_does_not_reuse_saved_cells(tmp_path):
+    data = stocked_data()
+    live = procurement.SpendRollup(data, str(tmp_path))
+    live.save()
+
+    inventory.remove_site(data, 'Site A')
+    live.forget_site('Site A')
+    inventory.add_site(data, 'Site A', header())
+    live.on_transaction(receive(data, 'Site A', 'paint', 3, 200.0))
+    loaded = procurement.SpendRollup(data, str(tmp_path))
+    assert loaded.price_trend('Site A', 'materials', 'cement') == []
+    assert loaded.cells == live.cells
+
+
+def test_rolled_back_log_is_rescanned(tmp_path):
+    data = stocked_data()
+    procurement.SpendRollup(data, str(tmp_path)).save()
+
+    del data['transactions'][1:]
+    data['system_info']['last_seq'] = 1
+    loaded = procurement.SpendRollup(data, str(tmp_path))
+    assert loaded.scanned == 1
+    assert [r['receipts'] for r in loaded.vendor_spend()] == [1]
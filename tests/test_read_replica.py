@@ -0,0 +1,72 @@
+import multiprocessing
+import os
+
+import inventory
+import read_replica
+import storage
+from conftest import make_data
+
+
+def saved_data():
+    data = make_data('Site A', 'Site B')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 20, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 5, 'rate': 350.0})
+    inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 5, 'Manager', 'Driver')
+    storage.save_data(data)
+    return data
+
+
+def test_published_snapshot_matches_the_shards():
+    data = saved_data()
+    assert read_replica.current(data).live
+
+    publisher = read_replica.Publisher()
+    meta = publisher.publish_once()
+    assert meta['generation'] == 1 and meta['last_seq'] == 2
+    assert publisher.publish_once() is None
+
+    snapshot = read_replica.open_snapshot()
+    assert not snapshot.live and snapshot.meta == meta
+    rows = sorted(zip(*(snapshot.items[c].to_pylist() for c in ('site', 'item', 'stock', 'value'))))
+    assert rows == [('Site A', 'cement', 15.0, 5250.0), ('Site B', 'cement', 5.0, 1750.0)]
+    # The transfer is stored in both shards but published once.
+    assert snapshot.transactions['seq'].to_pylist() == [1, 2]
+
+    inventory.consume(data, 'Site B', 'materials', 'cement', 2, 'Block B', 'Supervisor')
+    storage.save_sites(data, ['Site B'], data['transactions'][-1:])
+    assert publisher.publish_once()['generation'] == 2
+    assert read_replica.current(data).site_transaction_count('Site B') == 1
+
+
+def _publish(count):
+    publisher = read_replica.Publisher()
+    for _ in range(count):
+        publisher.publish_once(force=True)
+
+
+def test_publishers_in_several_processes_never_share_a_generation():
+    saved_data()
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_publish, args=(10,)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    snapshot = read_replica.open_snapshot()
+    assert snapshot.meta['generation'] == 30
+    kept = sorted(name for name in os.listdir(read_replica.SNAPSHOT_DIR) if name.endswith('.arrow'))
+    generations = range(30 - read_replica.KEEP_GENERATIONS + 1, 31)
+    assert kept == sorted(f"{kind}-{g}.arrow" for kind in ('items', 'transactions') for g in generations)
+
+
+def test_missing_generation_files_read_as_no_snapshot():
+    data = saved_data()
+    read_replica.Publisher().publish_once()
+    for name in os.listdir(read_replica.SNAPSHOT_DIR):
+        if name.endswith('.arrow'):
+            os.remove(os.path.join(read_replica.SNAPSHOT_DIR, name))
+    read_replica._opened.clear()
+    assert read_replica.open_snapshot() is None
+    assert read_replica.current(data).live
@@ -0,0 +1,93 @@
+import inventory
+import reconcile
+import storage
+from conftest import make_data
+
+
+def data_with_history():
+    data = make_data('Site A', 'Site B')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 20, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 5, 'rate': 350.0, 'code': 'CM-1'})
+    inventory.consume(data, 'Site A', 'materials', 'cement', 4, 'Block A', 'Supervisor')
+    inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 6, 'Manager', 'Driver')
+    return data
+
+
+def statuses(report):
+    return {(row.site, row.item): row.status for row in report.itertuples()}
+
+
+def test_replayed_log_matches_inventory():
+    data = data_with_history()
+    report = reconcile.reconcile(data)
+    assert statuses(report)[('Site A', 'cement')] == 'ok'
+    row = report[(report['site'] == 'Site A')].iloc[0]
+    assert (row['stock'], row['expected_stock'], row['used'], row['expected_used']) == (10, 10, 4, 4)
+
+
+def test_stock_mismatch_is_reported():
+    data = data_with_history()
+    data['sites']['Site A']['materials']['cement']['stock'] = 12
+    report = reconcile.reconcile(data)
+    assert statuses(report)[('Site A', 'cement')] == 'stock_mismatch'
+    assert report.loc[report['site'] == 'Site A', 'stock_diff'].iloc[0] == 2
+
+
+def test_edit_sets_the_expected_stock():
+    data = data_with_history()
+    inventory.edit_item(data, 'Site A', 'materials', 'cement', stock=50, used=4, unit='bags', rate=350.0,
+                        min_stock=5, code='CM-1')
+    inventory.consume(data, 'Site A', 'materials', 'cement', 5, 'Block A', 'Supervisor')
+    assert statuses(reconcile.reconcile(data))[('Site A', 'cement')] == 'ok'
+
+
+def test_deleted_item_still_in_inventory():
+    data = data_with_history()
+    item = dict(data['sites']['Site A']['materials']['cement'])
+    inventory.delete_item(data, 'Site A', 'materials', 'cement')
+    assert ('Site A', 'cement') not in statuses(reconcile.reconcile(data))
+    data['sites']['Site A']['materials']['cement'] = item
+    assert statuses(reconcile.reconcile(data))[('Site A', 'cement')] == 'deleted_but_live'
+
+
+def test_item_without_opening_balance_is_untracked(capsys):
+    data = make_data('Site A')
+    data['sites']['Site A']['materials']['sand'] = {
+        'stock': 40, 'used': 0, 'unit': 'kg', 'min_stock': 5, 'category': 'materials', 'rate': 10.0}
+    data['sites']['Site A']['materials']['gravel'] = {
+        'stock': 7, 'used': 0, 'unit': 'kg', 'min_stock': 5, 'category': 'materials', 'rate': 10.0}
+    # Sand predates the log: only its usage is recorded.
+    inventory.consume(data, 'Site A', 'materials', 'sand', 15, 'Block A', 'Supervisor')
+
+    report = reconcile.reconcile(data)
+    assert statuses(report) == {('Site A', 'gravel'): 'untracked', ('Site A', 'sand'): 'untracked'}
+    assert not report['baseline'].any()
+
+    storage.save_data(data)
+    assert reconcile.main([]) == 0
+
+
+def test_command_fails_on_mismatch(capsys):
+    data = data_with_history()
+    data['sites']['Site A']['materials']['cement']['used'] = 9
+    storage.save_data(data)
+    assert reconcile.main([]) == 1
+    assert 'used_mismatch' in capsys.readouterr().out
+
+
+def test_transfer_creating_the_item_sets_its_opening_balance():
+    data = data_with_history()
+    inventory.consume(data, 'Site B', 'materials', 'cement', 1, 'Block B', 'Supervisor')
+    inventory.edit_item(data, 'Site B', 'materials', 'cement', stock=5, used=1, unit='bags', rate=350.0,
+                        min_stock=5, code='CM-1')
+    # Removing the site logs no delete, so the new item follows the old one's history.
+    inventory.remove_site(data, 'Site B')
+    inventory.add_site(data, 'Site B', {})
+    inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 3, 'Manager', 'Driver')
+    assert data['transactions'][-1]['new_item']
+    inventory.consume(data, 'Site B', 'materials', 'cement', 2, 'Block B', 'Supervisor')
+
+    report = reconcile.reconcile(data)
+    assert statuses(report) == {('Site A', 'cement'): 'ok', ('Site B', 'cement'): 'ok'}
+    row = report[report['site'] == 'Site B'].iloc[0]
+    assert (row['expected_stock'], row['expected_used'], row['baseline']) == (1, 2, True)
@@ -0,0 +1,75 @@
+import threading
+
+import inventory
+import reports
+import storage
+from conftest import make_data
+
+
+def saved_site():
+    data = make_data('Site A', 'Site B')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 20, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 5, 'rate': 350.0})
+    inventory.consume(data, 'Site A', 'materials', 'cement', 4, 'Block A', 'Supervisor')
+    storage.save_data(data)
+
+
+def test_build_reports_writes_fresh_reports():
+    saved_site()
+    metas = reports.build_reports('Site A')
+    assert [m['period'] for m in metas] == list(reports.PERIODS)
+    meta, path = reports.latest_report('Site A', 'daily')
+    assert meta['summary']['items'] == 1 and meta['summary']['stock_value'] == 16 * 350.0
+    assert path.endswith('.xlsx')
+    assert not reports.is_due('Site A', 'daily')
+    assert reports.is_due('Site B', 'daily')
+
+
+def test_submit_builds_the_periods_asked_for(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_build(site_name, periods, data_dir, report_dir):
+        started.set()
+        release.wait(10)
+        return [{'site': site_name, 'period': period} for period in periods]
+
+    monkeypatch.setattr(reports, 'build_reports', slow_build)
+    scheduler = reports.ReportScheduler(workers=2)
+    daily = scheduler.submit('Site A', ['daily'])
+    started.wait(10)
+    assert scheduler.submit('Site A', ['daily']) is daily
+    weekly = scheduler.submit('Site A', ['weekly'])
+    assert weekly is not daily
+    assert scheduler.pending() == ['Site A']
+
+    release.set()
+    assert [m['period'] for m in daily.result(10)] == ['daily']
+    assert [m['period'] for m in weekly.result(10)] == ['weekly']
+
+
+def test_refresh_rebuilds_a_saved_site_after_the_running_build(monkeypatch):
+    release = threading.Event()
+    builds = []
+
+    def slow_build(site_name, periods, data_dir, report_dir):
+        builds.append(site_name)
+        release.wait(10)
+        return []
+
+    monkeypatch.setattr(reports, 'build_reports', slow_build)
+    scheduler = reports.ReportScheduler(workers=2)
+    scheduler.refresh('Site A')
+    first = scheduler.submit('Site A')
+    # Saved again while the first build runs: it is built once more afterwards.
+    scheduler.refresh('Site A')
+    scheduler.refresh('Site A')
+    assert scheduler.submit('Site A') is first
+
+    release.set()
+    first.result(10)
+    for _ in range(100):
+        if builds == ['Site A', 'Site A'] and not scheduler.pending():
+            break
+        threading.Event().wait(0.05)
+    assert builds == ['Site A', 'Site A'] and scheduler.pending() == []
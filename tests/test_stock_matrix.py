@@ -0,0 +1,51 @@
+import math
+
+import inventory
+import stock_matrix
+from conftest import make_data
+
+
+def stocked_data():
+    data = make_data('Site A', 'Site B', 'Site C')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 20, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 5, 'rate': 100.0})
+    inventory.receive(data, 'Site A', 'materials', 'river_sand', 10, 'Store',
+                      new_item={'unit': 'kg', 'min_stock': 2, 'rate': 50.0})
+    # Site B ends up stocking cement with none left; Site C stocks nothing.
+    inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 4, 'Manager', 'Driver')
+    inventory.consume(data, 'Site B', 'materials', 'cement', 4, 'Block B', 'Supervisor')
+    return data
+
+
+def cells(matrix):
+    return {key: [None if math.isnan(v) else v for v in row] for key, row in zip(matrix.index, matrix.values)}
+
+
+def test_pivot_keeps_zero_and_missing_cells_apart():
+    prepared = stock_matrix.prepare(stocked_data())
+    selected = stock_matrix.select(prepared, sort='item', descending=False)
+    matrix = stock_matrix.pivot(prepared, selected, 'stock')
+    assert list(matrix.columns) == ['Site A', 'Site B', 'Site C', 'Total']
+    assert cells(matrix) == {
+        ('Materials', 'Cement'): [16.0, 0.0, None, 16.0],
+        ('Materials', 'River Sand'): [10.0, None, None, 10.0],
+        ('Total', 'All Items Shown'): [26.0, 0.0, 0.0, 26.0],
+    }
+
+    shortfall = stock_matrix.pivot(prepared, selected, 'shortfall')
+    assert cells(shortfall)[('Materials', 'Cement')] == [0.0, 5.0, None, 5.0]
+    assert selected.set_index('item').loc['cement', 'sites_short'] == 1
+
+
+def test_pivot_of_filtered_items_and_of_no_items():
+    prepared = stock_matrix.prepare(stocked_data())
+    selected = stock_matrix.select(prepared, search='river sand')
+    assert cells(stock_matrix.pivot(prepared, selected, 'value')) == {
+        ('Materials', 'River Sand'): [500.0, None, None, 500.0],
+        ('Total', 'All Items Shown'): [500.0, 0.0, 0.0, 500.0],
+    }
+
+    empty = stock_matrix.prepare(make_data('Site A'))
+    assert stock_matrix.select(empty, search='sand').empty
+    matrix = stock_matrix.pivot(empty, stock_matrix.select(empty), 'stock')
+    assert cells(matrix) == {('Total', 'All Items Shown'): [0.0, 0.0]}
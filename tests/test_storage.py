@@ -0,0 +1,139 @@
+import json
+import os
+
+import pytest
+
+import storage
+from conftest import make_data
+
+
+def sample_data():
+    data = make_data('Site A', 'Site B')
+    data['sites']['Site A']['materials']['cement'] = {
+        'stock': 10, 'used': 2, 'unit': 'bags', 'min_stock': 5, 'category': 'materials', 'rate': 350.0, 'code': 'CM-1'}
+    data['transactions'] = [
+        {'seq': 1, 'ts': 1.0, 'type': 'used', 'site': 'Site A', 'category': 'materials', 'item': 'cement', 'quantity': 2},
+        {'seq': 2, 'ts': 2.0, 'type': 'transfer', 'from_site': 'Site A', 'to_site': 'Site B',
+         'category': 'materials', 'item': 'cement', 'quantity': 1},
+    ]
+    data['system_info']['last_seq'] = 2
+    return data
+
+
+def test_binary_round_trip():
+    data = sample_data()
+    assert storage.decode_binary(storage.encode_binary(data)) == data
+
+
+def test_binary_rejects_foreign_objects():
+    import pickle
+    import zlib
+    blob = storage._MAGIC + zlib.compress(pickle.dumps((1, {'x': os.getcwd}), protocol=pickle.HIGHEST_PROTOCOL))
+    with pytest.raises(storage.SnapshotError):
+        storage.decode_binary(blob)
+    with pytest.raises(storage.SnapshotError):
+        storage.decode_binary(b"not a snapshot")
+
+
+def test_legacy_json_is_migrated_into_shards():
+    data = sample_data()
+    for t in data['transactions']:
+        del t['seq'], t['ts']
+        t['date'] = '2025-01-01 10:00:00'
+    with open(storage.snapshot_path('json'), 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+
+    loaded = storage.load_data()
+    assert [t['seq'] for t in loaded['transactions']] == [1, 2]
+    assert set(storage.site_shards()) == {'Site A', 'Site B'}
+    assert storage.load_data() == loaded
+
+
+@pytest.mark.parametrize('fmt', list(storage.FORMATS))
+def test_sharded_round_trip(fmt):
+    data = sample_data()
+    data['system_info']['storage_format'] = fmt
+    storage.save_data(data)
+    assert storage.load_data() == data
+    assert storage.shard_path('Site A').endswith(storage.FORMATS[fmt])
+
+
+def test_switching_format_reads_the_newer_file():
+    data = sample_data()
+    storage.save_data(data)
+    data['system_info']['storage_format'] = 'binary'
+    data['sites']['Site A']['materials']['cement']['stock'] = 7
+    storage.save_data(data)
+    assert storage.load_data()['sites']['Site A']['materials']['cement']['stock'] == 7
+    assert not os.path.exists(os.path.join(storage.DATA_DIR, 'index.json'))
+
+
+def used(seq, site='Site A', quantity=1):
+    return {'seq': seq, 'ts': float(seq), 'type': 'used', 'site': site, 'category': 'materials',
+            'item': 'cement', 'quantity': quantity}
+
+
+def test_save_sites_appends_only_new_transactions(monkeypatch):
+    data = sample_data()
+    storage.save_data(data)
+    monkeypatch.setattr(storage, '_bucket_transactions', None)  # a site save must not scan the whole log
+
+    new = [used(3), used(4, site='Site B')]
+    data['transactions'].extend(new)
+    data['system_info']['last_seq'] = 4
+    storage.save_sites(data, ['Site A'], new)
+
+    _, site_a_log = storage.load_site('Site A')
+    _, site_b_log = storage.load_site('Site B')
+    assert [t['seq'] for t in site_a_log] == [1, 2, 3]
+    assert [t['seq'] for t in site_b_log] == [2]
+
+
+def test_save_sites_appends_to_history_written_by_another_process():
+    data = sample_data()
+    storage.save_data(data)
+
+    # Another process appends to the shard; this process's cached history is stale.
+    site_info, log = storage.load_site('Site A')
+    base = os.path.join(storage.DATA_DIR, storage.SHARD_DIR, storage.shard_id('Site A'))
+    storage._write_file(base, {'sites': {'Site A': site_info}, 'transactions': log + [used(3)]}, 'json')
+
+    data['transactions'].append(used(4))
+    storage.save_sites(data, ['Site A'], [data['transactions'][-1]])
+
+    _, log = storage.load_site('Site A')
+    assert [t['seq'] for t in log] == [1, 2, 3, 4]
+
+
+def test_save_sites_skips_transactions_already_stored():
+    data = sample_data()
+    storage.save_data(data)
+    storage.save_sites(data, ['Site A'], data['transactions'])
+    _, log = storage.load_site('Site A')
+    assert [t['seq'] for t in log] == [1, 2]
+
+
+def test_save_index_writes_only_new_and_removed_sites():
+    data = sample_data()
+    storage.save_data(data)
+    site_b_path = storage.shard_path('Site B')
+    before = os.stat(site_b_path).st_mtime_ns
+
+    data['sites']['Site C'] = {'materials': {}, 'tools and accessories': {}, 'machines': {}}
+    del data['sites']['Site A']
+    storage.save_index(data)
+
+    assert os.stat(site_b_path).st_mtime_ns == before
+    assert set(storage.site_shards()) == {'Site B', 'Site C'}
+    assert storage.shard_path('Site A') is None
+    assert storage.load_site('Site C') == (data['sites']['Site C'], [])
+
+
+def test_site_save_on_a_new_store_writes_the_index():
+    data = sample_data()
+    storage.save_sites(data, ['Site A'], data['transactions'])
+
+    loaded = storage.load_data()
+    assert loaded is not None
+    assert loaded['sites'] == data['sites']
+    assert [t['seq'] for t in loaded['transactions']] == [1, 2]
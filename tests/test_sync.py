@@ -0,0 +1,145 @@
+import copy
+import json
+
+import pytest
+
+import api
+import change_feed
+import inventory
+import storage
+import sync
+from conftest import make_data
+
+
+def stocked_data():
+    data = make_data('Site A', 'Site B')
+    data['sites']['Site A']['materials']['cement'] = {
+        'stock': 100, 'used': 0, 'unit': 'bags', 'min_stock': 5, 'category': 'materials', 'rate': 350.0,
+        'value': 35000.0}
+    data['system_info']['last_seq'] = 0
+    return data
+
+
+def use(quantity, **fields):
+    return sync.new_record('use', site='Site A', category='materials', item='cement', quantity=quantity,
+                           work_area='Block A', supervisor='Supervisor', **fields)
+
+
+def without_versions(data):
+    data = copy.deepcopy(data)
+    for site_info in data['sites'].values():
+        site_info.pop('version', None)
+    return data
+
+
+def test_batch_statuses():
+    data = stocked_data()
+    first = use(10)
+    records = [first, first, use(500), {'op': 'use'}, {**use(1), 'op': 'burn'}, use(5)]
+    results, transactions = sync.apply_batch(data, records, sync.request_index(data['transactions']))
+    assert [r['status'] for r in results] == ['applied', 'duplicate', 'conflict', 'invalid', 'invalid', 'applied']
+    assert results[1]['seq'] == results[0]['seq'] == 1
+    assert [t['seq'] for t in transactions] == [1, 2]
+    assert data['sites']['Site A']['materials']['cement']['stock'] == 85
+
+
+def test_unexpected_error_does_not_stop_the_batch(monkeypatch):
+    data = stocked_data()
+    consume = inventory.consume
+
+    def failing(data, site_name, category, item_name, quantity, *args, **kwargs):
+        if quantity == 13:
+            raise RuntimeError("boom")
+        return consume(data, site_name, category, item_name, quantity, *args, **kwargs)
+
+    monkeypatch.setattr(inventory, 'consume', failing)
+    results, transactions = sync.apply_batch(data, [use(13), use(2)], {})
+    assert [r['status'] for r in results] == ['invalid', 'applied']
+    assert 'boom' in results[0]['error']
+
+
+def test_undo_batch_restores_the_data():
+    data = stocked_data()
+    before = without_versions(data)
+    records = [
+        use(10),
+        sync.new_record('add', site='Site A', category='materials', item='sand', quantity=20, unit='kg', rate=5.0),
+        sync.new_record('transfer', from_site='Site A', to_site='Site B', category='materials', item='cement',
+                        quantity=30, authorized_by='Manager', driver_name='Driver'),
+        use(90),
+    ]
+    applied = {}
+    results, transactions = sync.apply_batch(data, records, applied)
+    assert [r['status'] for r in results] == ['applied', 'applied', 'applied', 'conflict']
+
+    sync.undo_batch(data, transactions, applied)
+    assert without_versions(data) == before
+    assert applied == {}
+
+
+def test_unpublished_shard_history_is_replaced():
+    data = stocked_data()
+    storage.save_data(data)
+    for quantity in (1, 2, 3):
+        inventory.consume(data, 'Site A', 'materials', 'cement', quantity, 'Block A', 'Supervisor')
+    storage.save_sites(data, ['Site A'], data['transactions'])
+
+    # The save of seqs 2-3 was never published: they are taken back and redone.
+    del data['transactions'][1:]
+    data['system_info']['last_seq'] = 1
+    inventory.consume(data, 'Site A', 'materials', 'cement', 7, 'Block A', 'Supervisor')
+    storage.save_sites(data, ['Site A'], data['transactions'][1:])
+
+    stored = storage.load_data()['transactions']
+    assert [(t['seq'], t['quantity']) for t in stored] == [(1, 1), (2, 7)]
+
+
+class FakeClient:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.sent = None
+
+    def post(self, path, payload):
+        self.sent = payload['records']
+        return 200, {'results': [{'request_id': r['request_id'], 'status': s}
+                                 for r, s in zip(self.sent, self.statuses)]}
+
+
+def test_outbox_push_keeps_only_rejected_records(tmp_path):
+    outbox = sync.Outbox(str(tmp_path / 'outbox.jsonl'))
+    outbox.add('use', site='Site A', item='cement', quantity=1)
+    conflict = outbox.add('use', site='Site A', item='cement', quantity=999)
+    outbox.add('use', site='Site A', item='cement', quantity=2)
+
+    outbox.push(FakeClient(['applied', 'conflict', 'duplicate']))
+    assert outbox.pending() == []
+    with open(outbox.path + '.rejected.jsonl', encoding='utf-8') as f:
+        rejected = [json.loads(line) for line in f]
+    assert [r['request_id'] for r in rejected] == [conflict['request_id']]
+    assert rejected[0]['status'] == 'conflict'
+
+
+def test_failed_flush_is_taken_back(monkeypatch):
+    storage.save_data(stocked_data())
+    store = api.Store(flush_interval=0)
+    save = change_feed.ChangeFeed.save
+    calls = []
+
+    def failing_save(self, data, sites=None, rewrite=False):
+        calls.append(sites)
+        if len(calls) == 1:
+            raise OSError("disk full")
+        return save(self, data, sites, rewrite)
+
+    monkeypatch.setattr(change_feed.ChangeFeed, 'save', failing_save)
+    record = use(10)
+    with pytest.raises(RuntimeError, match='disk full'):
+        store.apply([record])
+    assert store.data['sites']['Site A']['materials']['cement']['stock'] == 100
+    assert store.data['transactions'] == []
+
+    # Resending the batch applies it instead of reporting a duplicate.
+    assert [r['status'] for r in store.apply([record])] == ['applied']
+    data = change_feed.ChangeFeed().load()
+    assert data['sites']['Site A']['materials']['cement']['stock'] == 90
+    assert [t['request_id'] for t in data['transactions']] == [record['request_id']]
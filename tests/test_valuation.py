@@ -0,0 +1,37 @@
+import pytest
+
+import inventory
+import valuation
+from conftest import make_data
+
+
+def test_receipts_and_issues_use_the_average_cost():
+    item = {'stock': 10, 'rate': 100.0}
+    assert valuation.item_value(item) == 1000.0
+    assert valuation.receipt(item, 10, 130.0) == 1300.0
+    item['stock'] = 20
+    assert valuation.average_cost(item) == 115.0
+
+    assert valuation.issue(item, 5) == 575.0
+    item['stock'] = 15
+    assert item['value'] == 1725.0
+    assert valuation.issue(item, 15) == 1725.0
+    item['stock'] = 0
+    assert item['value'] == 0.0 and valuation.average_cost(item) == 100.0
+
+
+def test_revalue_keeps_average_cost_unless_the_rate_changes():
+    item = {'stock': 10, 'rate': 100.0, 'value': 1200.0}
+    assert valuation.revalue(item, 20, 100.0) == 2400.0
+    assert valuation.revalue(item, 20, 90.0) == 1800.0
+
+
+def test_transfer_moves_the_cost_to_the_receiving_site():
+    data = make_data('Site A', 'Site B')
+    inventory.receive(data, 'Site A', 'materials', 'cement', 10, 'Store',
+                      new_item={'unit': 'bags', 'min_stock': 1, 'rate': 100.0})
+    inventory.receive(data, 'Site A', 'materials', 'cement', 10, 'Store', rate=140.0)
+    moved = inventory.transfer(data, 'Site A', 'Site B', 'materials', 'cement', 5, 'Manager', 'Driver')
+    assert moved['value'] == pytest.approx(600.0)
+    assert valuation.item_value(data['sites']['Site A']['materials']['cement']) == pytest.approx(1800.0)
+    assert valuation.item_value(data['sites']['Site B']['materials']['cement']) == pytest.approx(600.0)
@@ -0,0 +1,63 @@
+"""Running weighted-average cost of items.
+
+Every item carries ``value``, the cost of the stock on hand, which the
+inventory operations keep up to date instead of views recomputing it as
+stock * rate:
+
+* a receipt adds quantity * its purchase rate,
+* usage and transfers take stock off at the average cost (value / stock);
+  the cost taken is recorded on the transaction as ``value``,
+* a transfer adds that cost to the item at the receiving site.
+
+An edit that changes the rate revalues the stock at the new rate, an edit of
+the stock alone keeps the average cost.  Items saved before values were kept
+start from stock * rate.  Reading a valuation is item_value() per item.
+"""
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0.0
+    return float(value)
+
+
+def item_value(item):
+    """Cost of the item's stock on hand"""
+    value = item.get('value')
+    if value is None:
+        return _number(item.get('stock')) * _number(item.get('rate'))
+    return _number(value)
+
+
+def average_cost(item):
+    """Cost per unit of the stock on hand; the item's rate when it has none"""
+    stock = _number(item.get('stock'))
+    if stock > 0:
+        return item_value(item) / stock
+    return _number(item.get('rate'))
+
+
+def receipt(item, quantity, rate):
+    """Add the cost of a receipt; call before the stock changes.  Returns the cost"""
+    cost = _number(quantity) * _number(rate)
+    item['value'] = item_value(item) + cost
+    return cost
+
+
+def issue(item, quantity):
+    """Take quantity off at average cost; call before the stock changes.  Returns the cost"""
+    stock = _number(item.get('stock'))
+    value = item_value(item)
+    if quantity >= stock:
+        item['value'] = 0.0
+        return value
+    cost = value * quantity / stock
+    item['value'] = value - cost
+    return cost
+
+
+def revalue(item, stock, rate):
+    """Value of an edited item; call before the item changes"""
+    if rate != item.get('rate'):
+        return _number(stock) * _number(rate)
+    return _number(stock) * average_cost(item)